@@ -64,6 +64,9 @@ The output action contains a dictionary with the following elements:
  * failover (dict): Output with a failover port (experimental)
 """
 
+    # Tunnel sources are resolved across DPs, after finalize.
+    mutable_attrs = frozenset(['tunnel_info'])
+
     defaults = {
         'rules': None,
         'exact_match': False,
@@ -190,11 +193,11 @@ The output action contains a dictionary with the following elements:
                 raise InvalidConfigError(err)
             test_config_condition(not ofmsgs, 'OF messages is empty')
             for ofmsg in ofmsgs:
-                ofmsg.datapath = NullRyuDatapath()
-                ofmsg.set_xid(0)
                 try:
-                    ofmsg.serialize()
-                except (KeyError, ValueError) as err:
+                    ryu_ofmsg = valve_of.to_ryu_ofmsg(ofmsg, NullRyuDatapath())
+                    ryu_ofmsg.set_xid(0)
+                    ryu_ofmsg.serialize()
+                except (netaddr.core.AddrFormatError, KeyError, ValueError) as err:
                     raise InvalidConfigError(err)
                 except Exception as err:
                     print(ofmsg)
@@ -17,6 +17,7 @@
 # limitations under the License.
 
 import difflib
+import hashlib
 import ipaddress
 import json
 from collections import OrderedDict
@@ -41,6 +42,8 @@ class Conf:
     defaults_types = None # type: dict
     dyn_finalized = False
     dyn_hash = None
+    dyn_digest = None
+    dyn_key_digests = None
 
     def __init__(self, _id, dp_id, conf=None):
         self._id = _id
@@ -167,10 +170,33 @@ class Conf:
         return '\n'.join(differ.compare(
             self.to_conf().splitlines(), other.to_conf().splitlines()))
 
+    @staticmethod
+    def _key_digest(key, value):
+        """Return digest of an attribute key/value."""
+        return hashlib.sha256(str((key, value)).encode('utf-8')).digest()
+
+    def conf_digest(self, dyn=False, subconf=True, ignore_keys=None):
+        """Return digest of keys configurably filtering attributes.
+
+        The digest is composed from digests of each attribute, which once
+        finalized are computed only once (except for mutable attributes).
+        """
+        if (self.dyn_digest is not None and not dyn and subconf and not ignore_keys):
+            return self.dyn_digest
+        key_digests = self.dyn_key_digests
+        if key_digests is None:
+            key_digests = {}
+        digests = []
+        for key, value in self._conf_keys(self, dyn=dyn, subconf=subconf, ignore_keys=ignore_keys):
+            key_digest = key_digests.get(key, None)
+            if key_digest is None:
+                key_digest = self._key_digest(key, value)
+            digests.append(key_digest)
+        return hashlib.sha256(b''.join(sorted(digests))).hexdigest()
+
     def conf_hash(self, dyn=False, subconf=True, ignore_keys=None):
         """Return hash of keys configurably filtering attributes."""
-        return hash(frozenset(list(map(
-            str, self._conf_keys(self, dyn=dyn, subconf=subconf, ignore_keys=ignore_keys)))))
+        return hash(self.conf_digest(dyn=dyn, subconf=subconf, ignore_keys=ignore_keys))
 
     def __hash__(self):
         if self.dyn_hash is not None:
@@ -198,13 +224,21 @@ class Conf:
             {k: self._finalize_val(v) for k, v in self.__dict__.items()
              if not k.startswith('dyn')})
         self.dyn_finalized = True
+        self.dyn_key_digests = {
+            key: self._key_digest(key, value) for key, value in self._conf_keys(self)
+            if key not in self.mutable_attrs}
+        if not self.mutable_attrs:
+            self.dyn_digest = self.conf_digest()
 
     def ignore_subconf(self, other, ignore_keys=None):
         """Return True if this config same as other, ignoring sub config."""
-        return (self.conf_hash(dyn=False, subconf=False, ignore_keys=ignore_keys)
-                == other.conf_hash(dyn=False, subconf=False, ignore_keys=ignore_keys))
+        return (self.conf_digest(dyn=False, subconf=False, ignore_keys=ignore_keys)
+                == other.conf_digest(dyn=False, subconf=False, ignore_keys=ignore_keys))
 
     def __eq__(self, other):
+        other_digest = getattr(other, 'dyn_digest', None)
+        if self.dyn_digest is not None and other_digest is not None:
+            return self.dyn_digest == other_digest
         return self.__hash__() == other.__hash__()
 
     def __ne__(self, other):
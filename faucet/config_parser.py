@@ -222,6 +222,7 @@ def _config_parser_v2(config_file, logname):
 
     if not top_confs['dps']:
         raise InvalidConfigError('DPs not configured in file: %s' % config_path)
+    config_parser_util.prune_config_cache(config_hashes)
 
     dps = _dp_parser_v2(
         top_confs['acls'],
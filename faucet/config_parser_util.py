@@ -16,6 +16,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import hashlib
 import logging
 import os
@@ -31,6 +32,9 @@ except ImportError:
 
 CONFIG_HASH_FUNC = 'sha256'
 
+# Parsed config files, by hash of file contents.
+_PARSED_CONFIG_CACHE = {}
+
 
 class UniqueKeyLoader(Loader):
 
@@ -64,27 +68,55 @@ def get_logger(logname):
     return logging.getLogger(logname + '.config')
 
 
-def read_config(config_file, logname):
-    """Return a parsed YAML config file or None."""
+def _config_content_hash(config_content):
+    config_hash = getattr(hashlib, CONFIG_HASH_FUNC)
+    return config_hash(config_content.encode('utf-8')).hexdigest()
+
+
+def read_config_and_hash(config_file, logname):
+    """Return a parsed YAML config file or None, and hash of its contents or None.
+
+    Files are parsed only if their contents have not been parsed before.
+    """
     logger = get_logger(logname)
+    config_hash = None
     try:
         with open(config_file, 'r') as stream:
-            conf = yaml.safe_load(stream.read())
+            config_content = stream.read()
+        config_hash = _config_content_hash(config_content)
+        conf = _PARSED_CONFIG_CACHE.get(config_hash, None)
+        if conf is None:
+            conf = yaml.safe_load(config_content)
+            _PARSED_CONFIG_CACHE[config_hash] = conf
     except (yaml.YAMLError, UnicodeDecodeError,
             PermissionError, ValueError) as err: # pytype: disable=name-error
         logger.error('Error in file %s (%s)', config_file, str(err))
-        return None
+        return (None, config_hash)
     except FileNotFoundError as err: # pytype: disable=name-error
         logger.error('Could not find requested file: %s', config_file)
-        return None
+        return (None, None)
+    # Config parsing modifies the parsed config, so is given a copy.
+    return (copy.deepcopy(conf), config_hash)
+
+
+def read_config(config_file, logname):
+    """Return a parsed YAML config file or None."""
+    conf, _ = read_config_and_hash(config_file, logname)
     return conf
 
 
+def prune_config_cache(config_hashes):
+    """Forget parsed config files, other than those with contents with these hashes."""
+    config_hashes = set(config_hashes.values())
+    for config_hash in list(_PARSED_CONFIG_CACHE):
+        if config_hash not in config_hashes:
+            del _PARSED_CONFIG_CACHE[config_hash]
+
+
 def config_file_hash(config_file_name):
     """Return hash of YAML config file contents."""
     with open(config_file_name) as config_file:
-        config_hash = getattr(hashlib, CONFIG_HASH_FUNC)
-        return config_hash(config_file.read().encode('utf-8')).hexdigest()
+        return _config_content_hash(config_file.read())
 
 
 def dp_config_path(config_file, parent_file=None):
@@ -100,7 +132,7 @@ def dp_include(config_hashes, config_file, logname, top_confs):
     if not os.path.isfile(config_file):
         logger.warning('not a regular file or does not exist: %s', config_file)
         return False
-    conf = read_config(config_file, logname)
+    conf, config_hash = read_config_and_hash(config_file, logname)
     if not conf:
         logger.warning('error loading config from file: %s', config_file)
         return False
@@ -117,7 +149,7 @@ def dp_include(config_hashes, config_file, logname, top_confs):
     # whether or not this configuration file should be reloaded upon receiving
     # a HUP signal.
     new_config_hashes = config_hashes.copy()
-    new_config_hashes[config_file] = config_file_hash(config_file)
+    new_config_hashes[config_file] = config_hash
 
     # Save the updated configuration state in separate dicts,
     # so if an error is found, the changes can simply be thrown away.
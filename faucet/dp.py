@@ -43,7 +43,7 @@ class DP(Conf):
 configuration.
 """
 
-    mutable_attrs = frozenset(['stack', 'vlans'])
+    mutable_attrs = frozenset(['stack', 'tunnel_acls', 'tunnel_updated_flags', 'vlans'])
 
     # Values that are set to None will be set using set_defaults
     # they are included here for testing and informational purposes
@@ -82,6 +82,8 @@ configuration.
         # This limits control plane activity when learning new hosts rapidly.
         # Flooding will still be done by the dataplane even with a packet
         # is ignored for learning purposes.
+        'packet_in_admission': {},
+        # Config for packet in admission control (token bucket rates per class).
         'drop_broadcast_source_address': True,
         # By default drop packets with a broadcast source address
         'drop_spoofed_faucet_mac': True,
@@ -89,7 +91,7 @@ configuration.
         'group_table': False,
         # Use GROUP tables for VLAN flooding
         'max_hosts_per_resolve_cycle': 5,
-        # Max hosts to try to resolve per gateway resolution cycle.
+        # Max hosts to try to resolve per gateway resolution cycle (per VLAN, shared between VLANs).
         'max_host_fib_retry_count': 10,
         # Max number of times to retry resolution of a host FIB route.
         'max_resolve_backoff_time': 64,
@@ -113,7 +115,7 @@ configuration.
         'lldp_beacon': {},
         # Config for LLDP beacon service.
         'metrics_rate_limit_sec': 0,
-        # Rate limit metric updates - don't update metrics if last update was less than this many seconds ago.
+        # Deprecated and ignored, learned host metrics are generated when scraped.
         'faucet_dp_mac': valve_packet.FAUCET_MAC,
         # MAC address of packets sent by FAUCET, not associated with any VLAN.
         'combinatorial_port_flood': False,
@@ -144,6 +146,14 @@ configuration.
         # Have OFA copy packet outs to multiple ports.
         'idle_dst': True,
         # If False, workaround for flow idle timer not reset on flow refresh.
+        'flow_audit': False,
+        # If True, on connect compare flows already on the datapath and only send differences.
+        'bundles': False,
+        # If True, send batches of flow/group/meter changes as an atomic bundle.
+        'fib_compression': False,
+        # If True, install the fewest FIB prefixes giving the same forwarding as all routes.
+        'ofmsg_coalesce_ms': 0,
+        # If > 0, queue flow messages this long so superseded ones need not be sent.
         }
 
     defaults_types = {
@@ -165,6 +175,7 @@ configuration.
         'ofchannel_log': str,
         'stack': dict,
         'ignore_learn_ins': int,
+        'packet_in_admission': dict,
         'drop_broadcast_source_address': bool,
         'drop_spoofed_faucet_mac': bool,
         'group_table': bool,
@@ -196,6 +207,10 @@ configuration.
         'multi_out': bool,
         'lacp_timeout': int,
         'idle_dst': bool,
+        'flow_audit': bool,
+        'bundles': bool,
+        'fib_compression': bool,
+        'ofmsg_coalesce_ms': int,
     }
 
     default_table_sizes_types = {
@@ -222,6 +237,24 @@ configuration.
         'system_name': str,
     }
 
+    packet_in_admission_defaults = {
+        'learn_rate': 0,
+        # Max learning packet ins per second for this DP (0 is unlimited).
+        'port_learn_rate': 0,
+        # Max learning packet ins per second for each port (0 is unlimited).
+        'vlan_learn_rate': 0,
+        # Max learning packet ins per second for each VLAN (0 is unlimited).
+        'control_rate': 0,
+        # Max LACP, LLDP and ARP/ND (each) packet ins per second for this DP (0 is unlimited).
+    }
+
+    packet_in_admission_defaults_types = {
+        'learn_rate': int,
+        'port_learn_rate': int,
+        'vlan_learn_rate': int,
+        'control_rate': int,
+    }
+
     dot1x_defaults_types = {
         'nfv_intf': str,
         'nfv_sw_port': int,
@@ -262,6 +295,7 @@ configuration.
         self.high_priority = None
         self.highest_priority = None
         self.ignore_learn_ins = None
+        self.packet_in_admission = None
         self.interface_ranges = None
         self.interfaces = None
         self.lacp_timeout = None
@@ -298,6 +332,10 @@ configuration.
         self.strict_packet_in_cookie = None
         self.multi_out = None
         self.idle_dst = None
+        self.flow_audit = None
+        self.bundles = None
+        self.fib_compression = None
+        self.ofmsg_coalesce_ms = None
 
         self.acls = {}
         self.vlans = {}
@@ -313,6 +351,11 @@ configuration.
         self.lldp_beacon = {}
         self.table_sizes = {}
         self.dyn_up_port_nos = set()
+        # Bumped when the stack graph changes at runtime (e.g. a stack link goes down).
+        self.dyn_stack_graph_version = 0
+        # Stack graph and topology version, shortest paths between stack DPs by source
+        # and destination DP, and our stack ports towards each destination DP.
+        self.dyn_stack_paths = (None, None, {}, {})
         self.has_externals = None
 
         #tunnel_id: int
@@ -373,6 +416,13 @@ configuration.
                 self.lldp_beacon, self.lldp_beacon_defaults_types)
             if self.lldp_beacon['system_name'] is None:
                 self.lldp_beacon['system_name'] = self.name
+        self._check_conf_types(
+            self.packet_in_admission, self.packet_in_admission_defaults_types)
+        for rate in self.packet_in_admission.values():
+            test_config_condition(rate is None or rate < 0, (
+                'packet_in_admission rates must be >= 0'))
+        self.packet_in_admission = dict(
+            self.packet_in_admission_defaults, **self.packet_in_admission)
         if self.stack:
             self._check_conf_types(self.stack, self.stack_defaults_types)
         if self.dot1x:
@@ -778,16 +828,39 @@ configuration.
         for tunnel_id, tunnel_acl in self.tunnel_acls.items():
             self.tunnel_updated_flags[tunnel_id] = False
 
+    def _stack_paths(self):
+        """Return shortest paths between all stack DPs, as of the current stack topology.
+
+        Paths are computed only when the stack topology has changed, so
+        per-packet lookups never search the stack graph.
+        """
+        graph = self.stack['graph']
+        graph_version = self.dyn_stack_graph_version
+        paths_graph, paths_version, _, _ = self.dyn_stack_paths
+        if paths_graph is not graph or paths_version != graph_version:
+            paths = dict(networkx.all_pairs_shortest_path(graph))
+            ports_by_peer_dp = defaultdict(list)
+            for port in self.stack_ports:
+                ports_by_peer_dp[port.stack['dp'].name].append(port)
+            ports_by_dest_dp = {
+                dest_dp: ports_by_peer_dp.get(path[1], [])
+                for dest_dp, path in paths.get(self.name, {}).items() if len(path) > 1}
+            self.dyn_stack_paths = (graph, graph_version, paths, ports_by_dest_dp)
+        return self.dyn_stack_paths[2:]
+
+    def stack_topo_changed(self):
+        """Note the stack graph has changed, so paths are recomputed on next use."""
+        self.dyn_stack_graph_version += 1
+
     def shortest_path(self, dest_dp, src_dp=None):
         """Return shortest path to a DP, as a list of DPs."""
         if src_dp is None:
             src_dp = self.name
         if self.stack is not None and 'root_dp' in self.stack:
-            try:
-                return networkx.shortest_path(
-                    self.stack['graph'], src_dp, dest_dp)
-            except (networkx.exception.NetworkXNoPath, networkx.exception.NodeNotFound):
-                pass
+            paths, _ = self._stack_paths()
+            src_paths = paths.get(src_dp, None)
+            if src_paths is not None:
+                return src_paths.get(dest_dp, [])
         return []
 
     def shortest_path_to_root(self):
@@ -816,12 +889,11 @@ configuration.
 
     def shortest_path_port(self, dest_dp):
         """Return first port on our DP, that is the shortest path towards dest DP."""
-        shortest_path = self.shortest_path(dest_dp)
-        if len(shortest_path) > 1:
-            peer_dp = shortest_path[1]
-            peer_dp_ports = self.peer_stack_up_ports(peer_dp)
-            if peer_dp_ports:
-                return peer_dp_ports[0]
+        if self.stack is not None and 'root_dp' in self.stack:
+            _, ports_by_dest_dp = self._stack_paths()
+            for port in ports_by_dest_dp.get(dest_dp, []):
+                if port.running():
+                    return port
         return None
 
     def is_in_path(self, src_dp, dst_dp):
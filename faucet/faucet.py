@@ -52,31 +52,11 @@ class EventFaucetMetricUpdate(event.EventBase): # pylint: disable=too-few-public
     pass
 
 
-class EventFaucetResolveGateways(event.EventBase): # pylint: disable=too-few-public-methods
-    """Event used to trigger gateway re/resolution."""
+class EventFaucetValveServices(event.EventBase): # pylint: disable=too-few-public-methods
+    """Event used to trigger periodic Valve services that are due."""
     pass
 
 
-class EventFaucetStateExpire(event.EventBase): # pylint: disable=too-few-public-methods
-    """Event used to trigger expiration of state in controller."""
-    pass
-
-class EventFaucetFastStateExpire(event.EventBase): # pylint: disable=too-few-public-methods
-    """Event used to trigger fast expiration of state in controller."""
-    pass
-
-
-class EventFaucetAdvertise(event.EventBase): # pylint: disable=too-few-public-methods
-    """Event used to trigger periodic network advertisements (eg IPv6 RAs)."""
-    pass
-
-
-class EventFaucetFastAdvertise(event.EventBase): # pylint: disable=too-few-public-methods
-    """Event used to trigger periodic fast network advertisements (eg LACP)."""
-    pass
-
-
-
 class Faucet(RyuAppBase):
     """A RyuApp that implements an L2/L3 learning VLAN switch.
 
@@ -89,18 +69,18 @@ class Faucet(RyuAppBase):
         }
     _EVENTS = [EventFaucetExperimentalAPIRegistered]
     _VALVE_SERVICES = {
-        EventFaucetMetricUpdate: (None, 5),
-        EventFaucetResolveGateways: ('resolve_gateways', 2),
-        EventFaucetStateExpire: ('state_expire', 5),
-        EventFaucetFastStateExpire: ('fast_state_expire', 2),
-        EventFaucetAdvertise: ('advertise', 15),
-        EventFaucetFastAdvertise: ('fast_advertise', 5),
+        EventFaucetMetricUpdate: ('metric_update', 5, 2),
     }
+    # Bounds on how long to wait for the next Valve service to be due.
+    _VALVE_SERVICE_MIN_SEC = 0.1
+    _VALVE_SERVICE_MAX_SEC = 1
+    _OFMSG_FLUSH_SEC = 0.01
     logname = 'faucet'
     exc_logname = logname + '.exception'
     bgp = None
     metrics = None
     notifier = None
+    _flush_ofmsgs_thread = None
     valves_manager = None
 
     def __init__(self, *args, **kwargs):
@@ -115,7 +95,9 @@ class Faucet(RyuAppBase):
             self.get_setting('EVENT_SOCK'), self.metrics, self.logger)
         self.valves_manager = valves_manager.ValvesManager(
             self.logname, self.logger, self.metrics, self.notifier, self.bgp,
-            self.dot1x, self._send_flow_msgs)
+            self.dot1x, self._send_flow_msgs,
+            shard=int(self.get_setting('SHARD')),
+            shards=int(self.get_setting('SHARDS')))
         self.thread_managers = (self.bgp, self.dot1x, self.metrics, self.notifier)
 
     @kill_on_exception(exc_logname)
@@ -136,13 +118,17 @@ class Faucet(RyuAppBase):
         if notifier_thread is not None:
             self.threads.append(notifier_thread)
 
-        for service_event, service_pair in self._VALVE_SERVICES.items():
-            name, interval = service_pair
+        for service_event, service_params in self._VALVE_SERVICES.items():
+            name, interval, jitter = service_params
             thread = hub.spawn(
-                partial(self._thread_reschedule, service_event(), interval))
+                partial(self._thread_reschedule, service_event(), interval, jitter))
             thread.name = name
             self.threads.append(thread)
 
+        thread = hub.spawn(self._thread_valve_services)
+        thread.name = 'valve_services'
+        self.threads.append(thread)
+
         # Register to API
         self.api._register(self)
         self.send_event_to_observers(EventFaucetExperimentalAPIRegistered())
@@ -177,6 +163,39 @@ class Faucet(RyuAppBase):
             valve.logger.error('send_flow_msgs: DP not up')
             return
         valve.send_flows(ryu_dp, flow_msgs)
+        # Only poll for messages queued for coalescing while there are some.
+        if valve.outq.depth and self._flush_ofmsgs_thread is None:
+            self._flush_ofmsgs_thread = hub.spawn(self._thread_flush_ofmsgs)
+
+    def _thread_valve_services(self):
+        """Trigger Valve services only when one is due."""
+        while True:
+            now = time.time()
+            next_due = self.valves_manager.valve_services_next_due()
+            if next_due is not None and next_due <= now:
+                self.send_event(self.__class__.__name__, EventFaucetValveServices())
+            # Check at least every max period, in case services are rescheduled sooner.
+            period = self._VALVE_SERVICE_MAX_SEC
+            if next_due is not None:
+                period = min(max(next_due - now, self._VALVE_SERVICE_MIN_SEC), period)
+            self._thread_jitter(period, 0)
+
+    @kill_on_exception(exc_logname)
+    def _thread_flush_ofmsgs(self):
+        """Send OpenFlow messages queued for coalescing, once due, until none are queued."""
+        queued = True
+        while queued:
+            hub.sleep(self._OFMSG_FLUSH_SEC)
+            now = time.time()
+            queued = False
+            for valve in list(self.valves_manager.valves.values()):
+                if valve.flush_due(now):
+                    ryu_dp = self.dpset.get(valve.dp.dp_id)
+                    if ryu_dp:
+                        valve.flush_flows(ryu_dp, now, max_ofmsgs=valve.OUTQ_BATCH_SIZE)
+                if valve.outq.depth:
+                    queued = True
+        self._flush_ofmsgs_thread = None
 
     def _get_valve(self, ryu_event, require_running=False):
         """Get Valve instance to response to an event.
@@ -199,23 +218,20 @@ class Faucet(RyuAppBase):
     def _config_files_changed(self):
         return self.valves_manager.config_watcher.files_changed()
 
+    def _watch_config_files(self):
+        return self.valves_manager.config_watcher.watch()
+
     @set_ev_cls(EventFaucetMetricUpdate, MAIN_DISPATCHER)
     @kill_on_exception(exc_logname)
     def metric_update(self, _):
         """Handle a request to update metrics in the controller."""
         self.valves_manager.update_metrics(time.time())
 
-    @set_ev_cls(EventFaucetResolveGateways, MAIN_DISPATCHER)
-    @set_ev_cls(EventFaucetStateExpire, MAIN_DISPATCHER)
-    @set_ev_cls(EventFaucetFastStateExpire, MAIN_DISPATCHER)
-    @set_ev_cls(EventFaucetAdvertise, MAIN_DISPATCHER)
-    @set_ev_cls(EventFaucetFastAdvertise, MAIN_DISPATCHER)
+    @set_ev_cls(EventFaucetValveServices, MAIN_DISPATCHER)
     @kill_on_exception(exc_logname)
-    def _valve_flow_services(self, ryu_event):
-        """Call a method on all Valves and send any resulting flows."""
-        self.valves_manager.valve_flow_services(
-            time.time(),
-            self._VALVE_SERVICES[type(ryu_event)][0])
+    def _valve_flow_services(self, _):
+        """Call Valve services that are due and send any resulting flows."""
+        self.valves_manager.valve_flow_services_due(time.time())
 
     def get_config(self):
         """FAUCET experimental API: return config for all Valves."""
@@ -248,10 +264,10 @@ class Faucet(RyuAppBase):
         Args:
             ryu_event (ryu.controller.ofp_event.EventOFPErrorMsg): trigger
         """
-        valve, _, msg = self._get_valve(ryu_event)
+        valve, ryu_dp, msg = self._get_valve(ryu_event)
         if valve is None:
             return
-        valve.oferror(msg)
+        self._send_flow_msgs(valve, valve.oferror(msg), ryu_dp=ryu_dp)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER) # pylint: disable=no-member
     @kill_on_exception(exc_logname)
@@ -309,6 +325,21 @@ class Faucet(RyuAppBase):
             return
         valve.ofdescstats_handler(msg.body)
 
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER) # pylint: disable=no-member
+    @set_ev_cls(ofp_event.EventOFPGroupDescStatsReply, MAIN_DISPATCHER) # pylint: disable=no-member
+    @set_ev_cls(ofp_event.EventOFPMeterConfigStatsReply, MAIN_DISPATCHER) # pylint: disable=no-member
+    @kill_on_exception(exc_logname)
+    def flow_audit_reply_handler(self, ryu_event):
+        """Handle a stats reply to a flow audit.
+
+        Args:
+            ryu_event (ryu.controller.ofp_event.EventOFPStatsReply): trigger.
+        """
+        valve, ryu_dp, msg = self._get_valve(ryu_event)
+        if valve is None:
+            return
+        self._send_flow_msgs(valve, valve.flow_audit_reply(msg), ryu_dp=ryu_dp)
+
     @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER) # pylint: disable=no-member
     @kill_on_exception(exc_logname)
     def port_status_handler(self, ryu_event):
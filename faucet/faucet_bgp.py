@@ -53,9 +53,14 @@ class BgpSpeakerKey:
 
 
 class FaucetBgp:
-    """Wrapper for Ryu BGP speaker."""
+    """Wrapper for Ryu BGP speaker.
+
+    Route changes from BGP are coalesced for a short time, and then
+    applied to each DP's RIB, with one batch of flows sent per DP.
+    """
 
     exc_logname = None
+    ROUTE_COALESCE_SEC = 0.5
 
     def __init__(self, logger, exc_logname, metrics, send_flow_msgs):
         self.logger = logger
@@ -65,6 +70,8 @@ class FaucetBgp:
         self._dp_bgp_speakers = {}
         self._dp_bgp_rib = {}
         self._valves = None
+        self._pending_route_changes = {}
+        self._route_flush_thread = None
         self.thread = None
 
     def _valve_vlan(self, dp_id, vlan_vid):
@@ -102,7 +109,7 @@ class FaucetBgp:
         """
         dp_id = bgp_speaker_key.dp_id
         vlan_vid = bgp_speaker_key.vlan_vid
-        valve, vlan = self._valve_vlan(dp_id, vlan_vid)
+        _, vlan = self._valve_vlan(dp_id, vlan_vid)
         if vlan is None:
             return
         prefix = ipaddress.ip_network(str(path_change.prefix))
@@ -118,20 +125,53 @@ class FaucetBgp:
                     nexthop, prefix)
                 return
 
-        flowmods = []
         if path_change.is_withdraw:
-            self.logger.info(
+            self.logger.debug(
                 'BGP withdraw %s', prefix)
             if prefix in self._dp_bgp_rib[bgp_speaker_key]:
                 del self._dp_bgp_rib[bgp_speaker_key][prefix]
-            flowmods = valve.del_route(vlan, prefix)
+            nexthop = None
         else:
-            self.logger.info(
+            self.logger.debug(
                 'BGP add %s nexthop %s', prefix, nexthop)
             self._dp_bgp_rib[bgp_speaker_key][prefix] = nexthop
-            flowmods = valve.add_route(vlan, nexthop, prefix)
-        if flowmods:
-            self._send_flow_msgs(valve, flowmods)
+        # Only the latest change to a prefix within the coalescing time is applied.
+        if dp_id not in self._pending_route_changes:
+            self._pending_route_changes[dp_id] = {}
+        self._pending_route_changes[dp_id][(vlan_vid, prefix)] = nexthop
+        if self._route_flush_thread is None:
+            self._route_flush_thread = hub.spawn_after(
+                self.ROUTE_COALESCE_SEC, self.flush_route_changes)
+
+    @kill_on_exception(exc_logname)
+    def flush_route_changes(self):
+        """Apply pending BGP route changes, sending one batch of flows per DP."""
+        self._route_flush_thread = None
+        pending_route_changes = self._pending_route_changes
+        self._pending_route_changes = {}
+        for dp_id, route_changes in pending_route_changes.items():
+            dp_valve = None
+            flowmods = []
+            adds = 0
+            withdraws = 0
+            for (vlan_vid, prefix), nexthop in route_changes.items():
+                valve, vlan = self._valve_vlan(dp_id, vlan_vid)
+                if vlan is None:
+                    continue
+                dp_valve = valve
+                if nexthop is None:
+                    withdraws += 1
+                    flowmods.extend(valve.del_route(vlan, prefix))
+                else:
+                    adds += 1
+                    flowmods.extend(valve.add_route(vlan, nexthop, prefix))
+            if dp_valve is None:
+                continue
+            self.logger.info(
+                'BGP applied %u adds and %u withdraws to DP %u' % (
+                    adds, withdraws, dp_id))
+            if flowmods:
+                self._send_flow_msgs(dp_valve, flowmods)
 
     @staticmethod
     def _vlan_prefixes_by_ipv(vlan, ipv):
@@ -177,6 +217,10 @@ class FaucetBgp:
         for bgp_speaker in self._dp_bgp_speakers.values():
             bgp_speaker.shutdown()
         self._dp_bgp_speakers = {}
+        if self._route_flush_thread is not None:
+            hub.kill(self._route_flush_thread)
+            self._route_flush_thread = None
+        self._pending_route_changes = {}
 
     def _add_bgp_speaker(self, valve, bgp_speaker_key, bgp_router):
         if bgp_speaker_key in self._dp_bgp_speakers:
@@ -184,12 +228,15 @@ class FaucetBgp:
             bgp_speaker = self._dp_bgp_speakers[bgp_speaker_key]
             if bgp_speaker_key in self._dp_bgp_rib:
                 # Re-add routes (to avoid flapping BGP even when VLAN cold starts).
+                bgp_vlan = bgp_router.bgp_vlan()
+                flowmods = []
                 for prefix, nexthop in self._dp_bgp_rib[bgp_speaker_key].items():
-                    self.logger.info('Re-adding %s via %s' % (prefix, nexthop))
-                    bgp_vlan = bgp_router.bgp_vlan()
-                    flowmods = valve.add_route(bgp_vlan, nexthop, prefix)
-                    if flowmods:
-                        self._send_flow_msgs(valve, flowmods)
+                    self.logger.debug('Re-adding %s via %s' % (prefix, nexthop))
+                    flowmods.extend(valve.add_route(bgp_vlan, nexthop, prefix))
+                self.logger.info('Re-added %u routes for %s' % (
+                    len(self._dp_bgp_rib[bgp_speaker_key]), bgp_speaker_key))
+                if flowmods:
+                    self._send_flow_msgs(valve, flowmods)
         else:
             self.logger.info('Adding %s' % bgp_speaker_key)
             bgp_speaker = self._create_bgp_speaker_for_vlan(bgp_speaker_key, bgp_router)
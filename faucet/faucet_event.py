@@ -2,8 +2,6 @@
 
 # TODO: events are currently schema-less. This is to facilitate rapid prototyping, and will change.
 # TODO: not all cases where a notified client fails or could block, have been tested.
-# only one client is supported (multiple clients should be implemented with a client that
-# copies/pushes to a message bus)
 
 # Copyright (C) 2013 Nippon Telegraph and Telephone Corporation.
 # Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
@@ -24,9 +22,9 @@
 
 import json
 import os
+import select
 import socket
 import time
-from contextlib import contextmanager
 
 import eventlet
 eventlet.monkey_patch()
@@ -35,27 +33,24 @@ from ryu.lib import hub # pylint: disable=wrong-import-position
 from ryu.lib.hub import StreamServer # pylint: disable=wrong-import-position
 
 
-class NonBlockLock:
-    """Non blocking lock that can be used as a context manager."""
-
-    def __init__(self):
-        self._lock = eventlet.semaphore.Semaphore()
-
-    @contextmanager
-    def acquire_nonblock(self):
-        """Attempt to acquire a lock."""
-        result = self._lock.acquire(blocking=False)
-        yield result
-        if result:
-            self.release()
+class FaucetEventNotifier:
+    """Event notification, via Unix domain socket.
 
-    def release(self):
-        """Release lock when done."""
-        self._lock.release()
+    Events are serialized once, into a ring buffer of the most recent events.
+    Any number of clients may connect, each with its own cursor into the buffer,
+    and each is sent all events it has not yet seen in one write per wakeup.
 
+    On connecting, a client may optionally send a subscription, as one line of
+    JSON, e.g. {"event_id": 100, "event_types": ["L2_LEARN"]}. Events after
+    event_id still in the buffer are replayed (so a client can resume after
+    reconnecting), and only events of the given types are sent. By default,
+    all buffered events of any type are sent. The server does not wait for
+    a subscription; one that arrives late applies to events not yet sent.
+    """
 
-class FaucetEventNotifier:
-    """Event notification, via Unix domain socket."""
+    EVENT_BUFFER_SIZE = 1024
+    SUBSCRIBE_TIMEOUT_SEC = 0.2
+    SUBSCRIBE_MAX_BYTES = 4096
 
     def __init__(self, socket_path, metrics, logger):
         self.logger = logger
@@ -63,8 +58,10 @@ class FaucetEventNotifier:
         self.metrics = metrics
         self.event_id = 0
         self.thread = None
-        self.lock = NonBlockLock()
-        self.event_q = eventlet.queue.Queue(120)
+        self.clients = 0
+        # (event_type, serialized event) by event_id modulo buffer size.
+        self.event_buffer = [None] * self.EVENT_BUFFER_SIZE
+        self._wakeup = eventlet.event.Event()
 
     def start(self):
         """Start socket server."""
@@ -74,21 +71,97 @@ class FaucetEventNotifier:
             self.thread.name = 'event'
         return self.thread
 
+    @staticmethod
+    def _subscription_sent(sock):
+        """Return True if a client has sent a subscription (or closed), without waiting."""
+        return bool(select.select([sock], [], [], 0)[0])
+
+    def _read_subscription(self, sock, event_id, event_types):
+        """Return event_id to resume after and event types wanted, or None if client closed.
+
+        Only called once a client has started sending, so waits only for the rest of a line.
+        """
+        buf = b''
+        sock.settimeout(self.SUBSCRIBE_TIMEOUT_SEC)
+        try:
+            while b'\n' not in buf and len(buf) < self.SUBSCRIBE_MAX_BYTES:
+                data = sock.recv(self.SUBSCRIBE_MAX_BYTES)
+                if not data:
+                    if not buf:
+                        return None
+                    break
+                buf += data
+        except socket.timeout:
+            pass
+        except (socket.error, IOError):
+            return None
+        finally:
+            sock.settimeout(None)
+        line = buf.split(b'\n')[0].strip()
+        if line:
+            try:
+                subscription = json.loads(line.decode('UTF-8'))
+                # Events already sent are not sent again.
+                event_id = max(int(subscription.get('event_id', event_id)), event_id)
+                if subscription.get('event_types', None) is not None:
+                    event_types = frozenset(subscription['event_types'])
+            except (ValueError, TypeError, AttributeError) as err:
+                self.logger.info('ignoring invalid event subscription: %s', err)
+        return (event_id, event_types)
+
+    def events_since(self, event_id, event_types=None):
+        """Return event_id of the last buffered event, and serialized events after event_id.
+
+        Args:
+            event_id (int): send events with higher event IDs than this.
+            event_types (frozenset): event types wanted, or None for all.
+        Returns:
+            tuple: last buffered event ID, events (bytes).
+        """
+        last_event_id = self.event_id
+        first_event_id = max(event_id + 1, last_event_id - self.EVENT_BUFFER_SIZE + 1, 1)
+        if first_event_id > event_id + 1:
+            self.logger.info(
+                'event client missed %u events', first_event_id - event_id - 1)
+        events = []
+        for buffered_event_id in range(first_event_id, last_event_id + 1):
+            event_type, event_bytes = self.event_buffer[
+                buffered_event_id % self.EVENT_BUFFER_SIZE]
+            if event_types is None or event_type in event_types:
+                events.append(event_bytes)
+        return (last_event_id, b''.join(events))
+
     def _loop(self, sock, _addr):
-        """Serve events."""
-        with self.lock.acquire_nonblock() as result:
-            if not result:
-                self.logger.info('multiple event clients not supported')
-            else:
-                self.logger.info('event client connected')
-                while True:
-                    event = self.event_q.get()
-                    event_bytes = bytes('\n'.join((json.dumps(event), '')).encode('UTF-8'))
-                    try:
-                        sock.sendall(event_bytes)
-                    except (socket.error, IOError) as err:
-                        self.logger.info('event client disconnected: %s', err)
-                        break
+        """Serve events to a client."""
+        self.clients += 1
+        self.metrics.faucet_event_clients.set(self.clients)
+        self.logger.info('event client connected')
+        event_id = 0
+        event_types = None
+        while True:
+            if self._subscription_sent(sock):
+                subscription = self._read_subscription(sock, event_id, event_types)
+                if subscription is None:
+                    self.logger.info('event client disconnected')
+                    break
+                event_id, event_types = subscription
+                if event_id > self.event_id:
+                    # Event IDs restart with FAUCET, so replay all buffered events.
+                    event_id = 0
+            wakeup = self._wakeup
+            if event_id >= self.event_id:
+                wakeup.wait()
+                continue
+            event_id, event_bytes = self.events_since(event_id, event_types)
+            if not event_bytes:
+                continue
+            try:
+                sock.sendall(event_bytes)
+            except (socket.error, IOError) as err:
+                self.logger.info('event client disconnected: %s', err)
+                break
+        self.clients -= 1
+        self.metrics.faucet_event_clients.set(self.clients)
         try:
             sock.close()
         except (socket.error, IOError):
@@ -109,9 +182,14 @@ class FaucetEventNotifier:
             assert header_key not in event_dict
         event.update(event_dict)
         self.metrics.faucet_event_id.set(event['event_id'])
-        if self.event_q.full():
-            self.event_q.get()
-        self.event_q.put(event)
+        if not self.socket_path:
+            return
+        event_type = next(iter(event_dict), None)
+        event_bytes = bytes('\n'.join((json.dumps(event), '')).encode('UTF-8'))
+        self.event_buffer[self.event_id % self.EVENT_BUFFER_SIZE] = (event_type, event_bytes)
+        wakeup = self._wakeup
+        self._wakeup = eventlet.event.Event()
+        wakeup.send()
 
     def check_path(self, socket_path):
         """Check that socket_path is valid."""
@@ -20,10 +20,100 @@
 
 from prometheus_client import Gauge as PromGauge, Info
 from prometheus_client import Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily
 
 from faucet.prom_client import PromClient
 
 
+class LearnedHostsCollector:
+    """Generate learned host metrics from VLAN host caches, when scraped."""
+
+    def __init__(self, required_labels, port_required_labels):
+        self.required_labels = required_labels
+        self.port_required_labels = port_required_labels
+        self.dps_func = None
+
+    def _metric_families(self):
+        return (
+            GaugeMetricFamily(
+                'vlan_hosts_learned',
+                'number of hosts learned on a VLAN',
+                labels=self.required_labels + ['vlan']),
+            GaugeMetricFamily(
+                'port_vlan_hosts_learned',
+                'number of hosts learned on a port and VLAN',
+                labels=self.port_required_labels + ['vlan']),
+            GaugeMetricFamily(
+                'learned_macs',
+                ('MAC address stored as 64bit number to DP ID, port, VLAN, '
+                 'and n (discrete index)'),
+                labels=self.port_required_labels + ['vlan', 'n']))
+
+    def describe(self):
+        """Return metric families without samples."""
+        return self._metric_families()
+
+    def _collect_port_hosts(self, dp, vlan, port_vlan_hosts_learned, learned_macs):
+        vid = str(vlan.vid)
+        for port in vlan.get_ports():
+            port_labels = dp.port_labels(port.number)
+            port_label_values = [
+                str(port_labels[label]) for label in self.port_required_labels] + [vid]
+            port_hosts = vlan.cached_hosts_on_port(port)
+            port_vlan_hosts_learned.add_metric(port_label_values, len(port_hosts))
+            for i, eth_src_int in enumerate(
+                    sorted([entry.eth_src_int for entry in port_hosts])):
+                learned_macs.add_metric(port_label_values + [str(i)], eth_src_int)
+
+    def collect(self):
+        """Return metric families with samples for all DPs' VLAN host caches."""
+        vlan_hosts_learned, port_vlan_hosts_learned, learned_macs = self._metric_families()
+        dps = []
+        if self.dps_func is not None:
+            dps = self.dps_func()
+        for dp in dps:
+            dp_labels = dp.base_prom_labels()
+            dp_label_values = [str(dp_labels[label]) for label in self.required_labels]
+            for vlan in list(dp.vlans.values()):
+                vlan_hosts_learned.add_metric(
+                    dp_label_values + [str(vlan.vid)], vlan.hosts_count())
+                self._collect_port_hosts(dp, vlan, port_vlan_hosts_learned, learned_macs)
+        return (vlan_hosts_learned, port_vlan_hosts_learned, learned_macs)
+
+
+class BoundMetrics: # pylint: disable=too-few-public-methods
+    """Metric children bound to fixed labels.
+
+    Each child is looked up on first use, then cached as an attribute
+    named for its metric, so later updates skip label handling.
+    """
+
+    def __init__(self, metrics, labels):
+        self._metrics = metrics
+        self._labels = labels
+
+    def __getattr__(self, var):
+        if var.startswith('_'):
+            raise AttributeError(var)
+        child = getattr(self._metrics, var).labels(**self._labels)
+        setattr(self, var, child)
+        return child
+
+
+class DPMetrics(BoundMetrics): # pylint: disable=too-few-public-methods
+    """Metric children bound to a DP, and to each of its ports and VLANs."""
+
+    def __init__(self, metrics, dp):
+        dp_labels = dp.base_prom_labels()
+        super(DPMetrics, self).__init__(metrics, dp_labels)
+        self.ports = {
+            port_no: BoundMetrics(metrics, dp.port_labels(port_no))
+            for port_no in dp.ports}
+        self.vlans = {
+            vid: BoundMetrics(metrics, dict(dp_labels, vlan=vid))
+            for vid in dp.vlans}
+
+
 class FaucetMetrics(PromClient):
     """Container class for objects that can be exported to Prometheus."""
 
@@ -53,6 +143,9 @@ class FaucetMetrics(PromClient):
         self.faucet_event_id = self._gauge(
             'faucet_event_id',
             'highest/most recent event ID to be sent', [])
+        self.faucet_event_clients = self._gauge(
+            'faucet_event_clients',
+            'number of clients connected to the event socket', [])
         self.faucet_config_reload_warm = self._dpid_counter(
             'faucet_config_reload_warm',
             'number of warm, differences only config reloads executed')
@@ -62,12 +155,24 @@ class FaucetMetrics(PromClient):
         self.of_ignored_packet_ins = self._dpid_counter(
             'of_ignored_packet_ins',
             'number of OF packet_ins received but ignored from DP (due to rate limiting)')
+        self.of_suppressed_packet_ins = self._dpid_counter(
+            'of_suppressed_packet_ins',
+            'number of OF packet_ins received from DP but suppressed, '
+            'as host learning was in progress')
+        self.of_avoided_packet_ins = self._dpid_counter(
+            'of_avoided_packet_ins',
+            'number of hosts learned from another DP in the stack, '
+            'avoiding an OF packet_in from DP')
         self.of_unexpected_packet_ins = self._dpid_counter(
             'of_unexpected_packet_ins',
             'number of OF packet_ins received that are unexpected from DP (e.g. for unknown VLAN)')
         self.of_packet_ins = self._dpid_counter(
             'of_packet_ins',
             'number of OF packet_ins received from DP')
+        self.of_packet_in_drops = self._counter(
+            'of_packet_in_drops',
+            'number of OF packet_ins dropped by admission control, by packet class',
+            self.REQUIRED_LABELS + ['packet_class'])
         self.of_non_vlan_packet_ins = self._dpid_counter(
             'of_non_vlan_packet_ins',
             'number of OF packet_ins received from DP, not associated with a FAUCET VLAN')
@@ -77,6 +182,20 @@ class FaucetMetrics(PromClient):
         self.of_flowmsgs_sent = self._dpid_counter(
             'of_flowmsgs_sent',
             'number of OF flow messages (and packet outs) sent to DP')
+        self.of_outq_coalesced = self._dpid_counter(
+            'of_outq_coalesced',
+            'number of queued OF flow messages superseded before being sent to DP')
+        self.of_outq_overflows = self._dpid_counter(
+            'of_outq_overflows',
+            'number of times too many OF messages were queued for DP')
+        self.of_outq_depth = self._dpid_gauge(
+            'of_outq_depth',
+            'number of OF messages queued for DP')
+        self.of_outq_latency_secs = self._histogram(
+            'of_outq_latency_secs',
+            'time OF messages waited in queue for DP',
+            self.REQUIRED_LABELS,
+            (0.0001, 0.001, 0.01, 0.1, 1))
         self.of_errors = self._dpid_counter(
             'of_errors',
             'number of OF errors received from DP')
@@ -86,18 +205,30 @@ class FaucetMetrics(PromClient):
         self.of_dp_disconnections = self._dpid_counter(
             'of_dp_disconnections',
             'number of OF connections from a DP')
-        self.vlan_hosts_learned = self._gauge(
-            'vlan_hosts_learned',
-            'number of hosts learned on a VLAN',
-            self.REQUIRED_LABELS + ['vlan'])
-        self.port_vlan_hosts_learned = self._gauge(
-            'port_vlan_hosts_learned',
-            'number of hosts learned on a port and VLAN',
-            self.PORT_REQUIRED_LABELS + ['vlan'])
+        self.learned_hosts = LearnedHostsCollector(
+            self.REQUIRED_LABELS, self.PORT_REQUIRED_LABELS)
+        self._reg.register(self.learned_hosts)
         self.vlan_neighbors = self._gauge(
             'vlan_neighbors',
             'number of L3 neighbors on a VLAN (whether resolved to L2 addresses, or not)',
             self.REQUIRED_LABELS + ['vlan', 'ipv'])
+        self.vlan_nexthop_resolve_backlog = self._gauge(
+            'vlan_nexthop_resolve_backlog',
+            'number of L3 nexthops on a VLAN due to be resolved, but not yet attempted',
+            self.REQUIRED_LABELS + ['vlan', 'ipv'])
+        self.nexthop_resolve_latency_secs = self._histogram(
+            'nexthop_resolve_latency_secs',
+            'time L3 nexthops waited to be resolved after due',
+            self.REQUIRED_LABELS,
+            (0.1, 1, 2, 5, 10, 30))
+        self.vlan_fib_routes_logical = self._gauge(
+            'vlan_fib_routes_logical',
+            'number of resolved routes on a VLAN, before FIB compression',
+            self.REQUIRED_LABELS + ['vlan', 'ipv'])
+        self.vlan_fib_routes_installed = self._gauge(
+            'vlan_fib_routes_installed',
+            'number of FIB routes installed for a VLAN, after FIB compression',
+            self.REQUIRED_LABELS + ['vlan', 'ipv'])
         self.vlan_learn_bans = self._gauge(
             'vlan_learn_bans',
             'number of times learning was banned on a VLAN',
@@ -116,6 +247,11 @@ class FaucetMetrics(PromClient):
             'FAUCET valve service processing time',
             self.REQUIRED_LABELS + ['valve_service'],
             (0.0001, 0.001, 0.01, 0.1, 1))
+        self.faucet_valve_service_lateness_secs = self._histogram(
+            'faucet_valve_service_lateness_secs',
+            'FAUCET valve service time called after due',
+            self.REQUIRED_LABELS + ['valve_service'],
+            (0.01, 0.1, 1, 5, 10))
         self.bgp_neighbor_uptime_seconds = self._gauge(
             'bgp_neighbor_uptime',
             'BGP neighbor uptime in seconds',
@@ -124,11 +260,6 @@ class FaucetMetrics(PromClient):
             'bgp_neighbor_routes',
             'BGP neighbor route count',
             self.REQUIRED_LABELS + ['vlan', 'neighbor', 'ipv'])
-        self.learned_macs = self._gauge(
-            'learned_macs',
-            ('MAC address stored as 64bit number to DP ID, port, VLAN, '
-             'and n (discrete index)'),
-            self.PORT_REQUIRED_LABELS + ['vlan', 'n'])
         self.port_status = self._gauge(
             'port_status',
             'status of switch ports',
@@ -209,6 +340,10 @@ class FaucetMetrics(PromClient):
         for gauge in self._dpid_gauges.values():
             gauge.labels(**dp_labels).set(0)
 
+    def dp_metrics(self, dp):
+        """Return metric children bound to a DP, its ports and VLANs."""
+        return DPMetrics(self, dp)
+
     def inc_var(self, var, labels, val=1):
         assert labels is not None
         metrics_var = getattr(self, var)
@@ -113,6 +113,9 @@ class Gauge(RyuAppBase):
     def _config_files_changed(self):
         return self.config_watcher.files_changed()
 
+    def _watch_config_files(self):
+        return self.config_watcher.watch()
+
     @set_ev_cls(EventReconfigure, MAIN_DISPATCHER)
     def reload_config(self, ryu_event):
         """Handle request for Gauge config reload."""
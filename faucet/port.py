@@ -323,9 +323,9 @@ class Port(Conf):
         """Return all host cache entries this port has learned (on all or specified VLANs)."""
         if vlans is None:
             vlans = self.vlans()
-        hosts = []
+        hosts = ()
         for vlan in vlans:
-            hosts.extend([entry for entry in list(vlan.cached_hosts_on_port(self))])
+            hosts += vlan.cached_hosts_on_port(self)
         return hosts
 
     def hosts_count(self, vlans=None):
@@ -19,23 +19,27 @@
 
 import copy
 import logging
+import time
 
 from collections import defaultdict, deque
 
 from faucet import tfm_pipeline
 from faucet import valve_acl
+from faucet import valve_admission
 from faucet import valve_flood
 from faucet import valve_host
 from faucet import valve_of
+from faucet import valve_outq
 from faucet import valve_packet
 from faucet import valve_route
+from faucet import valve_shadow
 from faucet import valve_table
 from faucet import valve_util
 from faucet import valve_pipeline
 
 from faucet.faucet_pipeline import STACK_LOOP_PROTECT_FIELD
 from faucet.port import STACK_STATE_INIT, STACK_STATE_UP, STACK_STATE_DOWN
-from faucet.vlan import NullVLAN
+from faucet.vlan import EdgeHostIndex, NullVLAN
 
 
 class ValveLogger:
@@ -78,22 +82,29 @@ class Valve:
     __slots__ = [
         'dot1x',
         'dp',
+        'dp_metrics',
+        'edge_host_index',
         'flood_manager',
         'host_manager',
         'pipeline',
         'acl_manager',
+        'admission',
         'logger',
         'logname',
         'metrics',
         'notifier',
         'ofchannel_logger',
+        'outq',
         'recent_ofmsgs',
+        'shadow',
+        '_bundle_fallback',
+        '_bundle_id',
+        '_flow_audit',
         '_last_advertise_sec',
         '_last_fast_advertise_sec',
         '_last_packet_in_sec',
         '_last_pipeline_flows',
         '_packet_in_count_sec',
-        '_port_highwater',
         '_route_manager_by_eth_type',
         '_route_manager_by_ipv',
     ]
@@ -102,10 +113,15 @@ class Valve:
     USE_BARRIERS = True
     STATIC_TABLE_IDS = False
     GROUPS = True
+    OUTQ_MAX_DEPTH = 2**16
+    OUTQ_BATCH_SIZE = 1024
 
 
-    def __init__(self, dp, logname, metrics, notifier, dot1x):
+    def __init__(self, dp, logname, metrics, notifier, dot1x, edge_host_index=None):
         self.dot1x = dot1x
+        if edge_host_index is None:
+            edge_host_index = EdgeHostIndex()
+        self.edge_host_index = edge_host_index
         self.dp = dp
         self.logname = logname
         self.metrics = metrics
@@ -113,6 +129,11 @@ class Valve:
         self.ofchannel_logger = None
         self.logger = None
         self.recent_ofmsgs = deque(maxlen=32)
+        self.shadow = valve_shadow.ValveShadow()
+        self.outq = valve_outq.ValveOutQueue(self.OUTQ_MAX_DEPTH)
+        self._flow_audit = None
+        self._bundle_fallback = False
+        self._bundle_id = 0
         self._last_pipeline_flows = []
         self._packet_in_count_sec = None
         self._last_packet_in_sec = None
@@ -120,17 +141,16 @@ class Valve:
         self._last_fast_advertise_sec = None
         self.dp_init()
 
-    def _port_vlan_labels(self, port, vlan):
-        return dict(self.dp.port_labels(port.number), vlan=vlan.vid)
-
     def _inc_var(self, var, labels=None, val=1):
         if labels is None:
-            labels = self.dp.base_prom_labels()
+            getattr(self.dp_metrics, var).inc(val)
+            return
         self.metrics.inc_var(var, labels, val)
 
     def _set_var(self, var, val, labels=None):
         if labels is None:
-            labels = self.dp.base_prom_labels()
+            getattr(self.dp_metrics, var).set(val)
+            return
         metrics_var = getattr(self.metrics, var)
         metrics_var.labels(**labels).set(val)
 
@@ -146,6 +166,13 @@ class Valve:
             new_dp.clone_dyn_state(self.dp)
             self.dp = new_dp
 
+        self.dp_metrics = self.metrics.dp_metrics(self.dp)
+        self.admission = valve_admission.ValvePacketAdmission(
+            self.dp, {
+                packet_class: self.metrics.of_packet_in_drops.labels( # pylint: disable=no-member
+                    **dict(self.dp.base_prom_labels(), packet_class=packet_class))
+                for packet_class in valve_admission.PACKET_CLASSES},
+            self.dp_metrics.of_suppressed_packet_ins)
         self.close_logs()
         self.logger = ValveLogger(
             logging.getLogger(self.logname + '.valve'), self.dp.dp_id, self.dp.name)
@@ -156,15 +183,10 @@ class Valve:
         self._last_fast_advertise_sec = 0
         self._route_manager_by_ipv = {}
         self._route_manager_by_eth_type = {}
-        self._port_highwater = {}
 
         self.dp.reset_refs()
 
         self.pipeline = valve_pipeline.ValvePipeline(self.dp)
-        for vlan_vid in self.dp.vlans.keys():
-            self._port_highwater[vlan_vid] = {}
-            for port_number in self.dp.ports.keys():
-                self._port_highwater[vlan_vid][port_number] = 0
         for ipv, route_manager_class, neighbor_timeout in (
                 (4, valve_route.ValveIPv4RouteManager, self.dp.arp_neighbor_timeout),
                 (6, valve_route.ValveIPv6RouteManager, self.dp.nd_neighbor_timeout)):
@@ -179,7 +201,9 @@ class Valve:
                 self.dp.max_host_fib_retry_count,
                 self.dp.max_resolve_backoff_time, proactive_learn,
                 self.DEC_TTL, self.dp.multi_out, fib_table,
-                self.dp.tables['vip'], self.pipeline, self.dp.routers)
+                self.dp.tables['vip'], self.pipeline, self.dp.routers,
+                fib_compression=self.dp.fib_compression,
+                resolve_latency=self.dp_metrics.nexthop_resolve_latency_secs)
             self._route_manager_by_ipv[route_manager.IPV] = route_manager
             for vlan in self.dp.vlans.values():
                 if vlan.faucet_vips_by_ipv(route_manager.IPV):
@@ -193,8 +217,15 @@ class Valve:
                 self.logger, self.dp.tables['flood'], self.pipeline, self.dp.group_table,
                 self.dp.groups, self.dp.combinatorial_port_flood,
                 self.dp.stack, self.dp.stack_ports,
-                self.dp.shortest_path_to_root, self.dp.shortest_path_port)
+                self.dp.shortest_path_to_root, self.dp.shortest_path_port,
+                self.dp.stack_topo_changed, self.edge_host_index, self.dp.dp_id)
+            self.edge_host_index.add_dp(self.dp.dp_id, self.dp.name)
+            for vlan in self.dp.vlans.values():
+                vlan.index_edge_hosts(self.edge_host_index)
         else:
+            self.edge_host_index.remove_dp(self.dp.dp_id)
+            for vlan in self.dp.vlans.values():
+                vlan.index_edge_hosts(None)
             self.flood_manager = valve_flood.ValveFloodManager(
                 self.logger, self.dp.tables['flood'], self.pipeline, self.dp.group_table,
                 self.dp.groups, self.dp.combinatorial_port_flood)
@@ -251,7 +282,8 @@ class Valve:
             valve_of.faucet_async(
                 packet_in=False, notify_flow_removed=False, port_status=False),
             valve_of.desc_stats_request()]
-        ofmsgs.extend(self._delete_all_valve_flows())
+        if not self.dp.flow_audit:
+            ofmsgs.extend(self._delete_all_valve_flows())
         return ofmsgs
 
     def ofchannel_log(self, ofmsgs):
@@ -351,6 +383,7 @@ class Valve:
     def _del_vlan(self, vlan):
         """Delete a configured VLAN."""
         self.logger.info('Delete VLAN %s' % vlan)
+        self.edge_host_index.remove_vlan(self.dp.dp_id, vlan.vid)
         table = valve_table.wildcard_table
         return [table.flowdel(match=table.match(vlan=vlan))]
 
@@ -417,8 +450,7 @@ class Valve:
         port = self.dp.ports.get(port_no, None)
         if port is None:
             return
-        port_labels = self.dp.port_labels(port.number)
-        self._set_var('port_status', port_status, labels=port_labels)
+        self.dp_metrics.ports[port.number].port_status.set(port_status)
 
     def port_status_handler(self, port_no, reason, state, _other_valves):
         """Return OpenFlow messages responding to port operational status change."""
@@ -571,10 +603,8 @@ class Valve:
         ofmsgs_by_valve = {}
         if next_state is not None:
             next_state()
-            self._set_var(
-                'port_stack_state',
-                port.dyn_stack_current_state,
-                labels=self.dp.port_labels(port.number))
+            self.dp_metrics.ports[port.number].port_stack_state.set(
+                port.dyn_stack_current_state)
             if port.is_stack_up() or port.is_stack_down():
                 port_stack_up = port.is_stack_up()
                 for valve in [self] + other_valves:
@@ -609,6 +639,10 @@ class Valve:
                 if age > self.dp.lldp_beacon['send_interval'] * 3:
                     self.logger.info('LLDP for port %s inactive after %s' % (port, age))
                     port.dyn_lldp_beacon_recv_state = None
+        if self._flow_audit is not None:
+            if now - self._flow_audit.start_time > valve_shadow.FLOW_AUDIT_TIMEOUT_SEC:
+                ofmsgs_by_valve.setdefault(self, []).extend(
+                    self._flow_audit_fallback('timed out'))
         return ofmsgs_by_valve
 
     def _reset_dp_status(self):
@@ -644,6 +678,47 @@ class Valve:
         self.dp.dyn_running = True
         self._inc_var('of_dp_connections')
         self._reset_dp_status()
+        if self.dp.flow_audit:
+            ofmsgs = self._start_flow_audit(now, ofmsgs)
+        return ofmsgs
+
+    def _start_flow_audit(self, now, ofmsgs):
+        """Ask datapath for its existing state, rather than sending cold start ofmsgs now."""
+        if any(valve_of.is_table_features_req(ofmsg) for ofmsg in ofmsgs):
+            self.logger.info('flow audit not supported with table features, cold starting')
+            return ofmsgs
+        self.logger.info('auditing existing flows')
+        self._flow_audit = valve_shadow.ValveFlowAudit(
+            now, ofmsgs,
+            groups=self.dp.group_table,
+            meters=bool(self.dp.meters or self.dp.packetin_pps))
+        return self._flow_audit.stats_requests()
+
+    def _flow_audit_fallback(self, reason):
+        """Abandon flow audit and send cold start ofmsgs."""
+        self.logger.warning('flow audit %s, cold starting' % reason)
+        ofmsgs = self._flow_audit.ofmsgs
+        self._flow_audit = None
+        return ofmsgs
+
+    def flow_audit_reply(self, msg):
+        """Handle a stats reply to a flow audit request.
+
+        Args:
+            msg (ryu.ofproto.ofproto_v1_3_parser.OFPMultipartReply): reply from datapath.
+        Returns:
+            list: OpenFlow messages, if any.
+        """
+        if self._flow_audit is None or not self._flow_audit.stats_reply(msg):
+            return []
+        flow_audit = self._flow_audit
+        self._flow_audit = None
+        # Flows sent during the audit (e.g. learned hosts) may be newer than the reply.
+        sent_shadow = self.shadow
+        self.shadow = flow_audit.shadow
+        ofmsgs = self.shadow.sync(flow_audit.ofmsgs, sent=sent_shadow)
+        self.logger.info('flow audit found %u flows, sending %u of %u OpenFlow messages' % (
+            len(self.shadow.flows), len(ofmsgs), len(flow_audit.ofmsgs)))
         return ofmsgs
 
     def datapath_disconnect(self):
@@ -653,6 +728,10 @@ class Valve:
             {'DP_CHANGE': {
                 'reason': 'disconnect'}})
         self.dp.dyn_running = False
+        self.shadow.reset()
+        self.outq.reset()
+        self._set_var('of_outq_depth', 0)
+        self._flow_audit = None
         self._inc_var('of_dp_disconnections')
         self._reset_dp_status()
 
@@ -849,7 +928,7 @@ class Valve:
         return self.ports_delete([port_num])
 
     def _reset_lacp_status(self, port):
-        self._set_var('port_lacp_status', port.dyn_lacp_up, labels=self.dp.port_labels(port.number))
+        self.dp_metrics.ports[port.number].port_lacp_status.set(port.dyn_lacp_up)
 
     def lacp_down(self, port, cold_start=False):
         """Return OpenFlow messages when LACP is down on a port."""
@@ -1079,27 +1158,79 @@ class Valve:
             return route_manager.control_plane_handler(now, pkt_meta)
         return []
 
+    def admit_packet_in(self, now, pkt_meta):
+        """Return True if a packet in should be processed.
+
+        Control plane packet ins (LACP, LLDP, and ARP/ND for a FAUCET VIP or MAC)
+        have their own budget, and are not subject to ignore_learn_ins.
+        Learning packet ins from a host already being learned are suppressed.
+        """
+        packet_class = self.admission.classify(pkt_meta)
+        if packet_class == valve_admission.LEARN_CLASS:
+            if self.admission.learn_pending(now, pkt_meta):
+                return False
+            if self.rate_limit_packet_ins(now):
+                return False
+        return self.admission.admit(now, packet_class, pkt_meta)
+
     def rate_limit_packet_ins(self, now):
-        """Return True if too many packet ins this second."""
+        """Return True if too many learning packet ins this second."""
         if self._last_packet_in_sec != now:
             self._last_packet_in_sec = now
             self._packet_in_count_sec = 0
         self._packet_in_count_sec += 1
         if self.dp.ignore_learn_ins:
             if self._packet_in_count_sec % self.dp.ignore_learn_ins == 0:
-                self._inc_var('of_ignored_packet_ins')
+                self.dp_metrics.of_ignored_packet_ins.inc()
                 return True
         return False
 
+    def learn_host_from_stack(self, now, edge_dp, vid, eth_src):
+        """Learn a host learned on an edge port of another DP in the stack.
+
+        The host is learned on our port towards that DP, as it would be
+        from a packet in from the host arriving on a stack port.
+
+        Args:
+            now (float): seconds since epoch.
+            edge_dp (str): name of DP that learned the host.
+            vid (int): VLAN VID of host.
+            eth_src (str): MAC address of host.
+        Returns:
+            list: OpenFlow messages, if any.
+        """
+        vlan = self.dp.vlans.get(vid, None)
+        if vlan is None:
+            return []
+        learn_port = self.dp.shortest_path_port(edge_dp)
+        if learn_port is None:
+            return []
+        learn_flows, _, update_cache = self.host_manager.learn_host_on_vlan_ports(
+            now, learn_port, vlan, eth_src,
+            last_dp_coldstart_time=self.dp.dyn_last_coldstart_time)
+        if update_cache:
+            vlan.add_cache_host(eth_src, learn_port, now)
+            if learn_flows:
+                self.dp_metrics.of_avoided_packet_ins.inc()
+            self.logger.info(
+                'L2 learned %s on %s VLAN %u from %s (%u hosts total)' % (
+                    eth_src, learn_port, vid, edge_dp, vlan.hosts_count()))
+        return learn_flows
+
     def _learn_host(self, now, other_valves, pkt_meta):
         """Possibly learn a host on a port.
 
+        A host learned on an edge port of a stacked DP, is learned by
+        the other DPs in the stack at the same time, so they do not each
+        need a packet in from the host to learn it.
+
         Args:
             valves (list): of all Valves (datapaths).
             pkt_meta (PacketMeta): PacketMeta instance for packet received.
         Returns:
-            list: OpenFlow messages, if any.
+            dict: OpenFlow messages, if any by Valve.
         """
+        ofmsgs_by_valve = {}
         learn_port = self.flood_manager.edge_learn_port(
             other_valves, pkt_meta)
         if learn_port is not None:
@@ -1114,8 +1245,10 @@ class Valve:
                     if pkt_meta.port.number != previous_port_no:
                         port_move_text = ', moved from port %u' % previous_port_no
                 pkt_meta.vlan.add_cache_host(pkt_meta.eth_src, pkt_meta.port, now)
-                if pkt_meta.l3_pkt is None:
-                    pkt_meta.reparse_ip()
+                if learn_flows:
+                    self.admission.add_pending_learn(now, pkt_meta)
+                if pkt_meta.l3_src is None:
+                    pkt_meta.parse_l3_addrs()
                 self.logger.info(
                     'L2 learned %s %s (%u hosts total)' % (
                         pkt_meta.log(), port_move_text, pkt_meta.vlan.hosts_count()))
@@ -1128,10 +1261,17 @@ class Valve:
                         'eth_type': pkt_meta.eth_type,
                         'l3_src_ip': str(pkt_meta.l3_src),
                         'l3_dst_ip': str(pkt_meta.l3_dst)}})
-            return learn_flows
-        return []
+                if learn_flows and self.dp.stack and not learn_port.stack:
+                    for other_valve in other_valves:
+                        if other_valve.dp.stack:
+                            other_learn_flows = other_valve.learn_host_from_stack(
+                                now, self.dp.name, pkt_meta.vlan.vid, pkt_meta.eth_src)
+                            if other_learn_flows:
+                                ofmsgs_by_valve[other_valve] = other_learn_flows
+            ofmsgs_by_valve[self] = learn_flows
+        return ofmsgs_by_valve
 
-    def parse_rcv_packet(self, in_port, vlan_vid, eth_type, data, orig_len, pkt, eth_pkt, vlan_pkt):
+    def parse_rcv_packet(self, in_port, vlan_vid, eth_type, data, orig_len, eth_src, eth_dst):
         """Parse a received packet into a PacketMeta instance.
 
         Args:
@@ -1140,20 +1280,17 @@ class Valve:
             eth_type (int): Ethernet type of packet.
             data (bytes): Raw packet data.
             orig_len (int): Original length of packet.
-            pkt (ryu.lib.packet.packet): parsed packet received.
-            ekt_pkt (ryu.lib.packet.ethernet): parsed Ethernet header.
-            vlan_pkt (ryu.lib.packet.vlan): parsed VLAN Ethernet header.
+            eth_src (str): source Ethernet MAC address.
+            eth_dst (str): destination Ethernet MAC address.
         Returns:
             PacketMeta instance.
         """
-        eth_src = eth_pkt.src
-        eth_dst = eth_pkt.dst
         vlan = None
         if vlan_vid in self.dp.vlans:
             vlan = self.dp.vlans[vlan_vid]
         port = self.dp.ports[in_port]
         pkt_meta = valve_packet.PacketMeta(
-            data, orig_len, pkt, eth_pkt, vlan_pkt, port, vlan, eth_src, eth_dst, eth_type)
+            data, orig_len, port, vlan, eth_src, eth_dst, eth_type)
         if vlan_vid == self.dp.global_vlan:
             vlan_vid = valve_packet.int_from_mac(pkt_meta.eth_dst)
             vlan = self.dp.vlans.get(vlan_vid, None)
@@ -1183,13 +1320,13 @@ class Valve:
         # Truncate packet in data (OVS > 2.5 does not honor max_len)
         data = msg.data[:valve_of.MAX_PACKET_IN_BYTES]
 
-        # eth/VLAN header only
-        pkt, eth_pkt, eth_type, vlan_pkt, vlan_vid = valve_packet.parse_packet_in_pkt(
-            data, max_len=valve_packet.ETH_VLAN_HEADER_SIZE)
-        if pkt is None or eth_pkt is None:
+        # eth/VLAN header only, Ryu parses the rest on demand.
+        eth_header = valve_packet.parse_eth_header(data)
+        if eth_header is None:
             self.logger.info(
                 'unparseable packet from port %u' % in_port)
             return None
+        eth_src, eth_dst, eth_type, vlan_vid = eth_header
         if (vlan_vid is not None and
                 vlan_vid not in self.dp.vlans and
                 vlan_vid != self.dp.global_vlan):
@@ -1197,7 +1334,7 @@ class Valve:
                 'packet for unknown VLAN %u' % vlan_vid)
             return None
         pkt_meta = self.parse_rcv_packet(
-            in_port, vlan_vid, eth_type, data, msg.total_len, pkt, eth_pkt, vlan_pkt)
+            in_port, vlan_vid, eth_type, data, msg.total_len, eth_src, eth_dst)
         if not valve_packet.mac_addr_is_unicast(pkt_meta.eth_src):
             self.logger.info(
                 'packet with non-unicast eth_src %s port %u' % (
@@ -1239,61 +1376,34 @@ class Valve:
                 labels=dict(self.dp.base_prom_labels(), table_name=table.name,
                             next_tables=",".join(next_tables)))
 
-    def update_metrics(self, now, updated_port=None, rate_limited=False):
-        """Update Gauge/metrics."""
+    def update_metrics(self, now):
+        """Update Gauge/metrics.
 
-        def _update_vlan(vlan, now, rate_limited):
-            if vlan.dyn_last_updated_metrics_sec and rate_limited:
-                if now - vlan.dyn_last_updated_metrics_sec < self.dp.metrics_rate_limit_sec:
-                    return False
-            vlan_labels = dict(self.dp.base_prom_labels(), vlan=vlan.vid)
-            self._set_var('vlan_hosts_learned', vlan.hosts_count(), labels=vlan_labels)
-            self._set_var('vlan_learn_bans', vlan.dyn_learn_ban_count, labels=vlan_labels)
+        Learned host metrics are generated from host caches when scraped.
+        """
+        for vlan in self.dp.vlans.values():
+            self.dp_metrics.vlans[vlan.vid].vlan_learn_bans.set(vlan.dyn_learn_ban_count)
             for ipv in vlan.ipvs():
+                labels = dict(self.dp.base_prom_labels(), vlan=vlan.vid, ipv=ipv)
                 self._set_var(
                     'vlan_neighbors',
                     vlan.neigh_cache_count_by_ipv(ipv),
-                    labels=dict(vlan_labels, ipv=ipv))
-            return True
-
-        def _update_port(vlan, port):
-            port_labels = self.dp.port_labels(port.number)
-            port_vlan_labels = self._port_vlan_labels(port, vlan)
-            port_vlan_hosts_learned = port.hosts_count(vlans=[vlan])
-            self._set_var(
-                'port_learn_bans', port.dyn_learn_ban_count, labels=port_labels)
-            self._set_var(
-                'port_vlan_hosts_learned', port_vlan_hosts_learned, labels=port_vlan_labels)
-            highwater = self._port_highwater[vlan.vid][port.number]
-            stats_stale = vlan.dyn_host_cache_stats_stale.get(port.number, True)
-            # No change in hosts learned on this VLAN, don't re-export MACs.
-            if highwater == port_vlan_hosts_learned and not stats_stale:
-                return
-            if highwater > port_vlan_hosts_learned:
-                for i in range(port_vlan_hosts_learned, highwater + 1):
-                    self._set_var('learned_macs', 0, dict(port_vlan_labels, n=i))
-            self._port_highwater[vlan.vid][port.number] = port_vlan_hosts_learned
-            port_vlan_hosts = port.hosts(vlans=[vlan])
-            assert port_vlan_hosts_learned == len(port_vlan_hosts)
-            # TODO: make MAC table updates less expensive.
-            for i, entry in enumerate(sorted(port_vlan_hosts)):
-                self._set_var('learned_macs', entry.eth_src_int, dict(port_vlan_labels, n=i))
-            vlan.dyn_host_cache_stats_stale[port.number] = False
-
-        if updated_port:
-            for vlan in updated_port.vlans():
-                if _update_vlan(vlan, now, rate_limited):
-                    _update_port(vlan, updated_port)
-                    vlan.dyn_last_updated_metrics_sec = now
-        else:
-            for vlan in self.dp.vlans.values():
-                if _update_vlan(vlan, now, rate_limited):
-                    for port in vlan.get_ports():
-                        _update_port(vlan, port)
-                    vlan.dyn_last_updated_metrics_sec = now
+                    labels=labels)
+                route_manager = self._route_manager_by_ipv.get(ipv, None)
+                if route_manager is not None:
+                    self._set_var(
+                        'vlan_nexthop_resolve_backlog',
+                        route_manager.resolve_backlog(vlan, now),
+                        labels=labels)
+                if route_manager is not None and route_manager.fib_compression:
+                    logical_routes, installed_routes = route_manager.fib_route_counts(vlan)
+                    self._set_var('vlan_fib_routes_logical', logical_routes, labels=labels)
+                    self._set_var('vlan_fib_routes_installed', installed_routes, labels=labels)
+        for port in self.dp.ports.values():
+            self.dp_metrics.ports[port.number].port_learn_bans.set(port.dyn_learn_ban_count)
 
     def _non_vlan_rcv_packet(self, now, other_valves, pkt_meta):
-        self._inc_var('of_non_vlan_packet_ins')
+        self.dp_metrics.of_non_vlan_packet_ins.inc()
         if pkt_meta.port.lacp:
             lacp_ofmsgs_by_valve = self.lacp_handler(now, pkt_meta)
             if lacp_ofmsgs_by_valve:
@@ -1319,25 +1429,27 @@ class Valve:
         else:
             ofmsgs.extend(
                 route_manager.add_host_fib_route_from_pkt(now, pkt_meta))
-            # No CPN activity, run resolver.
+            # No CPN activity, run resolver (new nexthops are left for the resolve service).
             ofmsgs.extend(
                 route_manager.resolve_gateways(
-                    pkt_meta.vlan, now, resolve_all=False))
+                    [pkt_meta.vlan], now, max_resolves=1, new_nexthops=False))
             ofmsgs.extend(
                 route_manager.resolve_expire_hosts(
-                    pkt_meta.vlan, now, resolve_all=False))
+                    [pkt_meta.vlan], now, max_resolves=1, new_nexthops=False))
         return ofmsgs
 
     def _vlan_rcv_packet(self, now, other_valves, pkt_meta):
-        self._inc_var('of_vlan_packet_ins')
+        self.dp_metrics.of_vlan_packet_ins.inc()
         ban_rules = self.host_manager.ban_rules(pkt_meta)
         if ban_rules:
             return {self: ban_rules}
 
         ofmsgs = []
         ofmsgs.extend(self._router_rcv_packet(now, other_valves, pkt_meta))
-        ofmsgs.extend(self._learn_host(now, other_valves, pkt_meta))
-        return {self: ofmsgs}
+        ofmsgs_by_valve = self._learn_host(now, other_valves, pkt_meta)
+        ofmsgs.extend(ofmsgs_by_valve.get(self, []))
+        ofmsgs_by_valve[self] = ofmsgs
+        return ofmsgs_by_valve
 
     def rcv_packet(self, now, other_valves, pkt_meta):
         """Handle a packet from the dataplane (eg to re/learn a host).
@@ -1394,6 +1506,8 @@ class Valve:
         """
         ofmsgs_by_valve = defaultdict(list)
         if self.dp.dyn_running:
+            self.shadow.expire(now)
+            self.admission.expire_pending_learns(now)
             ofmsgs_by_valve.update(self._lacp_state_expire(now, other_valves))
             for vlan in self.dp.vlans.values():
                 expired_hosts = self.host_manager.expire_hosts_from_vlan(vlan, now)
@@ -1407,8 +1521,9 @@ class Valve:
                             'port_no': entry.port.number,
                             'vid': vlan.vid,
                             'eth_src': entry.eth_src}})
-                for route_manager in self._route_manager_by_ipv.values():
-                    ofmsgs_by_valve[self].extend(route_manager.resolve_expire_hosts(vlan, now))
+            vlans = list(self.dp.vlans.values())
+            for route_manager in self._route_manager_by_ipv.values():
+                ofmsgs_by_valve[self].extend(route_manager.resolve_expire_hosts(vlans, now))
         return ofmsgs_by_valve
 
     def _pipeline_change(self):
@@ -1507,6 +1622,9 @@ class Valve:
         """
         cold_start, ofmsgs = self._apply_config_changes(
             new_dp, self.dp.get_config_changes(self.logger, new_dp))
+        if self._flow_audit is not None and ofmsgs:
+            # Audit in progress would send flows from the old config.
+            cold_start = True
         restart_type = None
         if cold_start:
             restart_type = 'cold'
@@ -1515,6 +1633,10 @@ class Valve:
                 ofmsgs = None
         elif self.dp.dyn_running and ofmsgs:
             restart_type = 'warm'
+            delta_ofmsgs = self.shadow.delta(ofmsgs)
+            self.logger.info('warm start reduced %u to %u OpenFlow messages' % (
+                len(ofmsgs), len(delta_ofmsgs)))
+            ofmsgs = delta_ofmsgs
         else:
             ofmsgs = []
         if restart_type is not None:
@@ -1579,6 +1701,11 @@ class Valve:
         route_manager = self._route_manager_by_ipv[ip_dst.version]
         return route_manager.del_route(vlan, ip_dst)
 
+    def routing_active(self):
+        """Return True if this Valve routes for any VLAN (so has gateways to resolve)."""
+        return any(
+            route_manager.active for route_manager in self._route_manager_by_ipv.values())
+
     def resolve_gateways(self, now, _other_valves):
         """Call route managers to re/resolve gateways.
 
@@ -1587,9 +1714,9 @@ class Valve:
         """
         ofmsgs = []
         if self.dp.dyn_running:
+            vlans = list(self.dp.vlans.values())
             for route_manager in self._route_manager_by_ipv.values():
-                for vlan in self.dp.vlans.values():
-                    ofmsgs.extend(route_manager.resolve_gateways(vlan, now))
+                ofmsgs.extend(route_manager.resolve_gateways(vlans, now))
         if ofmsgs:
             return {self: ofmsgs}
         return {}
@@ -1599,6 +1726,8 @@ class Valve:
 
         Args:
             msg (ryu.controller.ofp_event.EventOFPMsgBase): message from datapath.
+        Returns:
+            list: OpenFlow messages, if any (None to reconnect).
         """
         self._inc_var('of_errors')
         orig_msgs = [orig_msg for orig_msg in self.recent_ofmsgs if orig_msg.xid == msg.xid]
@@ -1614,6 +1743,16 @@ class Valve:
         except KeyError:
             pass
         self.logger.error('OFError type: %s code: %s %s' % (error_type, error_code, error_txt))
+        if self.dp.bundles and not self._bundle_fallback:
+            if valve_of.is_bundle_error(msg) or any(
+                    valve_of.is_bundle(orig_msg) for orig_msg in orig_msgs):
+                # Bundle was discarded so datapath state is unknown.
+                self.logger.warning('bundle failed, disabling bundles and reconnecting')
+                self._bundle_fallback = True
+                return None
+        if self._flow_audit is not None and self._flow_audit.is_request_xid(msg.xid):
+            return self._flow_audit_fallback('request failed')
+        return []
 
     def prepare_send_flows(self, flow_msgs):
         """Prepare to send flows to datapath.
@@ -1625,14 +1764,21 @@ class Valve:
             return flow_msgs
         reordered_flow_msgs = valve_of.valve_flowreorder(
             flow_msgs, use_barriers=self.USE_BARRIERS)
+        self.shadow.apply_ofmsgs(reordered_flow_msgs)
+        if self.dp.bundles and not self._bundle_fallback:
+            self._bundle_id = (self._bundle_id + 1) % 2**32
+            reordered_flow_msgs = valve_of.bundle_ofmsgs(self._bundle_id, reordered_flow_msgs)
         self.ofchannel_log(reordered_flow_msgs)
-        self._inc_var('of_flowmsgs_sent', val=len(reordered_flow_msgs))
-        self.recent_ofmsgs.extend(reordered_flow_msgs)
+        self.dp_metrics.of_flowmsgs_sent.inc(len(reordered_flow_msgs))
         return reordered_flow_msgs
 
     def send_flows(self, ryu_dp, flow_msgs):
         """Send flows to datapath (or disconnect an OF session).
 
+        Flows are queued and, unless coalescing is configured, sent immediately.
+        If too many flows are queued (e.g. on cold start), they are sent
+        immediately, in batches, as the datapath accepts them.
+
         Args:
             ryu_dp (ryu.controller.controller.Datapath): datapath.
             flow_msgs (list): OpenFlow messages to send.
@@ -1640,10 +1786,67 @@ class Valve:
         if flow_msgs is None:
             self.datapath_disconnect()
             ryu_dp.close()
-        else:
-            for flow_msg in self.prepare_send_flows(flow_msgs):
-                flow_msg.datapath = ryu_dp
-                ryu_dp.send_msg(flow_msg)
+            return
+        now = time.time()
+        coalesced = self.outq.put(now, self.prepare_send_flows(flow_msgs))
+        if coalesced:
+            self.dp_metrics.of_outq_coalesced.inc(coalesced)
+        if self.dp.ofmsg_coalesce_ms:
+            if not self.outq.full():
+                self.dp_metrics.of_outq_depth.set(self.outq.depth)
+                return
+            # Send now rather than queue without bound.
+            self.logger.warning('%u OpenFlow messages queued, sending' % self.outq.depth)
+            self._inc_var('of_outq_overflows')
+        self.flush_flows(ryu_dp, now)
+
+    def flush_due(self, now):
+        """Return True if queued flows have waited for the coalescing window.
+
+        Args:
+            now (float): current epoch time.
+        Returns:
+            bool: True if flush_flows() should be called.
+        """
+        oldest = self.outq.oldest()
+        return oldest is not None and now - oldest >= self.dp.ofmsg_coalesce_ms / 1e3
+
+    def _send_batch(self, ryu_dp, flow_msgs):
+        """Serialize flows to datapath as one write."""
+        buf = bytearray()
+        for flow_msg in flow_msgs:
+            flow_msg = valve_of.to_ryu_ofmsg(flow_msg, ryu_dp)
+            if flow_msg.xid is None:
+                ryu_dp.set_xid(flow_msg)
+            flow_msg.serialize()
+            buf.extend(flow_msg.buf)
+            self.recent_ofmsgs.append(flow_msg)
+        # Blocks while Ryu's (bounded) send queue for a slow datapath is full.
+        ryu_dp.send(bytes(buf))
+
+    def flush_flows(self, ryu_dp, now, max_ofmsgs=None):
+        """Send queued flows to datapath, in batches.
+
+        Args:
+            ryu_dp (ryu.controller.controller.Datapath): datapath.
+            now (float): current epoch time.
+            max_ofmsgs (int): maximum number of flows to send (None for all).
+        """
+        sent = 0
+        while max_ofmsgs is None or sent < max_ofmsgs:
+            batch_size = self.OUTQ_BATCH_SIZE
+            if max_ofmsgs is not None:
+                batch_size = min(batch_size, max_ofmsgs - sent)
+            queued_time, flow_msgs = self.outq.get(batch_size)
+            if not flow_msgs:
+                break
+            if sent:
+                # Let other green threads (e.g. Ryu's send loop) run between batches.
+                time.sleep(0)
+            self.dp_metrics.of_outq_latency_secs.observe(now - queued_time)
+            self._send_batch(ryu_dp, flow_msgs)
+            sent += len(flow_msgs)
+        self.dp_metrics.of_outq_depth.set(self.outq.depth)
 
     def flow_timeout(self, now, table_id, match):
         """Call flow timeout message handler:
@@ -1655,6 +1858,7 @@ class Valve:
         Returns:
             list: OpenFlow messages, if any.
         """
+        self.shadow.flow_removed(table_id, match)
         return self.host_manager.flow_timeout(now, table_id, match)
 
     def get_config_dict(self):
@@ -0,0 +1,198 @@
+"""Packet-in admission control for a datapath."""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2019 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from faucet import valve_of
+
+
+LACP_CLASS = 'lacp'
+LLDP_CLASS = 'lldp'
+L3_CLASS = 'l3'
+LEARN_CLASS = 'learn'
+CONTROL_CLASSES = (LACP_CLASS, LLDP_CLASS, L3_CLASS)
+PACKET_CLASSES = CONTROL_CLASSES + (LEARN_CLASS,)
+
+_CONTROL_CLASS_BY_ETH_TYPE = {
+    valve_of.ether.ETH_TYPE_SLOW: LACP_CLASS,
+    valve_of.ether.ETH_TYPE_LLDP: LLDP_CLASS,
+}
+# IPv6 all routers (RS) destination.
+_RS_ETH_DST = '33:33:00:00:00:02'
+# Time learning flows for a host are expected to take to reach the DP.
+LEARN_PENDING_SEC = 1.0
+
+
+class TokenBucket:
+    """Token bucket, refilled at a rate per second up to a burst size."""
+
+    __slots__ = [
+        'burst',
+        'last_time',
+        'rate',
+        'tokens',
+    ]
+
+    def __init__(self, rate, burst=None):
+        if burst is None:
+            burst = max(1, rate)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_time = None
+
+    def admit(self, now):
+        """Take a token if available and return True, else return False."""
+        tokens = self.tokens
+        if self.last_time is not None:
+            tokens = min(self.burst, tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+class ValvePacketAdmission:
+    """Admit or drop packet ins by class, with a separate budget for each.
+
+    Packet ins are classed on their Ethernet header. LACP, LLDP (including
+    stack probes), and ARP/ND for a FAUCET VIP or MAC are control plane classes,
+    admitted from one bucket per class per DP. All other packet ins are
+    for learning, and may be limited per DP, port and VLAN. So a flood of
+    learning packet ins cannot starve the control plane.
+
+    Once a host has been learned, further learning packet ins from it on
+    the same port are suppressed until its learning flows have had time to
+    reach the DP, so they are not parsed and processed again.
+    """
+
+    def __init__(self, dp, drop_counters, suppressed_counter):
+        """Initialize admission control for a DP.
+
+        Args:
+            dp (DP): datapath configuration.
+            drop_counters (dict): Prometheus counter children by packet class.
+            suppressed_counter (Counter): Prometheus counter child for suppressed learning packet ins.
+        """
+        self.drop_counters = drop_counters
+        self.suppressed_counter = suppressed_counter
+        self.pending_learns = {}
+        conf = dp.packet_in_admission
+        self.control_buckets = {}
+        if conf['control_rate']:
+            self.control_buckets = {
+                packet_class: TokenBucket(conf['control_rate'])
+                for packet_class in CONTROL_CLASSES}
+        self.learn_bucket = None
+        if conf['learn_rate']:
+            self.learn_bucket = TokenBucket(conf['learn_rate'])
+        self.port_learn_buckets = {}
+        if conf['port_learn_rate']:
+            self.port_learn_buckets = {
+                port_no: TokenBucket(conf['port_learn_rate']) for port_no in dp.ports}
+        self.vlan_learn_buckets = {}
+        if conf['vlan_learn_rate']:
+            self.vlan_learn_buckets = {
+                vid: TokenBucket(conf['vlan_learn_rate']) for vid in dp.vlans}
+        self.l3_eth_dsts = {
+            vlan.vid: frozenset(
+                [vlan.faucet_mac.lower(), _RS_ETH_DST] + [
+                    self._nd_eth_dst(faucet_vip.ip)
+                    for faucet_vip in vlan.faucet_vips_by_ipv(6)])
+            for vlan in dp.vlans.values() if vlan.faucet_vips}
+        self.l3_vips = {
+            vlan.vid: frozenset([faucet_vip.ip for faucet_vip in vlan.faucet_vips])
+            for vlan in dp.vlans.values() if vlan.faucet_vips}
+
+    @staticmethod
+    def _nd_eth_dst(ip_addr):
+        """Return solicited node multicast Ethernet destination, for ND for an IPv6 address."""
+        return '33:33:ff:%s' % ':'.join(['%02x' % i for i in ip_addr.packed[-3:]])
+
+    def classify(self, pkt_meta):
+        """Return packet class of a packet in."""
+        eth_type = pkt_meta.eth_type
+        packet_class = _CONTROL_CLASS_BY_ETH_TYPE.get(eth_type, None)
+        if packet_class is not None:
+            return packet_class
+        vlan = pkt_meta.vlan
+        if vlan is not None and vlan.vid in self.l3_eth_dsts:
+            if pkt_meta.eth_dst in self.l3_eth_dsts[vlan.vid]:
+                return L3_CLASS
+            # Broadcast ARP is control plane only if for a VIP (not between hosts).
+            if eth_type == valve_of.ether.ETH_TYPE_ARP:
+                pkt_meta.parse_l3_addrs()
+                if pkt_meta.l3_dst in self.l3_vips[vlan.vid]:
+                    return L3_CLASS
+        return LEARN_CLASS
+
+    def add_pending_learn(self, now, pkt_meta):
+        """Record that learning flows are in progress for a packet in's host."""
+        vlan = pkt_meta.vlan
+        # Routed VLANs also learn host FIB entries from packet ins.
+        if vlan.vid in self.l3_eth_dsts:
+            return
+        self.pending_learns[(vlan.vid, pkt_meta.eth_src, pkt_meta.port.number)] = (
+            now + LEARN_PENDING_SEC)
+
+    def learn_pending(self, now, pkt_meta):
+        """Return True if learning is in progress for a packet in's host, and count it."""
+        if not self.pending_learns:
+            return False
+        vlan = pkt_meta.vlan
+        if vlan is None:
+            return False
+        key = (vlan.vid, pkt_meta.eth_src, pkt_meta.port.number)
+        expiry = self.pending_learns.get(key, None)
+        if expiry is None:
+            return False
+        if now >= expiry:
+            del self.pending_learns[key]
+            return False
+        self.suppressed_counter.inc()
+        return True
+
+    def expire_pending_learns(self, now):
+        """Forget learns in progress that should have completed by now."""
+        if self.pending_learns:
+            self.pending_learns = {
+                key: expiry for key, expiry in self.pending_learns.items() if expiry > now}
+
+    def _admit_learn(self, now, pkt_meta):
+        port_bucket = self.port_learn_buckets.get(pkt_meta.port.number, None)
+        if port_bucket is not None and not port_bucket.admit(now):
+            return False
+        vlan = pkt_meta.vlan
+        if vlan is not None:
+            vlan_bucket = self.vlan_learn_buckets.get(vlan.vid, None)
+            if vlan_bucket is not None and not vlan_bucket.admit(now):
+                return False
+        if self.learn_bucket is not None and not self.learn_bucket.admit(now):
+            return False
+        return True
+
+    def admit(self, now, packet_class, pkt_meta):
+        """Return True if a packet in of a class is admitted, else count it dropped."""
+        if packet_class == LEARN_CLASS:
+            admitted = self._admit_learn(now, pkt_meta)
+        else:
+            bucket = self.control_buckets.get(packet_class, None)
+            admitted = bucket is None or bucket.admit(now)
+        if not admitted:
+            self.drop_counters[packet_class].inc()
+        return admitted
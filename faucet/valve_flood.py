@@ -306,7 +306,8 @@ class ValveFloodStackManager(ValveFloodManager):
                  use_group_table, groups,
                  combinatorial_port_flood,
                  stack, stack_ports,
-                 dp_shortest_path_to_root, shortest_path_port):
+                 dp_shortest_path_to_root, shortest_path_port, stack_topo_changed,
+                 edge_host_index, dp_id):
         super(ValveFloodStackManager, self).__init__(
             logger, flood_table, pipeline,
             use_group_table, groups,
@@ -315,6 +316,9 @@ class ValveFloodStackManager(ValveFloodManager):
         self.stack_ports = stack_ports
         self.shortest_path_port = shortest_path_port
         self.dp_shortest_path_to_root = dp_shortest_path_to_root
+        self.stack_topo_changed = stack_topo_changed
+        self.edge_host_index = edge_host_index
+        self.dp_id = dp_id
         self._reset_peer_distances()
         self._flood_actions_func = self._flood_actions
         if self.stack_size == 2:
@@ -566,22 +570,18 @@ class ValveFloodStackManager(ValveFloodManager):
         """Return True if this datapath is the root of the stack."""
         return 'priority' in self.stack
 
-    def _edge_dp_for_host(self, other_valves, pkt_meta):
+    def _edge_dp_for_host(self, pkt_meta):
         """Simple distributed unicast learning.
 
         Args:
-            other_valves (list): All Valves other than this one.
             pkt_meta (PacketMeta): PacketMeta instance for packet received.
         Returns:
-            Valve instance or None (of edge datapath where packet received)
+            name of edge datapath where packet received, or None.
         """
         # TODO: simplest possible unicast learning.
         # We find just one port that is the shortest unicast path to
         # the destination. We could use other factors (eg we could
         # load balance over multiple ports based on destination MAC).
-        # TODO: each DP learns independently. An edge DP could
-        # call other valves so they learn immediately without waiting
-        # for packet in.
         # TODO: edge DPs could use a different forwarding algorithm
         # (for example, just default switch to a neighbor).
         # Find port that forwards closer to destination DP that
@@ -592,17 +592,10 @@ class ValveFloodStackManager(ValveFloodManager):
         if pkt_meta.port.stack:
             peer_dp = pkt_meta.port.stack['dp']
             if peer_dp.is_stack_edge() or peer_dp.is_stack_root():
-                return peer_dp
-        stacked_valves = [valve for valve in other_valves if valve.dp.stack is not None]
-        eth_src = pkt_meta.eth_src
-        vlan_vid = pkt_meta.vlan.vid
-        for other_valve in stacked_valves:
-            if vlan_vid in other_valve.dp.vlans:
-                other_dp_vlan = other_valve.dp.vlans[vlan_vid]
-                entry = other_dp_vlan.cached_host(eth_src)
-                if entry and not entry.port.stack:
-                    return other_valve.dp
-        return None
+                return peer_dp.name
+        # Another DP that has learned this host on an edge port.
+        return self.edge_host_index.edge_dp(
+            pkt_meta.vlan.vid, pkt_meta.eth_src, exclude_dp_id=self.dp_id)
 
     def update_stack_topo(self, event, dp, port=None):
         """Update the stack topo according to the event."""
@@ -634,6 +627,8 @@ class ValveFloodStackManager(ValveFloodManager):
                 _stack_topo_up_dp(dp)
             else:
                 _stack_topo_down_dp(dp)
+        # Paths between DPs are recomputed on next use.
+        self.stack_topo_changed()
         return True
 
     def edge_learn_port(self, other_valves, pkt_meta):
@@ -646,10 +641,10 @@ class ValveFloodStackManager(ValveFloodManager):
             port to learn host on, or None.
         """
         if pkt_meta.port.stack:
-            edge_dp = self._edge_dp_for_host(other_valves, pkt_meta)
+            edge_dp = self._edge_dp_for_host(pkt_meta)
             # No edge DP may have learned this host yet.
             if edge_dp is None:
                 return None
-            return self.shortest_path_port(edge_dp.name)
+            return self.shortest_path_port(edge_dp)
         return super(ValveFloodStackManager, self).edge_learn_port(
             other_valves, pkt_meta)
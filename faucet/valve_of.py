@@ -210,7 +210,7 @@ def is_flowmod(ofmsg):
     Returns:
         bool: True if is a FlowMod
     """
-    return isinstance(ofmsg, parser.OFPFlowMod)
+    return isinstance(ofmsg, (ValveFlowMod, parser.OFPFlowMod))
 
 
 def is_groupmod(ofmsg):
@@ -245,6 +245,50 @@ def is_packetout(ofmsg):
     """
     return isinstance(ofmsg, parser.OFPPacketOut)
 
+def is_barrier(ofmsg):
+    """Return True if OF message is a BarrierRequest.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bool: True if is a BarrierRequest.
+    """
+    return isinstance(ofmsg, parser.OFPBarrierRequest)
+
+def is_bundle(ofmsg):
+    """Return True if OF message is a bundle control or add message.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bool: True if is a bundle message.
+    """
+    return isinstance(ofmsg, (parser.ONFBundleCtrlMsg, parser.ONFBundleAddMsg))
+
+def is_bundleable(ofmsg):
+    """Return True if OF message may be added to a bundle.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bool: True if is a FlowMod, GroupMod or MeterMod.
+    """
+    return is_flowmod(ofmsg) or is_groupmod(ofmsg) or is_metermod(ofmsg)
+
+def is_bundle_error(msg):
+    """Return True if an OFPErrorMsg was caused by a bundle message.
+
+    Args:
+        msg: ryu.ofproto.ofproto_v1_3_parser.OFPErrorMsg message.
+    Returns:
+        bool: True if the offending message was an experimenter (bundle) message.
+    """
+    data = getattr(msg, 'data', None)
+    # FAUCET sends no other experimenter messages.
+    return (
+        msg.type == ofp.OFPET_EXPERIMENTER or
+        bool(data) and len(data) > 1 and data[1] == ofp.OFPT_EXPERIMENTER)
+
 def is_output(ofmsg):
     """Return True if flow message is an action output message.
 
@@ -538,20 +582,236 @@ def barrier():
     return parser.OFPBarrierRequest(None)
 
 
+BUNDLE_FLAGS = ofp.ONF_BF_ATOMIC | ofp.ONF_BF_ORDERED
+
+
+def bundlectrl(bundle_id, type_, datapath=None):
+    """Return OpenFlow (ONF extension) bundle control message.
+
+    Args:
+        bundle_id (int): bundle ID.
+        type_ (int): control type (e.g. ONF_BCT_OPEN_REQUEST).
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.ONFBundleCtrlMsg: bundle control message.
+    """
+    return parser.ONFBundleCtrlMsg(
+        datapath, bundle_id=bundle_id, type_=type_, flags=BUNDLE_FLAGS, properties=[])
+
+
+def bundleadd(bundle_id, ofmsg, datapath=None):
+    """Return OpenFlow (ONF extension) bundle add message.
+
+    Args:
+        bundle_id (int): bundle ID.
+        ofmsg: message to add to bundle.
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.ONFBundleAddMsg: bundle add message.
+    """
+    return parser.ONFBundleAddMsg(datapath, bundle_id, BUNDLE_FLAGS, ofmsg, [])
+
+
+def bundle_ofmsgs(bundle_id, ofmsgs):
+    """Return ofmsgs with flow, group and meter mods in one atomic bundle.
+
+    Table features requests must be applied before any flows, so they (and
+    anything before them) are sent ahead of the bundle. Other messages that
+    cannot be bundled follow the bundle commit, in order. Barriers within
+    the bundle are removed, as the bundle is applied as one change.
+
+    Args:
+        bundle_id (int): bundle ID.
+        ofmsgs (list): ofmsgs as ordered by valve_flowreorder().
+    Returns:
+        list: bundled ofmsgs (unchanged if fewer than 2 could be bundled).
+    """
+    first_bundled = 0
+    for i, ofmsg in enumerate(ofmsgs):
+        if is_table_features_req(ofmsg):
+            first_bundled = i + 1
+    if first_bundled and first_bundled < len(ofmsgs) and is_barrier(ofmsgs[first_bundled]):
+        first_bundled += 1
+    bundled_ofmsgs = []
+    other_ofmsgs = []
+    for ofmsg in ofmsgs[first_bundled:]:
+        if is_bundleable(ofmsg):
+            bundled_ofmsgs.append(bundleadd(bundle_id, ofmsg))
+        elif not is_barrier(ofmsg):
+            other_ofmsgs.append(ofmsg)
+    if len(bundled_ofmsgs) < 2:
+        return ofmsgs
+    return (
+        ofmsgs[:first_bundled] +
+        [bundlectrl(bundle_id, ofp.ONF_BCT_OPEN_REQUEST)] +
+        bundled_ofmsgs +
+        [bundlectrl(bundle_id, ofp.ONF_BCT_COMMIT_REQUEST)] +
+        other_ofmsgs)
+
+
 def table_features(body):
     return parser.OFPTableFeaturesStatsRequest(
         datapath=None, body=body)
 
 
+def ofobj_key(value):
+    """Return hashable key for a Ryu object (e.g. an instruction), ignoring encoded lengths."""
+    if isinstance(value, (list, tuple)):
+        return tuple([ofobj_key(val) for val in value])
+    if hasattr(value, '__dict__'):
+        return (value.__class__.__name__,) + tuple([
+            (attr, ofobj_key(val)) for attr, val in sorted(value.__dict__.items())
+            if attr != 'len'])
+    return value
+
+
+class ValveMatch:
+    """Immutable, hashable OpenFlow match, converted to an OFPMatch when sent."""
+
+    __slots__ = ['_fields', '_key']
+
+    def __init__(self, match_fields):
+        self._fields = {
+            field: tuple(value) if isinstance(value, list) else value
+            for field, value in match_fields.items()}
+        self._key = None
+
+    def key(self):
+        """Return key that identifies this match."""
+        if self._key is None:
+            self._key = tuple(sorted(self._fields.items()))
+        return self._key
+
+    def items(self):
+        """Return list of (field, value) pairs."""
+        return list(self._fields.items())
+
+    def get(self, field, default=None):
+        """Return value of field, or default if not matched."""
+        return self._fields.get(field, default)
+
+    def to_ryu(self):
+        """Return Ryu OFPMatch."""
+        return parser.OFPMatch(**self._fields)
+
+    def __getitem__(self, field):
+        return self._fields[field]
+
+    def __contains__(self, field):
+        return field in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        return isinstance(other, ValveMatch) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __str__(self):
+        return 'ValveMatch(%s)' % ','.join(
+            ['%s=%s' % (field, value) for field, value in self._fields.items()])
+
+    __repr__ = __str__
+
+
+class ValveFlowMod:
+    """Immutable, hashable flow modification, converted to an OFPFlowMod when sent.
+
+    Building and comparing Ryu OFPFlowMods (which can only be compared
+    via str()) is expensive, so these are used inside Valve instead.
+    """
+
+    __slots__ = [
+        'cookie',
+        'command',
+        'table_id',
+        'priority',
+        'out_port',
+        'out_group',
+        'match',
+        'instructions',
+        'hard_timeout',
+        'idle_timeout',
+        'flags',
+        '_key',
+    ]
+
+    def __init__(self, cookie, command, table_id, priority, out_port, out_group, # pylint: disable=too-many-arguments
+                 match_fields, inst, hard_timeout, idle_timeout, flags):
+        self.cookie = cookie
+        self.command = command
+        self.table_id = table_id
+        self.priority = priority
+        self.out_port = out_port
+        self.out_group = out_group
+        self.match = match_fields
+        self.instructions = inst
+        self.hard_timeout = hard_timeout
+        self.idle_timeout = idle_timeout
+        self.flags = flags
+        self._key = None
+
+    def key(self):
+        """Return key that identifies this flowmod."""
+        if self._key is None:
+            self._key = (
+                self.command, self.table_id, self.priority, self.match.key(),
+                self.cookie, self.out_port, self.out_group,
+                self.hard_timeout, self.idle_timeout, self.flags,
+                ofobj_key(self.instructions))
+        return self._key
+
+    def to_ryu(self, datapath=None):
+        """Return Ryu OFPFlowMod."""
+        return parser.OFPFlowMod(
+            datapath=datapath,
+            cookie=self.cookie,
+            command=self.command,
+            table_id=self.table_id,
+            priority=self.priority,
+            out_port=self.out_port,
+            out_group=self.out_group,
+            match=self.match.to_ryu(),
+            instructions=list(self.instructions),
+            hard_timeout=self.hard_timeout,
+            idle_timeout=self.idle_timeout,
+            flags=self.flags)
+
+    def __eq__(self, other):
+        return isinstance(other, ValveFlowMod) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __str__(self):
+        return 'ValveFlowMod(%s)' % ','.join([
+            '%s=%s' % (attr, getattr(self, attr)) for attr in self.__slots__[:-1]])
+
+    __repr__ = __str__
+
+
+def to_ryu_ofmsg(ofmsg, datapath=None):
+    """Return Ryu message to send for an OpenFlow message."""
+    if isinstance(ofmsg, ValveFlowMod):
+        return ofmsg.to_ryu(datapath)
+    if isinstance(ofmsg, parser.ONFBundleAddMsg):
+        ofmsg.message = to_ryu_ofmsg(ofmsg.message, datapath)
+    ofmsg.datapath = datapath
+    return ofmsg
+
+
 def match(match_fields):
     """Return OpenFlow matches from dict.
 
     Args:
         match_fields (dict): match fields and values.
     Returns:
-        ryu.ofproto.ofproto_v1_3_parser.OFPMatch: matches.
+        ValveMatch: matches.
     """
-    return parser.OFPMatch(**match_fields)
+    return ValveMatch(match_fields)
 
 
 def valve_match_vid(value):
@@ -618,7 +878,7 @@ def match_from_dict(match_dict):
             raise InvalidConfigError('%s cannot be type %s' % (of_match, type(field)))
         kwargs[of_match] = encoded_field
 
-    return parser.OFPMatch(**kwargs)
+    return match(kwargs)
 
 
 def _match_ip_masked(ipa):
@@ -682,19 +942,13 @@ def build_match_dict(in_port=None, vlan=None, eth_type=None, eth_src=None,
 
 def flowmod(cookie, command, table_id, priority, out_port, out_group,
             match_fields, inst, hard_timeout, idle_timeout, flags=0):
-    return parser.OFPFlowMod(
-        datapath=None,
-        cookie=cookie,
-        command=command,
-        table_id=table_id,
-        priority=priority,
-        out_port=out_port,
-        out_group=out_group,
-        match=match_fields,
-        instructions=inst,
-        hard_timeout=hard_timeout,
-        idle_timeout=idle_timeout,
-        flags=flags)
+    if match_fields is None:
+        match_fields = match({})
+    elif not isinstance(match_fields, ValveMatch):
+        match_fields = match(dict(match_fields.items()))
+    return ValveFlowMod(
+        cookie, command, table_id, priority, out_port, out_group,
+        match_fields, tuple(inst), hard_timeout, idle_timeout, flags)
 
 
 def group_act(group_id):
@@ -772,6 +1026,16 @@ def meterdel(datapath=None, meter_id=ofp.OFPM_ALL):
         meter_id)
 
 
+def metermod(datapath=None, meter_id=0, flags=0, bands=None):
+    """Modify a meter."""
+    return parser.OFPMeterMod(
+        datapath,
+        ofp.OFPMC_MODIFY,
+        flags,
+        meter_id,
+        bands)
+
+
 def meteradd(meter_conf):
     """Add a meter based on YAML configuration."""
 
@@ -837,14 +1101,25 @@ _MSG_KINDS_TYPES = {
 
 # We need to examine the OF message more closely to classify it.
 _MSG_KINDS = {
+    ValveFlowMod: (('deleteglobal', is_global_flowdel), ('delete', is_flowdel)),
     parser.OFPFlowMod: (('deleteglobal', is_global_flowdel), ('delete', is_flowdel)),
     parser.OFPGroupMod: (('deleteglobal', is_global_groupdel), ('delete', is_groupdel), ('groupadd', is_groupadd)),
     parser.OFPMeterMod: (('delete', is_meterdel), ('meteradd', is_meteradd)),
 }
 
 
+_FLOWDEL_COMMANDS = frozenset((ofp.OFPFC_DELETE, ofp.OFPFC_DELETE_STRICT))
+
+
 def _msg_kind(ofmsg):
     ofmsg_type = type(ofmsg)
+    if ofmsg_type is ValveFlowMod:
+        # Most common case, so avoid the generic predicates.
+        if ofmsg.command in _FLOWDEL_COMMANDS:
+            if ofmsg.table_id == ofp.OFPTT_ALL and not ofmsg.match:
+                return 'deleteglobal'
+            return 'delete'
+        return 'other'
     ofmsg_kind = _MSG_KINDS_TYPES.get(ofmsg_type, None)
     if ofmsg_kind:
         return ofmsg_kind
@@ -856,22 +1131,32 @@ def _msg_kind(ofmsg):
     return 'other'
 
 
-def _partition_ofmsgs(input_ofmsgs):
-    """Partition input ofmsgs by kind."""
-    by_kind = {}
-    for ofmsg in input_ofmsgs:
-        by_kind.setdefault(_msg_kind(ofmsg), []).append(ofmsg)
-    return by_kind
+def _dedupe_key(ofmsg):
+    """Return key that is equal for duplicate ofmsgs."""
+    # ValveFlowMods are hashable with a cached key.
+    if isinstance(ofmsg, ValveFlowMod):
+        return ofmsg
+    # Built in comparison doesn't work until serialized() called
+    # Can't use dict or json comparison as may be nested
+    return str(ofmsg)
 
 
 def dedupe_ofmsgs(input_ofmsgs):
     """Return deduplicated ofmsg list."""
-    # Built in comparison doesn't work until serialized() called
-    # Can't use dict or json comparison as may be nested
-    deduped_input_ofmsgs = {str(ofmsg): ofmsg for ofmsg in input_ofmsgs}
+    deduped_input_ofmsgs = {}
+    for ofmsg in input_ofmsgs:
+        deduped_input_ofmsgs.setdefault(_dedupe_key(ofmsg), ofmsg)
     return list(deduped_input_ofmsgs.values())
 
 
+# Sort ofmsgs without a priority before any with one.
+_NO_PRIORITY = 2**16
+
+
+def _priority_sort_key(ofmsg):
+    return -getattr(ofmsg, 'priority', _NO_PRIORITY)
+
+
 # kind, random_order, suggest_barrier
 _OFMSG_ORDER = (
     ('deleteglobal', False, True),
@@ -890,26 +1175,24 @@ def valve_flowreorder(input_ofmsgs, use_barriers=True):
     # while optionally randomizing order. Platforms that do
     # parallel delete will perform better and platforms that
     # don't will have at most only one barrier to deal with.
-    output_ofmsgs = []
-    by_kind = _partition_ofmsgs(input_ofmsgs)
+    # Partition by kind and dedupe in one pass.
+    by_kind = {kind: {} for kind, _, _ in _OFMSG_ORDER}
+    for ofmsg in input_ofmsgs:
+        by_kind[_msg_kind(ofmsg)].setdefault(_dedupe_key(ofmsg), ofmsg)
 
     # Suppress all other deletes if a global delete is present.
-    delete_global_ofmsgs = by_kind.get('deleteglobal', [])
-    if delete_global_ofmsgs:
-        by_kind['delete'] = []
+    if by_kind['deleteglobal']:
+        by_kind['delete'] = {}
 
+    output_ofmsgs = []
     for kind, random_order, suggest_barrier in _OFMSG_ORDER:
-        ofmsgs = dedupe_ofmsgs(by_kind.get(kind, []))
+        ofmsgs = list(by_kind[kind].values())
         if ofmsgs:
             if random_order:
                 random.shuffle(ofmsgs)
             else:
-                with_priorities = [ofmsg for ofmsg in ofmsgs if hasattr(ofmsg, 'priority')]
                 # If priority present, send highest priority first.
-                if with_priorities:
-                    with_priorities.sort(key=lambda ofmsg: ofmsg.priority, reverse=True)
-                    without_priorities = [ofmsg for ofmsg in ofmsgs if not hasattr(ofmsg, 'priority')]
-                    ofmsgs = without_priorities + with_priorities
+                ofmsgs.sort(key=_priority_sort_key)
             output_ofmsgs.extend(ofmsgs)
             if use_barriers and suggest_barrier:
                 output_ofmsgs.append(barrier())
@@ -976,3 +1259,19 @@ def faucet_async(datapath=None, notify_flow_removed=False, packet_in=True, port_
 def desc_stats_request(datapath=None):
     """Query switch description."""
     return parser.OFPDescStatsRequest(datapath, 0)
+
+
+def flow_stats_request(datapath=None):
+    """Query all flows in all tables."""
+    return parser.OFPFlowStatsRequest(
+        datapath, 0, ofp.OFPTT_ALL, ofp.OFPP_ANY, ofp.OFPG_ANY, 0, 0, parser.OFPMatch())
+
+
+def group_desc_stats_request(datapath=None):
+    """Query all group descriptions."""
+    return parser.OFPGroupDescStatsRequest(datapath, 0)
+
+
+def meter_config_stats_request(datapath=None):
+    """Query all meter configurations."""
+    return parser.OFPMeterConfigStatsRequest(datapath, 0, ofp.OFPM_ALL)
@@ -0,0 +1,127 @@
+"""Outbound OpenFlow message queue for a datapath."""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2019 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+
+from faucet import valve_of
+from faucet.valve_of import ofp
+
+
+class ValveOutQueue:
+    """FIFO of OpenFlow messages waiting to be sent to a datapath.
+
+    A queued flow add or strict delete is superseded (removed) by a later
+    add or strict delete of the same (table, priority, match), as only the
+    later one affects the final state of the datapath. Likewise a queued
+    strict modify is superseded by a later one.
+    """
+
+    _COALESCE_COMMANDS = frozenset((
+        ofp.OFPFC_ADD, ofp.OFPFC_MODIFY_STRICT, ofp.OFPFC_DELETE_STRICT))
+
+    def __init__(self, max_depth):
+        self.max_depth = max_depth
+        self.depth = 0
+        self._queue = deque()
+        self._queued_by_key = {}
+
+    def reset(self):
+        """Discard all queued messages."""
+        self.depth = 0
+        self._queue = deque()
+        self._queued_by_key = {}
+
+    def full(self):
+        """Return True if no more messages should be queued."""
+        return self.depth >= self.max_depth
+
+    def oldest(self):
+        """Return time the oldest queued message was queued, or None if empty."""
+        while self._queue:
+            queued_time, ofmsg, _ = self._queue[0]
+            if ofmsg is not None:
+                return queued_time
+            self._queue.popleft()
+        return None
+
+    @classmethod
+    def _coalesce_key(cls, ofmsg):
+        if not isinstance(ofmsg, valve_of.ValveFlowMod):
+            return None
+        if ofmsg.command not in cls._COALESCE_COMMANDS:
+            return None
+        if ofmsg.command == ofp.OFPFC_DELETE_STRICT:
+            # A delete filtered by output port/group may not delete the flow.
+            if ofmsg.out_port not in (None, ofp.OFPP_ANY):
+                return None
+            if ofmsg.out_group not in (None, ofp.OFPG_ANY):
+                return None
+        return (ofmsg.table_id, ofmsg.priority, ofmsg.match.key())
+
+    def put(self, now, ofmsgs):
+        """Queue ofmsgs, superseding queued flow messages.
+
+        Args:
+            now (float): current epoch time.
+            ofmsgs (list): OpenFlow messages to queue, in order.
+        Returns:
+            int: number of queued messages superseded.
+        """
+        coalesced = 0
+        for ofmsg in ofmsgs:
+            key = self._coalesce_key(ofmsg)
+            if key is not None:
+                queued = self._queued_by_key.get(key, None)
+                if queued is not None and queued[1] is not None:
+                    if (ofmsg.command != ofp.OFPFC_MODIFY_STRICT or
+                            queued[1].command == ofp.OFPFC_MODIFY_STRICT):
+                        queued[1] = None
+                        self.depth -= 1
+                        coalesced += 1
+            queued = [now, ofmsg, key]
+            self._queue.append(queued)
+            if key is not None:
+                self._queued_by_key[key] = queued
+            self.depth += 1
+        return coalesced
+
+    def get(self, max_ofmsgs=None):
+        """Dequeue messages in order.
+
+        Args:
+            max_ofmsgs (int): maximum number of messages to dequeue (None for all).
+        Returns:
+            tuple: time oldest message was queued (or None), list of messages.
+        """
+        oldest_time = None
+        ofmsgs = []
+        while self._queue and (max_ofmsgs is None or len(ofmsgs) < max_ofmsgs):
+            queued = self._queue.popleft()
+            queued_time, ofmsg, key = queued
+            if ofmsg is None:
+                continue
+            self.depth -= 1
+            if key is not None and self._queued_by_key.get(key, None) is queued:
+                del self._queued_by_key[key]
+            # Superseded messages may leave barriers adjacent.
+            if ofmsgs and valve_of.is_barrier(ofmsg) and valve_of.is_barrier(ofmsgs[-1]):
+                continue
+            if oldest_time is None:
+                oldest_time = queued_time
+            ofmsgs.append(ofmsg)
+        return (oldest_time, ofmsgs)
@@ -23,7 +23,6 @@ import struct
 from netaddr import EUI
 
 from ryu.lib import addrconv
-from ryu.lib.mac import BROADCAST, is_multicast, haddr_to_bin
 from ryu.lib.packet import (
     arp, bpdu, ethernet,
     icmp, icmpv6, ipv4, ipv6,
@@ -149,6 +148,43 @@ def parse_lldp(pkt):
     return pkt.get_protocol(lldp.lldp)
 
 
+_ETH_HEADER = struct.Struct('!6s6sH')
+_VLAN_HEADER = struct.Struct('!HH')
+_MAC_STR_FORMAT = ':'.join(['%02x'] * 6)
+
+
+def mac_str(mac_bytes):
+    """Return MAC address as a string.
+
+    Args:
+        mac_bytes (bytes): MAC address in binary form.
+    Returns:
+        str: MAC address (e.g. 0e:00:00:00:00:01).
+    """
+    return _MAC_STR_FORMAT % tuple(mac_bytes)
+
+
+def parse_eth_header(data):
+    """Parse Ethernet/VLAN header directly from packet data.
+
+    Args:
+        data (bytes): packet data from dataplane.
+    Returns:
+        tuple: eth_src (str), eth_dst (str), Ethernet type (inside VLAN),
+            VLAN VID (or None if no VLAN); None if too short to parse.
+    """
+    if len(data) < ETH_HEADER_SIZE:
+        return None
+    eth_dst, eth_src, eth_type = _ETH_HEADER.unpack_from(data)
+    vlan_vid = None
+    if eth_type == valve_of.ether.ETH_TYPE_8021Q:
+        if len(data) < ETH_VLAN_HEADER_SIZE:
+            return None
+        vlan_tci, eth_type = _VLAN_HEADER.unpack_from(data, ETH_HEADER_SIZE)
+        vlan_vid = vlan_tci & 0x0fff
+    return (mac_str(eth_src), mac_str(eth_dst), eth_type, vlan_vid)
+
+
 def parse_packet_in_pkt(data, max_len, eth_pkt=None, vlan_pkt=None):
     """Parse a packet received via packet in from the dataplane.
 
@@ -197,10 +233,8 @@ def mac_addr_is_unicast(mac_addr):
     Returns:
         bool: True if a unicast Ethernet address.
     """
-    mac_bin = haddr_to_bin(mac_addr)
-    if mac_bin == BROADCAST:
-        return False
-    return not is_multicast(mac_bin)
+    # Broadcast is also multicast.
+    return not int(mac_addr[:2], 16) & 1
 
 
 def build_pkt_header(vid, eth_src, eth_dst, dl_type):
@@ -698,13 +732,20 @@ class PacketMeta:
         valve_of.ether.ETH_TYPE_IP: VLAN_ICMP_ECHO_REQ_SIZE,
     }
 
-    def __init__(self, data, orig_len, pkt, eth_pkt, vlan_pkt, port, valve_vlan,
-                 eth_src, eth_dst, eth_type):
+    # Offsets of L3 source and destination addresses, from start of L3 header.
+    L3_ADDR_OFFSETS = {
+        valve_of.ether.ETH_TYPE_IP: (4, IPV4_HEADER_SIZE, 12, 16, 4),
+        valve_of.ether.ETH_TYPE_ARP: (None, ARP_REQ_PKT_SIZE, 14, 24, 4),
+        valve_of.ether.ETH_TYPE_IPV6: (6, IPV6_HEADER_SIZE, 8, 24, 16),
+    }
+
+    def __init__(self, data, orig_len, port, valve_vlan, eth_src, eth_dst, eth_type):
         self.data = data
         self.orig_len = orig_len
-        self.pkt = pkt
-        self.eth_pkt = eth_pkt
-        self.vlan_pkt = vlan_pkt
+        # Ryu packet is parsed on demand, by reparse().
+        self.pkt = None
+        self.eth_pkt = None
+        self.vlan_pkt = None
         self.port = port
         self.vlan = valve_vlan
         self.eth_src = eth_src
@@ -746,6 +787,21 @@ class PacketMeta:
             return ip_header[0] >> 4
         return None
 
+    def parse_l3_addrs(self):
+        """Parse L3 source and destination addresses directly from packet data."""
+        if self.eth_type not in self.L3_ADDR_OFFSETS:
+            return
+        ip_ver, header_size, src_offset, dst_offset, addr_size = self.L3_ADDR_OFFSETS[
+            self.eth_type]
+        if len(self.data) < ETH_VLAN_HEADER_SIZE + header_size:
+            return
+        if ip_ver is not None and ip_ver != self.ip_ver():
+            return
+        src_offset += ETH_VLAN_HEADER_SIZE
+        dst_offset += ETH_VLAN_HEADER_SIZE
+        self.l3_src = ipaddress.ip_address(bytes(self.data[src_offset:src_offset+addr_size]))
+        self.l3_dst = ipaddress.ip_address(bytes(self.data[dst_offset:dst_offset+addr_size]))
+
     def reparse_ip(self, payload=0):
         """Reparse packet with specified IP header type and optionally payload."""
         if self.eth_type in self.ETH_TYPES_PARSERS:
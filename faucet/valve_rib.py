@@ -0,0 +1,321 @@
+"""Routing information base, indexed for longest prefix match."""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2019 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class RibNode:
+    """Radix trie node, for a prefix that is a route, or a branch point between routes."""
+
+    __slots__ = [
+        'addr',
+        'children',
+        'ip_dst',
+        'prefixlen',
+        'uniform',
+    ]
+
+    def __init__(self, addr, prefixlen, ip_dst=None):
+        self.addr = addr
+        self.prefixlen = prefixlen
+        self.ip_dst = ip_dst
+        self.children = [None, None]
+        # Inherited and uniform nexthop, as last computed by FibCompressor.
+        self.uniform = None
+
+
+class Rib(dict):
+    """IP routes, destination network to gateway, for one IP version.
+
+    Routes are a dict, and are also indexed by a path compressed binary
+    radix trie, so the most specific route for an address (and the routes
+    within a network) can be found without scanning every route.
+    """
+
+    __slots__ = [
+        '_max_prefixlen',
+        '_root',
+    ]
+
+    def __init__(self):
+        super(Rib, self).__init__()
+        self._max_prefixlen = None
+        self._root = None
+
+    def _bit(self, addr, pos):
+        return (addr >> (self._max_prefixlen - 1 - pos)) & 1
+
+    def _common_prefixlen(self, addr, other_addr, limit):
+        diff = addr ^ other_addr
+        if not diff:
+            return limit
+        return min(limit, self._max_prefixlen - diff.bit_length())
+
+    def _insert(self, ip_dst):
+        if self._root is None:
+            self._max_prefixlen = ip_dst.max_prefixlen
+            self._root = RibNode(0, 0)
+        addr = int(ip_dst.network_address)
+        prefixlen = ip_dst.prefixlen
+        node = self._root
+        while True:
+            if node.prefixlen == prefixlen:
+                node.ip_dst = ip_dst
+                return
+            branch = self._bit(addr, node.prefixlen)
+            child = node.children[branch]
+            if child is None:
+                node.children[branch] = RibNode(addr, prefixlen, ip_dst)
+                return
+            common = self._common_prefixlen(
+                addr, child.addr, min(prefixlen, child.prefixlen))
+            if common == child.prefixlen:
+                node = child
+                continue
+            if common == prefixlen:
+                new_node = RibNode(addr, prefixlen, ip_dst)
+            else:
+                new_node = RibNode(addr, common)
+                new_node.children[self._bit(addr, common)] = RibNode(addr, prefixlen, ip_dst)
+            new_node.children[self._bit(child.addr, common)] = child
+            node.children[branch] = new_node
+            return
+
+    def _remove(self, ip_dst):
+        addr = int(ip_dst.network_address)
+        prefixlen = ip_dst.prefixlen
+        path = []
+        node = self._root
+        while node is not None and node.prefixlen < prefixlen:
+            path.append(node)
+            node = node.children[self._bit(addr, node.prefixlen)]
+        if node is None or node.ip_dst != ip_dst:
+            return
+        node.ip_dst = None
+        # Splice out nodes that no longer branch between routes.
+        while path and node.ip_dst is None:
+            children = [child for child in node.children if child is not None]
+            if len(children) > 1:
+                return
+            parent = path.pop()
+            parent.children[parent.children.index(node)] = children[0] if children else None
+            if children:
+                return
+            node = parent
+
+    def __setitem__(self, ip_dst, ip_gw):
+        if ip_dst not in self:
+            self._insert(ip_dst)
+        super(Rib, self).__setitem__(ip_dst, ip_gw)
+
+    def __delitem__(self, ip_dst):
+        super(Rib, self).__delitem__(ip_dst)
+        self._remove(ip_dst)
+
+    def pop(self, ip_dst, *args):
+        if ip_dst in self:
+            ip_gw = self[ip_dst]
+            del self[ip_dst]
+            return ip_gw
+        return super(Rib, self).pop(ip_dst, *args)
+
+    def clear(self):
+        super(Rib, self).clear()
+        self._root = None
+
+    def longest_match(self, ip_addr):
+        """Return the most specific route destination containing an address, or None."""
+        if self._root is None or ip_addr.max_prefixlen != self._max_prefixlen:
+            return None
+        addr = int(ip_addr)
+        best = None
+        node = self._root
+        while node is not None:
+            if self._common_prefixlen(addr, node.addr, node.prefixlen) != node.prefixlen:
+                break
+            if node.ip_dst is not None:
+                best = node.ip_dst
+            if node.prefixlen == self._max_prefixlen:
+                break
+            node = node.children[self._bit(addr, node.prefixlen)]
+        return best
+
+    def subnets(self, ip_net):
+        """Return route destinations within a network (including the network itself)."""
+        if self._root is None or ip_net.max_prefixlen != self._max_prefixlen:
+            return []
+        addr = int(ip_net.network_address)
+        prefixlen = ip_net.prefixlen
+        node = self._root
+        while node is not None and node.prefixlen < prefixlen:
+            node = node.children[self._bit(addr, node.prefixlen)]
+        if node is None or self._common_prefixlen(addr, node.addr, prefixlen) != prefixlen:
+            return []
+        ip_dsts = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node.ip_dst is not None:
+                ip_dsts.append(node.ip_dst)
+            nodes.extend([child for child in node.children if child is not None])
+        return ip_dsts
+
+
+# Uniform nexthop value for a network whose addresses do not all have the same nexthop.
+_MIXED = object()
+
+
+def _same_uniform(uniform, other_uniform):
+    if uniform is _MIXED or other_uniform is _MIXED:
+        return uniform is other_uniform
+    return uniform == other_uniform
+
+
+class FibCompressor:
+    """Compress a FIB, to fewer prefixes that give the same longest match results.
+
+    Routes whose nearest covering route has the same nexthop are redundant, and
+    networks whose addresses all resolve to the same nexthop need only one prefix.
+    Prefixes are never added where there was no route before, so addresses with
+    no route still match no route. When a route changes, only the part of the
+    trie whose compressed prefixes could have changed is recomputed.
+    """
+
+    __slots__ = [
+        '_network',
+        'installed',
+        'routes',
+    ]
+
+    def __init__(self):
+        self.routes = Rib()
+        self.installed = Rib()
+        self._network = None
+
+    def _node_net(self, node):
+        if node.ip_dst is not None:
+            return node.ip_dst
+        shift = self.routes._max_prefixlen - node.prefixlen # pylint: disable=protected-access
+        return self._network((node.addr >> shift << shift, node.prefixlen))
+
+    def _uniform_nexthop(self, node, inherited, use_cache, force=False):
+        """Return the nexthop of all addresses in a trie node, or _MIXED."""
+        if use_cache and not force and node.uniform is not None and node.uniform[0] == inherited:
+            return node.uniform[1]
+        nexthop = inherited
+        if node.ip_dst is not None:
+            nexthop = self.routes[node.ip_dst]
+        if node.prefixlen == self.routes._max_prefixlen: # pylint: disable=protected-access
+            uniform = nexthop
+        else:
+            halves = []
+            for child in node.children:
+                if child is None:
+                    halves.append(nexthop)
+                    continue
+                child_uniform = self._uniform_nexthop(child, nexthop, use_cache)
+                # A child deeper than half this network, leaves the rest with our nexthop.
+                if (child.prefixlen != node.prefixlen + 1 and
+                        not _same_uniform(child_uniform, nexthop)):
+                    child_uniform = _MIXED
+                halves.append(child_uniform)
+            uniform = halves[0]
+            if not _same_uniform(halves[0], halves[1]):
+                uniform = _MIXED
+        node.uniform = (inherited, uniform)
+        return uniform
+
+    def _compressed(self, node, inherited):
+        """Return compressed (prefix, nexthop) entries within a trie node."""
+        uniform = node.uniform[1]
+        if uniform is not _MIXED:
+            if uniform is None or uniform == inherited:
+                return []
+            return [(self._node_net(node), uniform)]
+        entries = []
+        if node.ip_dst is not None:
+            nexthop = self.routes[node.ip_dst]
+            if nexthop != inherited:
+                entries.append((node.ip_dst, nexthop))
+                inherited = nexthop
+        for child in node.children:
+            if child is not None:
+                entries.extend(self._compressed(child, inherited))
+        return entries
+
+    def update(self, ip_dst, nexthop=None):
+        """Add, change or (if nexthop is None) delete a route.
+
+        Args:
+            ip_dst (ipaddress.ip_network): route destination.
+            nexthop: nexthop (any comparable value, e.g. a MAC address), or None.
+        Returns:
+            tuple: compressed prefixes to add or change (dict of prefix to nexthop),
+                and compressed prefixes to delete (list).
+        """
+        routes = self.routes
+        if nexthop is None:
+            if ip_dst not in routes:
+                return ({}, [])
+            del routes[ip_dst]
+        else:
+            if routes.get(ip_dst, None) == nexthop:
+                return ({}, [])
+            routes[ip_dst] = nexthop
+            self._network = type(ip_dst)
+        addr = int(ip_dst.network_address)
+        prefixlen = ip_dst.prefixlen
+        # Nodes (and the nexthops they inherit), from the root down to
+        # the deepest node containing the changed route.
+        path = []
+        inherited = None
+        node = routes._root # pylint: disable=protected-access
+        while node is not None and node.prefixlen <= prefixlen:
+            if routes._common_prefixlen( # pylint: disable=protected-access
+                    addr, node.addr, node.prefixlen) != node.prefixlen:
+                break
+            path.append((node, inherited))
+            if node.ip_dst is not None:
+                inherited = routes[node.ip_dst]
+            if node.prefixlen == prefixlen:
+                break
+            node = node.children[routes._bit(addr, node.prefixlen)] # pylint: disable=protected-access
+        # Everything within the deepest node may inherit a different nexthop.
+        region, region_inherited = path.pop()
+        self._uniform_nexthop(region, region_inherited, False)
+        # Ancestors need recomputing only until one is as uniform as it was.
+        while path:
+            parent, parent_inherited = path[-1]
+            previous = parent.uniform
+            uniform = self._uniform_nexthop(parent, parent_inherited, True, force=True)
+            if previous is not None and _same_uniform(previous[1], uniform):
+                break
+            region, region_inherited = path.pop()
+        new_entries = {}
+        # Otherwise, a uniform ancestor covers the region with a prefix that has not changed.
+        if all(ancestor.uniform[1] is _MIXED for ancestor, _ in path):
+            new_entries = dict(self._compressed(region, region_inherited))
+        deleted = []
+        for installed_dst in self.installed.subnets(self._node_net(region)):
+            if installed_dst not in new_entries:
+                deleted.append(installed_dst)
+                del self.installed[installed_dst]
+        added = {}
+        for installed_dst, installed_nexthop in new_entries.items():
+            if self.installed.get(installed_dst, None) != installed_nexthop:
+                added[installed_dst] = installed_nexthop
+                self.installed[installed_dst] = installed_nexthop
+        return (added, deleted)
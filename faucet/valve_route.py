@@ -28,6 +28,7 @@ from ryu.lib.packet import arp, icmp, icmpv6, ipv4, ipv6
 from faucet import valve_of
 from faucet import valve_packet
 from faucet.valve_manager_base import ValveManagerBase
+from faucet.valve_rib import FibCompressor
 
 
 class AnonVLAN:
@@ -74,13 +75,14 @@ class NextHop:
             (2**self.resolve_retries + random.randint(0, self.resolve_retries)),
             max_resolve_backoff_time)
 
-    def resolution_due(self, now, max_age):
-        """Return True if this nexthop is due to be re resolved/retried."""
-        if self.eth_src is not None and self.age(now) < max_age:
-            return False
-        if self.next_retry_time is None or self.next_retry_time < now:
-            return True
-        return False
+    def resolution_due_time(self, max_age):
+        """Return time after which this nexthop is due to be re resolved/retried."""
+        due_time = self.next_retry_time
+        if self.eth_src is not None:
+            expire_time = self.cache_time + max_age
+            if due_time is None or due_time < expire_time:
+                due_time = expire_time
+        return due_time
 
 
 class ValveRouteManager(ValveManagerBase):
@@ -90,6 +92,8 @@ class ValveRouteManager(ValveManagerBase):
         'active',
         'neighbor_timeout',
         'dec_ttl',
+        'fib_compression',
+        'fib_compressors',
         'fib_table',
         'pipeline',
         'multi_out',
@@ -100,6 +104,7 @@ class ValveRouteManager(ValveManagerBase):
         'max_hosts_per_resolve_cycle',
         'max_resolve_backoff_time',
         'proactive_learn',
+        'resolve_latency',
         'route_priority',
         'routers',
         'vip_table',
@@ -116,7 +121,8 @@ class ValveRouteManager(ValveManagerBase):
     def __init__(self, logger, global_vlan, neighbor_timeout,
                  max_hosts_per_resolve_cycle, max_host_fib_retry_count,
                  max_resolve_backoff_time, proactive_learn, dec_ttl, multi_out,
-                 fib_table, vip_table, pipeline, routers):
+                 fib_table, vip_table, pipeline, routers, fib_compression=False,
+                 resolve_latency=None):
         self.logger = logger
         self.global_vlan = AnonVLAN(global_vlan)
         self.neighbor_timeout = neighbor_timeout
@@ -131,6 +137,9 @@ class ValveRouteManager(ValveManagerBase):
         self.pipeline = pipeline
         self.route_priority = self._LPM_PRIORITY
         self.routers = routers
+        self.fib_compression = fib_compression
+        self.fib_compressors = defaultdict(FibCompressor)
+        self.resolve_latency = resolve_latency
         self.active = False
         self.global_routing = self._global_routing()
         if self.global_routing:
@@ -269,7 +278,13 @@ class ValveRouteManager(ValveManagerBase):
 
     @staticmethod
     def _stateful_gw(vlan, dst_ip):
-        return not dst_ip.is_link_local or vlan.ip_dsts_for_ip_gw(dst_ip)
+        return not dst_ip.is_link_local or vlan.is_ip_gw(dst_ip)
+
+    def _routed_in_vip_subnet(self, vlan, faucet_vip, dst_ip):
+        """Return True if an IP is routed by a route more specific than its VIP subnet."""
+        ip_dst = self._vlan_routes(vlan).longest_match(dst_ip)
+        return (ip_dst is not None and
+                faucet_vip.network.prefixlen < ip_dst.prefixlen < ip_dst.max_prefixlen)
 
     def _global_routing(self):
         return self.global_vlan.vid and self.routers and len(self.routers) == 1
@@ -342,6 +357,8 @@ class ValveRouteManager(ValveManagerBase):
 
     def add_vlan(self, vlan):
         ofmsgs = []
+        # VLAN FIB flows are (re)installed from scratch, so forget what was compressed.
+        self.fib_compressors.pop(vlan.vid, None)
         # add controller IPs if configured.
         for faucet_vip in vlan.faucet_vips_by_ipv(self.IPV):
             max_prefixlen = faucet_vip.ip.max_prefixlen
@@ -353,24 +370,61 @@ class ValveRouteManager(ValveManagerBase):
                 vlan, priority, faucet_vip, faucet_vip_host))
         return ofmsgs
 
+    def _fib_add_flows(self, vlan, ip_dst, eth_dst):
+        ofmsgs = []
+        inst = self.pipeline.accept_to_l2_forwarding(
+            actions=self._nexthop_actions(eth_dst, vlan))
+        routed_vlans = self._routed_vlans(vlan)
+        for routed_vlan in routed_vlans:
+            in_match = self._route_match(routed_vlan, ip_dst)
+            ofmsgs.append(self.fib_table.flowmod(
+                in_match, priority=self._route_priority(ip_dst), inst=inst))
+        return ofmsgs
+
+    def _fib_del_flows(self, vlan, ip_dst):
+        ofmsgs = []
+        routed_vlans = self._routed_vlans(vlan)
+        for routed_vlan in routed_vlans:
+            route_match = self._route_match(routed_vlan, ip_dst)
+            ofmsgs.append(self.fib_table.flowdel(
+                route_match, priority=self._route_priority(ip_dst), strict=True))
+        return ofmsgs
+
+    def _compressed_fib_flows(self, vlan, ip_dst, eth_dst):
+        """Return flows to update the compressed FIB, for a route added/updated/deleted."""
+        fib_compressor = self.fib_compressors[vlan.vid]
+        added, deleted = fib_compressor.update(ip_dst, eth_dst)
+        ofmsgs = []
+        for installed_dst, installed_eth_dst in added.items():
+            ofmsgs.extend(self._fib_add_flows(vlan, installed_dst, installed_eth_dst))
+        for installed_dst in deleted:
+            ofmsgs.extend(self._fib_del_flows(vlan, installed_dst))
+        # A host route not installed itself, must not leave a resolution blackhole behind.
+        if (ip_dst.prefixlen == ip_dst.max_prefixlen and
+                ip_dst not in fib_compressor.installed and ip_dst not in deleted):
+            ofmsgs.extend(self._fib_del_flows(vlan, ip_dst))
+        return ofmsgs
+
+    def fib_route_counts(self, vlan):
+        """Return number of resolved routes, and number of FIB routes installed, for a VLAN."""
+        fib_compressor = self.fib_compressors[vlan.vid]
+        return (len(fib_compressor.routes), len(fib_compressor.installed))
+
     def _add_resolved_route(self, vlan, ip_gw, ip_dst, eth_dst, is_updated):
         ofmsgs = []
         if is_updated:
             self.logger.info(
                 'Updating next hop for route %s via %s (%s) on VLAN %u' % (
                     ip_dst, ip_gw, eth_dst, vlan.vid))
-            ofmsgs.extend(self._del_route_flows(vlan, ip_dst))
+            if not self.fib_compression:
+                ofmsgs.extend(self._del_route_flows(vlan, ip_dst))
         else:
             self.logger.info(
                 'Adding new route %s via %s (%s) on VLAN %u' % (
                     ip_dst, ip_gw, eth_dst, vlan.vid))
-        inst = self.pipeline.accept_to_l2_forwarding(
-            actions=self._nexthop_actions(eth_dst, vlan))
-        routed_vlans = self._routed_vlans(vlan)
-        for routed_vlan in routed_vlans:
-            in_match = self._route_match(routed_vlan, ip_dst)
-            ofmsgs.append(self.fib_table.flowmod(
-                in_match, priority=self._route_priority(ip_dst), inst=inst))
+        if self.fib_compression:
+            return self._compressed_fib_flows(vlan, ip_dst, eth_dst)
+        ofmsgs.extend(self._fib_add_flows(vlan, ip_dst, eth_dst))
         return ofmsgs
 
     def _update_nexthop_cache(self, now, vlan, eth_src, port, ip_gw):
@@ -403,33 +457,6 @@ class ValveRouteManager(ValveManagerBase):
         self._update_nexthop_cache(now, vlan, eth_src, port, resolved_ip_gw)
         return ofmsgs
 
-    def _vlan_unresolved_nexthops(self, vlan, ip_gws, now):
-        """Return unresolved or expired IP gateways, never tried/oldest first.
-
-        Args:
-           vlan (vlan): VLAN containing this RIB/FIB.
-           ip_gws (list): tuple, IP gateway and controller IP in same subnet.
-           now (float): seconds since epoch.
-        Returns:
-           list: prioritized list of gateways.
-        """
-        vlan_nexthop_cache = self._vlan_nexthop_cache(vlan)
-        nexthop_entries = [
-            (ip_gw, vlan_nexthop_cache.get(ip_gw, None)) for ip_gw in ip_gws]
-        not_fresh_nexthops = [
-            (ip_gw, entry) for ip_gw, entry in nexthop_entries
-            if entry is None or entry.resolution_due(now, self.neighbor_timeout)]
-        unresolved_nexthops_by_retries = defaultdict(list)
-        for ip_gw, entry in not_fresh_nexthops:
-            if entry is None:
-                entry = self._update_nexthop_cache(now, vlan, None, None, ip_gw)
-            unresolved_nexthops_by_retries[entry.resolve_retries].append(ip_gw)
-        unresolved_nexthops = deque()
-        for _retries, nexthops in sorted(unresolved_nexthops_by_retries.items()):
-            random.shuffle(nexthops)
-            unresolved_nexthops.extend(nexthops)
-        return unresolved_nexthops
-
     def advertise(self, vlan):
         raise NotImplementedError # pragma: no cover
 
@@ -481,66 +508,127 @@ class ValveRouteManager(ValveManagerBase):
             return self._expire_gateway_flows(ip_gw, nexthop_cache_entry, vlan, now)
         return self._resolve_gateway_flows(ip_gw, nexthop_cache_entry, vlan, now)
 
-    def _resolve_gateways_flows(self, resolve_handler, vlan, now,
-                                unresolved_nexthops, remaining_attempts):
-        ofmsgs = []
-        for ip_gw in unresolved_nexthops:
-            if remaining_attempts == 0:
-                break
-            entry = self._vlan_nexthop_cache_entry(vlan, ip_gw)
-            if entry is None:
+    def _due_nexthops(self, vlan, gw_queue, ip_gws, now):
+        """Yield (due time, IP gateway, nexthop) for nexthops due to be resolved, earliest first.
+
+        Nexthop is None if never tried (or expired).
+
+        Args:
+           vlan (vlan): VLAN containing this RIB/FIB.
+           gw_queue (NextHopQueue): gateways of one type, by resolution due time.
+           ip_gws (set): current gateways of that type.
+           now (float): seconds since epoch.
+        """
+        vlan_nexthop_cache = self._vlan_nexthop_cache(vlan)
+        while True:
+            due = gw_queue.pop_due(now)
+            if due is None:
+                return
+            due_time, ip_gw = due
+            if ip_gw not in ip_gws:
                 continue
-            if not entry.resolution_due(now, self.neighbor_timeout):
+            entry = vlan_nexthop_cache.get(ip_gw, None)
+            if entry is not None:
+                entry_due_time = entry.resolution_due_time(self.neighbor_timeout)
+                if entry_due_time > due_time:
+                    # Nexthop was updated (e.g. learned) since it was queued.
+                    gw_queue.schedule(ip_gw, entry_due_time)
+                    continue
+            yield (due_time, ip_gw, entry)
+
+    def _resolve_gateways_flows(self, resolve_handler, vlans, now,
+                                gw_queues_attr, gws_attr, max_resolves, new_nexthops):
+        """Resolve due nexthops, sharing attempts between VLANs in turn.
+
+        Args:
+           resolve_handler (callable): returns flows to resolve (or expire) a nexthop.
+           vlans (list): VLANs to resolve nexthops on.
+           now (float): seconds since epoch.
+           gw_queues_attr (str): VLAN attribute, gateway queues by IP version.
+           gws_attr (str): VLAN attribute, gateways by IP version.
+           max_resolves (int): maximum resolution attempts, if not None.
+           new_nexthops (bool): if False, leave never tried nexthops for a later cycle.
+        Returns:
+           list: OpenFlow messages.
+        """
+        if max_resolves is None:
+            max_resolves = self.max_hosts_per_resolve_cycle * len(vlans)
+        ofmsgs = []
+        rescheduled = []
+        deferred = []
+        due_nexthops = deque()
+        for vlan in vlans:
+            gw_queue = getattr(vlan, gw_queues_attr)[self.IPV]
+            if gw_queue:
+                due_nexthops.append((vlan, gw_queue, self._due_nexthops(
+                    vlan, gw_queue, getattr(vlan, gws_attr)[self.IPV], now)))
+        while due_nexthops and max_resolves > 0:
+            vlan, gw_queue, vlan_due_nexthops = due_nexthops.popleft()
+            due = next(vlan_due_nexthops, None)
+            if due is None:
                 continue
+            due_time, ip_gw, entry = due
+            if entry is None:
+                if not new_nexthops:
+                    deferred.append((gw_queue, ip_gw, due_time))
+                    due_nexthops.append((vlan, gw_queue, vlan_due_nexthops))
+                    continue
+                # Never tried, or expired, so try now.
+                entry = self._update_nexthop_cache(now, vlan, None, None, ip_gw)
+                due_time = now
             resolve_flows = resolve_handler(ip_gw, entry, vlan, now)
             if resolve_flows:
                 ofmsgs.extend(resolve_flows)
-                remaining_attempts -= 1
+                max_resolves -= 1
+                if self.resolve_latency is not None:
+                    self.resolve_latency.observe(now - due_time)
+            rescheduled.append((vlan, gw_queue, ip_gw, entry))
+            due_nexthops.append((vlan, gw_queue, vlan_due_nexthops))
+        # Queue attempted nexthops only now, so none is attempted twice in one cycle.
+        for vlan, gw_queue, ip_gw, entry in rescheduled:
+            if self._vlan_nexthop_cache_entry(vlan, ip_gw) is entry:
+                due_time = entry.resolution_due_time(self.neighbor_timeout)
+            else:
+                due_time = now
+            gw_queue.schedule(ip_gw, due_time)
+        for gw_queue, ip_gw, due_time in deferred:
+            gw_queue.schedule(ip_gw, due_time)
         return ofmsgs
 
-    def resolve_gateways(self, vlan, now, resolve_all=True):
-        """Re/resolve gateways.
+    def resolve_gateways(self, vlans, now, max_resolves=None, new_nexthops=True):
+        """Re/resolve gateways due to be resolved.
 
         Args:
-            vlan (vlan): VLAN containing this RIB/FIB.
+            vlans (list): VLANs containing this RIB/FIB.
             now (float): seconds since epoch.
-            resolve_all (bool): attempt to resolve all unresolved gateways.
+            max_resolves (int): maximum resolution attempts (default per VLAN limit for each VLAN).
+            new_nexthops (bool): if False, only retry gateways already tried.
         Returns:
             list: OpenFlow messages.
         """
-        unresolved_gateways = []
-        if resolve_all:
-            unresolved_gateways = self._vlan_unresolved_nexthops(
-                vlan, vlan.dyn_route_gws_by_ipv[self.IPV], now)
-            vlan.dyn_unresolved_route_ip_gws[self.IPV] = unresolved_gateways
-        else:
-            if vlan.dyn_unresolved_route_ip_gws[self.IPV]:
-                unresolved_gateways = [vlan.dyn_unresolved_route_ip_gws[self.IPV].popleft()]
         return self._resolve_gateways_flows(
-            self._resolve_gateway_flows, vlan, now,
-            unresolved_gateways, self.max_hosts_per_resolve_cycle)
+            self._resolve_gateway_flows, vlans, now,
+            'dyn_route_gw_queue_by_ipv', 'dyn_route_gws_by_ipv', max_resolves, new_nexthops)
 
-    def resolve_expire_hosts(self, vlan, now, resolve_all=True):
-        """Re/resolve hosts.
+    def resolve_expire_hosts(self, vlans, now, max_resolves=None, new_nexthops=True):
+        """Re/resolve hosts due to be resolved, and expire dead hosts.
 
         Args:
-            vlan (vlan): VLAN containing this RIB/FIB.
+            vlans (list): VLANs containing this RIB/FIB.
             now (float): seconds since epoch.
-            resolve_all (bool): attempt to resolve all unresolved gateways.
+            max_resolves (int): maximum resolution attempts (default per VLAN limit for each VLAN).
+            new_nexthops (bool): if False, only retry hosts already tried.
         Returns:
             list: OpenFlow messages.
         """
-        unresolved_gateways = []
-        if resolve_all:
-            unresolved_gateways = self._vlan_unresolved_nexthops(
-                vlan, vlan.dyn_host_gws_by_ipv[self.IPV], now)
-            vlan.dyn_unresolved_host_ip_gws[self.IPV] = unresolved_gateways
-        else:
-            if vlan.dyn_unresolved_host_ip_gws[self.IPV]:
-                unresolved_gateways = [vlan.dyn_unresolved_host_ip_gws[self.IPV].popleft()]
         return self._resolve_gateways_flows(
-            self._resolve_expire_gateway_flows, vlan, now,
-            unresolved_gateways, self.max_hosts_per_resolve_cycle)
+            self._resolve_expire_gateway_flows, vlans, now,
+            'dyn_host_gw_queue_by_ipv', 'dyn_host_gws_by_ipv', max_resolves, new_nexthops)
+
+    def resolve_backlog(self, vlan, now):
+        """Return number of gateways and hosts on a VLAN due to be resolved, not yet attempted."""
+        return (vlan.dyn_route_gw_queue_by_ipv[self.IPV].due_count(now) +
+                vlan.dyn_host_gw_queue_by_ipv[self.IPV].due_count(now))
 
     def _cached_nexthop_eth_dst(self, vlan, ip_gw):
         entry = self._vlan_nexthop_cache_entry(vlan, ip_gw)
@@ -569,7 +657,8 @@ class ValveRouteManager(ValveManagerBase):
             else:
                 vlan, faucet_vip = router.vip_map(dst_ip)
             if (vlan and vlan.ip_in_vip_subnet(dst_ip, faucet_vip) and
-                    faucet_vip.ip != dst_ip and self._stateful_gw(vlan, dst_ip)):
+                    faucet_vip.ip != dst_ip and self._stateful_gw(vlan, dst_ip) and
+                    not self._routed_in_vip_subnet(vlan, faucet_vip, dst_ip)):
                 limit = self._vlan_nexthop_cache_limit(vlan)
                 if limit is None or len(self._vlan_nexthop_cache(vlan)) < limit:
                     # TODO: avoid relearning L3 source if same L3 source tries
@@ -692,13 +781,9 @@ class ValveRouteManager(ValveManagerBase):
         return ofmsgs
 
     def _del_route_flows(self, vlan, ip_dst):
-        ofmsgs = []
-        routed_vlans = self._routed_vlans(vlan)
-        for routed_vlan in routed_vlans:
-            route_match = self._route_match(routed_vlan, ip_dst)
-            ofmsgs.append(self.fib_table.flowdel(
-                route_match, priority=self._route_priority(ip_dst), strict=True))
-        return ofmsgs
+        if self.fib_compression:
+            return self._compressed_fib_flows(vlan, ip_dst, None)
+        return self._fib_del_flows(vlan, ip_dst)
 
     def del_route(self, vlan, ip_dst):
         """Delete a route from the RIB.
@@ -23,6 +23,8 @@ import random
 import signal
 import sys
 
+from eventlet.hubs import trampoline
+from eventlet.timeout import Timeout
 from ryu.base import app_manager
 from ryu.controller import dpset, event
 from ryu.controller.handler import set_ev_cls
@@ -101,6 +103,7 @@ class RyuAppBase(app_manager.RyuApp):
         Args:
             ryu_event (ryu.controller.event.EventReplyBase): event to trigger.
             period (int): how often to trigger.
+            jitter (int): maximum random extra delay, added to period.
         """
         while True:
             self.send_event(self.__class__.__name__, ryu_event)
@@ -127,13 +130,32 @@ class RyuAppBase(app_manager.RyuApp):
         """Return True if config files changed."""
         raise NotImplementedError # pragma: no cover
 
+    @staticmethod
+    def _watch_config_files():
+        """Return file descriptor readable when config files may have changed, or None."""
+        raise NotImplementedError # pragma: no cover
+
+    def _config_file_wait(self, period, jitter=2):
+        """Wait for config files to change (or up to a period, to check for dead threads)."""
+        fileno = self._watch_config_files()
+        if fileno is None:
+            self._thread_jitter(period, jitter)
+            return
+        try:
+            trampoline(fileno, read=True, timeout=period + (random.random() * jitter))
+        except Timeout:
+            pass
+        self._check_thread_exception()
+
     def _config_file_stat(self):
-        """Periodically stat config files for any changes."""
+        """Check config files for any changes, when notified by inotify or else periodically."""
+        if self._watch_config_files() is not None:
+            self.logger.info('watching config files for changes with inotify')
         while True:
             if self._config_files_changed():
                 if self.stat_reload:
                     self.send_event(self.__class__.__name__, EventReconfigure())
-            self._thread_jitter(3)
+            self._config_file_wait(3)
 
     def start(self):
         """Start controller."""
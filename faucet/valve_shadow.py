@@ -0,0 +1,624 @@
+"""Controller side model of OpenFlow state installed on a datapath."""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2019 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import ipaddress
+import time
+
+from faucet import valve_of
+
+MAC_MATCH_FIELDS = frozenset((
+    'eth_src', 'eth_dst', 'arp_sha', 'arp_tha', 'ipv6_nd_sll', 'ipv6_nd_tll'))
+IP_MATCH_FIELDS = frozenset((
+    'ipv4_src', 'ipv4_dst', 'arp_spa', 'arp_tpa',
+    'ipv6_src', 'ipv6_dst', 'ipv6_nd_target'))
+# Allow for latency between sending a flow and the switch starting its timers.
+TIMEOUT_GRACE_SEC = 5
+# Give up on a flow audit and cold start if the datapath hasn't replied by now.
+FLOW_AUDIT_TIMEOUT_SEC = 30
+
+
+def match_field_int(field, value):
+    """Return a match field value (or mask) as an integer."""
+    if isinstance(value, int):
+        return value
+    if field in MAC_MATCH_FIELDS:
+        return int(value.replace(':', ''), 16)
+    if field in IP_MATCH_FIELDS:
+        return int(ipaddress.ip_address(value))
+    return int(value)
+
+
+def match_ints(match):
+    """Return dict of match field to (value, mask) integers (mask None if exact)."""
+    ints = {}
+    for field, value in match.items():
+        mask = None
+        if isinstance(value, tuple):
+            value, mask = value
+        elif field in IP_MATCH_FIELDS and isinstance(value, str) and '/' in value:
+            value, mask = ipaddress.ip_interface(value).with_netmask.split('/')
+        value = match_field_int(field, value)
+        if mask is not None:
+            mask = match_field_int(field, mask)
+            value &= mask
+        ints[field] = (value, mask)
+    return ints
+
+
+def flow_key(table_id, priority, flow_match_ints):
+    """Return key identifying a flow by table, priority and match."""
+    return (table_id, priority, tuple(sorted(flow_match_ints.items())))
+
+
+def _stripped_jsondict(value):
+    """Return hashable form of a Ryu JSON dict, without encoded lengths."""
+    if isinstance(value, dict):
+        return tuple(sorted(
+            (key, _stripped_jsondict(val)) for key, val in value.items() if key != 'len'))
+    if isinstance(value, list):
+        return tuple([_stripped_jsondict(val) for val in value])
+    return value
+
+
+def ofobjs_value(ofobjs, sort_key=None):
+    """Return comparable form of OpenFlow instructions, actions, buckets or bands.
+
+    Objects we construct and objects parsed from a datapath reply differ in
+    whether lengths are filled in, so str() can't be used to compare them.
+    """
+    if sort_key is not None:
+        ofobjs = sorted(ofobjs, key=sort_key)
+    return _stripped_jsondict([ofobj.to_jsondict() for ofobj in ofobjs])
+
+
+class ShadowFlow:
+    """A flow believed to be installed in a datapath table."""
+
+    __slots__ = [
+        'key',
+        'table_id',
+        'priority',
+        'match',
+        'match_ints',
+        'instructions',
+        'cookie',
+        'hard_timeout',
+        'idle_timeout',
+        'flags',
+        'deadline',
+        '_value',
+    ]
+
+    def __init__(self, flowmod, now, instructions=None):
+        self.table_id = flowmod.table_id
+        self.priority = flowmod.priority
+        self.match = flowmod.match
+        self.match_ints = match_ints(self.match)
+        self.key = flow_key(self.table_id, self.priority, self.match_ints)
+        if instructions is None:
+            instructions = flowmod.instructions
+        self.instructions = instructions
+        self.cookie = flowmod.cookie
+        self.hard_timeout = flowmod.hard_timeout
+        self.idle_timeout = flowmod.idle_timeout
+        self.flags = flowmod.flags
+        self.deadline = getattr(flowmod, 'deadline', None)
+        if self.deadline is None:
+            timeout = self.hard_timeout
+            if self.idle_timeout and not self.flags & valve_of.ofp.OFPFF_SEND_FLOW_REM:
+                # Datapath won't tell us when it idles out, so assume it has.
+                timeout = min(timeout or self.idle_timeout, self.idle_timeout)
+            if timeout:
+                self.deadline = now + timeout + TIMEOUT_GRACE_SEC
+        self._value = None
+
+    def timed(self):
+        """Return True if the switch may expire this flow by itself."""
+        return bool(self.hard_timeout or self.idle_timeout)
+
+    def value(self):
+        """Return comparable representation of what this flow does."""
+        if self._value is None:
+            # Instructions are executed in type order regardless of list order.
+            self._value = (
+                self.cookie, self.hard_timeout, self.idle_timeout, self.flags,
+                ofobjs_value(self.instructions, sort_key=lambda inst: inst.type))
+        return self._value
+
+    def output_ports(self):
+        """Return set of ports this flow directly outputs to."""
+        ports = set()
+        for instruction in self.instructions:
+            if valve_of.is_apply_actions(instruction):
+                for action in instruction.actions:
+                    if valve_of.is_output(action):
+                        ports.add(action.port)
+        return ports
+
+    def matched_by(self, del_match_ints, out_port=valve_of.ofp.OFPP_ANY):
+        """Return True if a non-strict delete/modify with these matches selects this flow."""
+        for field, del_value_mask in del_match_ints.items():
+            value_mask = self.match_ints.get(field, None)
+            if value_mask is None:
+                return False
+            del_value, del_mask = del_value_mask
+            value, _ = value_mask
+            if del_mask is not None:
+                value &= del_mask
+            if value != del_value:
+                return False
+        if out_port != valve_of.ofp.OFPP_ANY and out_port not in self.output_ports():
+            return False
+        return True
+
+    def flowmod(self):
+        """Return flowmod that installs this flow."""
+        return valve_of.flowmod(
+            self.cookie,
+            valve_of.ofp.OFPFC_ADD,
+            self.table_id,
+            self.priority,
+            0,
+            0,
+            self.match,
+            self.instructions,
+            self.hard_timeout,
+            self.idle_timeout,
+            self.flags)
+
+    def flowdel(self):
+        """Return strict flowmod that deletes only this flow."""
+        return valve_of.flowmod(
+            0,
+            valve_of.ofp.OFPFC_DELETE_STRICT,
+            self.table_id,
+            self.priority,
+            valve_of.ofp.OFPP_ANY,
+            valve_of.ofp.OFPG_ANY,
+            self.match,
+            [],
+            0,
+            0)
+
+
+def _group_value(groupmod):
+    return (groupmod.type, ofobjs_value(groupmod.buckets))
+
+
+def _meter_value(metermod):
+    return (metermod.flags, ofobjs_value(metermod.bands))
+
+
+class _ShadowState:
+    """Apply OpenFlow messages to a model of datapath state."""
+
+    groups = None # type: dict
+    meters = None # type: dict
+
+    def _flow_get(self, key):
+        raise NotImplementedError # pragma: no cover
+
+    def _flow_put(self, flow):
+        raise NotImplementedError # pragma: no cover
+
+    def _flow_remove(self, key):
+        raise NotImplementedError # pragma: no cover
+
+    def _flow_clear(self):
+        raise NotImplementedError # pragma: no cover
+
+    def _flow_candidates(self, table_id, del_match_ints):
+        """Return flows in table (or all tables) that might be selected by matches."""
+        raise NotImplementedError # pragma: no cover
+
+    def matching_flows(self, table_id, del_match_ints, out_port=valve_of.ofp.OFPP_ANY):
+        """Return flows selected by a non-strict delete/modify."""
+        return [
+            flow for flow in self._flow_candidates(table_id, del_match_ints)
+            if flow.matched_by(del_match_ints, out_port)]
+
+    def _apply_flowmod(self, ofmsg, now):
+        command = ofmsg.command
+        if command == valve_of.ofp.OFPFC_ADD:
+            self._flow_put(ShadowFlow(ofmsg, now))
+        elif valve_of.is_global_flowdel(ofmsg):
+            self._flow_clear()
+        elif command in (valve_of.ofp.OFPFC_DELETE_STRICT, valve_of.ofp.OFPFC_MODIFY_STRICT):
+            if ofmsg.table_id == valve_of.ofp.OFPTT_ALL:
+                table_ids = {flow.table_id for flow in self.matching_flows(
+                    ofmsg.table_id, match_ints(ofmsg.match))}
+            else:
+                table_ids = (ofmsg.table_id,)
+            for table_id in table_ids:
+                flow = self._flow_get(flow_key(
+                    table_id, ofmsg.priority, match_ints(ofmsg.match)))
+                if flow is None:
+                    continue
+                if command == valve_of.ofp.OFPFC_DELETE_STRICT:
+                    if ofmsg.out_port in (valve_of.ofp.OFPP_ANY, None) or (
+                            ofmsg.out_port in flow.output_ports()):
+                        self._flow_remove(flow.key)
+                else:
+                    self._flow_put(ShadowFlow(flow, now, instructions=ofmsg.instructions))
+        else:
+            out_port = valve_of.ofp.OFPP_ANY
+            if command == valve_of.ofp.OFPFC_DELETE and ofmsg.out_port is not None:
+                out_port = ofmsg.out_port
+            for flow in self.matching_flows(ofmsg.table_id, match_ints(ofmsg.match), out_port):
+                if command == valve_of.ofp.OFPFC_DELETE:
+                    self._flow_remove(flow.key)
+                else:
+                    self._flow_put(ShadowFlow(flow, now, instructions=ofmsg.instructions))
+
+    def _apply_groupmod(self, ofmsg):
+        if ofmsg.command == valve_of.ofp.OFPGC_DELETE:
+            if ofmsg.group_id == valve_of.ofp.OFPG_ALL:
+                self.groups = {}
+            else:
+                self.groups.pop(ofmsg.group_id, None)
+        else:
+            self.groups[ofmsg.group_id] = ofmsg
+
+    def _apply_metermod(self, ofmsg):
+        if ofmsg.command == valve_of.ofp.OFPMC_DELETE:
+            if ofmsg.meter_id == valve_of.ofp.OFPM_ALL:
+                self.meters = {}
+            else:
+                self.meters.pop(ofmsg.meter_id, None)
+        else:
+            self.meters[ofmsg.meter_id] = ofmsg
+
+    def apply_ofmsgs(self, ofmsgs, now=None):
+        """Update model with OpenFlow messages, in the order the datapath will apply them."""
+        if now is None:
+            now = time.time()
+        for ofmsg in ofmsgs:
+            if valve_of.is_flowmod(ofmsg):
+                self._apply_flowmod(ofmsg, now)
+            elif valve_of.is_groupmod(ofmsg):
+                self._apply_groupmod(ofmsg)
+            elif valve_of.is_metermod(ofmsg):
+                self._apply_metermod(ofmsg)
+
+
+class _ShadowOverlay(_ShadowState):
+    """Pending changes to a ValveShadow, without modifying it."""
+
+    def __init__(self, shadow):
+        self.shadow = shadow
+        self.added = {}
+        self.removed = set()
+        self.groups = dict(shadow.groups)
+        self.meters = dict(shadow.meters)
+
+    def _flow_get(self, key):
+        if key in self.added:
+            return self.added[key]
+        if key in self.removed:
+            return None
+        return self.shadow.flows.get(key, None)
+
+    def _flow_put(self, flow):
+        self.added[flow.key] = flow
+        self.removed.discard(flow.key)
+
+    def _flow_remove(self, key):
+        self.added.pop(key, None)
+        if key in self.shadow.flows:
+            self.removed.add(key)
+
+    def _flow_clear(self):
+        self.added = {}
+        self.removed = set(self.shadow.flows.keys())
+
+    def _flow_candidates(self, table_id, del_match_ints):
+        for flow in self.shadow._flow_candidates(table_id, del_match_ints): # pylint: disable=protected-access
+            if flow.key not in self.removed and flow.key not in self.added:
+                yield flow
+        for flow in list(self.added.values()):
+            if table_id in (valve_of.ofp.OFPTT_ALL, flow.table_id):
+                yield flow
+
+
+class ValveShadow(_ShadowState):
+    """Model of the flows, groups and meters installed on a datapath.
+
+    The model is updated with every message sent to the datapath, so that
+    a batch of changes (such as a warm config reload) can be reduced to
+    the minimal add/modify/delete difference against what is installed.
+    """
+
+    def __init__(self):
+        self.flows = {}
+        self.groups = {}
+        self.meters = {}
+        self._table_flows = {}
+        self._flow_index = {}
+        self._deadlines = []
+
+    def reset(self):
+        """Forget all state (e.g. datapath disconnected)."""
+        self.__init__()
+
+    def _index_keys(self, flow):
+        for field, value_mask in flow.match_ints.items():
+            value, mask = value_mask
+            if mask is None:
+                yield (flow.table_id, field, value)
+
+    def _flow_get(self, key):
+        return self.flows.get(key, None)
+
+    def _flow_put(self, flow):
+        if flow.key in self.flows:
+            self._flow_remove(flow.key)
+        self.flows[flow.key] = flow
+        self._table_flows.setdefault(flow.table_id, set()).add(flow.key)
+        for index_key in self._index_keys(flow):
+            self._flow_index.setdefault(index_key, set()).add(flow.key)
+        if flow.deadline is not None:
+            heapq.heappush(self._deadlines, (flow.deadline, flow.key))
+
+    def _flow_remove(self, key):
+        flow = self.flows.pop(key, None)
+        if flow is None:
+            return
+        self._table_flows[flow.table_id].discard(key)
+        for index_key in self._index_keys(flow):
+            index_keys = self._flow_index[index_key]
+            index_keys.discard(key)
+            if not index_keys:
+                del self._flow_index[index_key]
+
+    def _flow_clear(self):
+        self.flows = {}
+        self._table_flows = {}
+        self._flow_index = {}
+        self._deadlines = []
+
+    def _flow_candidates(self, table_id, del_match_ints):
+        if table_id == valve_of.ofp.OFPTT_ALL:
+            table_ids = list(self._table_flows.keys())
+        else:
+            table_ids = [table_id]
+        exact_fields = [
+            (field, value) for field, (value, mask) in del_match_ints.items() if mask is None]
+        for candidate_table_id in table_ids:
+            if exact_fields:
+                index_sets = [
+                    self._flow_index.get((candidate_table_id, field, value), set())
+                    for field, value in exact_fields]
+                keys = min(index_sets, key=len)
+            else:
+                keys = self._table_flows.get(candidate_table_id, set())
+            for key in list(keys):
+                yield self.flows[key]
+
+    def expire(self, now):
+        """Forget flows that the datapath will have expired by timeout.
+
+        Flows with an idle timeout are reported when removed if they have
+        the send flow removed flag, otherwise they are assumed idle.
+        """
+        while self._deadlines and self._deadlines[0][0] < now:
+            deadline, key = heapq.heappop(self._deadlines)
+            flow = self.flows.get(key, None)
+            if flow is not None and flow.deadline == deadline:
+                self._flow_remove(key)
+
+    def flow_removed(self, table_id, match):
+        """Forget flows the datapath reported as removed."""
+        removed_match_ints = match_ints(match)
+        for flow in list(self._flow_candidates(table_id, removed_match_ints)):
+            if flow.match_ints == removed_match_ints:
+                self._flow_remove(flow.key)
+
+    def delta(self, ofmsgs):
+        """Return the minimal OpenFlow messages with the same effect as ofmsgs.
+
+        Flows, groups and meters that ofmsgs would delete and then re-add
+        unchanged are left alone, changed ones are overwritten in place,
+        and only flows that are really removed are deleted.
+
+        Args:
+            ofmsgs (list): OpenFlow messages to reduce.
+        Returns:
+            list: OpenFlow messages.
+        """
+        ordered_ofmsgs = valve_of.valve_flowreorder(ofmsgs, use_barriers=False)
+        if any(valve_of.is_global_flowdel(ofmsg) for ofmsg in ordered_ofmsgs):
+            return ofmsgs
+        now = time.time()
+        overlay = _ShadowOverlay(self)
+        delta_ofmsgs = []
+        flowdels = []
+        for ofmsg in ordered_ofmsgs:
+            if valve_of.is_flowmod(ofmsg):
+                if ofmsg.command == valve_of.ofp.OFPFC_DELETE:
+                    flowdels.append(ofmsg)
+            elif not (valve_of.is_groupmod(ofmsg) or valve_of.is_metermod(ofmsg)):
+                delta_ofmsgs.append(ofmsg)
+                continue
+            overlay.apply_ofmsgs([ofmsg], now=now)
+
+        added_flows = []
+        for key, flow in overlay.added.items():
+            old_flow = self.flows.get(key, None)
+            if old_flow is None or flow.timed() or old_flow.value() != flow.value():
+                added_flows.append(flow)
+        added_keys = {flow.key for flow in added_flows}
+        removed_keys = set(overlay.removed)
+
+        # A delete that doesn't touch any flow we are leaving alone can be
+        # sent as is, which is cheaper than deleting flows one at a time.
+        for flowdel in flowdels:
+            del_match_ints = match_ints(flowdel.match)
+            out_port = flowdel.out_port
+            if out_port is None:
+                out_port = valve_of.ofp.OFPP_ANY
+            collateral = [
+                flow for flow in overlay.matching_flows(flowdel.table_id, del_match_ints, out_port)
+                if flow.key not in added_keys]
+            if collateral:
+                continue
+            deleted_keys = {
+                flow.key for flow in self.matching_flows(
+                    flowdel.table_id, del_match_ints, out_port)}
+            if deleted_keys & removed_keys:
+                delta_ofmsgs.append(flowdel)
+                removed_keys -= deleted_keys
+        delta_ofmsgs.extend([self.flows[key].flowdel() for key in removed_keys])
+        delta_ofmsgs.extend([flow.flowmod() for flow in added_flows])
+
+        delta_ofmsgs.extend(self._groups_meters_delta(overlay.groups, overlay.meters))
+        return delta_ofmsgs
+
+    def _groups_meters_delta(self, groups, meters):
+        """Return messages to change installed groups and meters to groups and meters."""
+        ofmsgs = []
+        for group_id in self.groups.keys() - groups.keys():
+            ofmsgs.append(valve_of.groupdel(group_id=group_id))
+        for group_id, groupmod in groups.items():
+            old_groupmod = self.groups.get(group_id, None)
+            if old_groupmod is None:
+                ofmsgs.append(valve_of.groupadd(
+                    type_=groupmod.type, group_id=group_id, buckets=groupmod.buckets))
+            elif _group_value(old_groupmod) != _group_value(groupmod):
+                ofmsgs.append(valve_of.groupmod(
+                    type_=groupmod.type, group_id=group_id, buckets=groupmod.buckets))
+
+        for meter_id in self.meters.keys() - meters.keys():
+            ofmsgs.append(valve_of.meterdel(meter_id=meter_id))
+        for meter_id, metermod in meters.items():
+            old_metermod = self.meters.get(meter_id, None)
+            if old_metermod is None:
+                ofmsgs.append(metermod)
+            elif _meter_value(old_metermod) != _meter_value(metermod):
+                # Deleting a meter would also delete flows that use it.
+                ofmsgs.append(valve_of.metermod(
+                    meter_id=meter_id, flags=metermod.flags, bands=metermod.bands))
+        return ofmsgs
+
+    def sync(self, ofmsgs, sent=None):
+        """Return messages to make the datapath state as if ofmsgs were applied from scratch.
+
+        Used to reprogram a datapath that already has flows (e.g. after a
+        controller restart), where the shadow was loaded from the datapath.
+
+        Args:
+            ofmsgs (list): OpenFlow messages that would program an empty datapath.
+            sent (ValveShadow): flows sent while the datapath was being read
+                (e.g. learned hosts), which are kept rather than deleted.
+        Returns:
+            list: OpenFlow messages.
+        """
+        now = time.time()
+        kept_keys = set()
+        if sent is not None:
+            for flow in sent.flows.values():
+                self._flow_put(flow)
+            kept_keys = set(sent.flows.keys())
+        target = ValveShadow()
+        sync_ofmsgs = []
+        for ofmsg in valve_of.valve_flowreorder(ofmsgs, use_barriers=False):
+            if (valve_of.is_flowmod(ofmsg) or
+                    valve_of.is_groupmod(ofmsg) or valve_of.is_metermod(ofmsg)):
+                target.apply_ofmsgs([ofmsg], now=now)
+            else:
+                sync_ofmsgs.append(ofmsg)
+        sync_ofmsgs.extend([
+            self.flows[key].flowdel()
+            for key in self.flows.keys() - target.flows.keys() - kept_keys])
+        for key, flow in target.flows.items():
+            old_flow = self.flows.get(key, None)
+            if old_flow is None or flow.timed() or old_flow.value() != flow.value():
+                sync_ofmsgs.append(flow.flowmod())
+        sync_ofmsgs.extend(self._groups_meters_delta(target.groups, target.meters))
+        return sync_ofmsgs
+
+    def load_flow_stats(self, flow_stats):
+        """Add flows reported by a datapath flow stats reply."""
+        now = time.time()
+        for stats in flow_stats:
+            self._flow_put(ShadowFlow(stats, now))
+
+    def load_group_desc_stats(self, group_desc_stats):
+        """Add groups reported by a datapath group description stats reply."""
+        for stats in group_desc_stats:
+            self.groups[stats.group_id] = stats
+
+    def load_meter_config_stats(self, meter_config_stats):
+        """Add meters reported by a datapath meter config stats reply."""
+        for stats in meter_config_stats:
+            self.meters[stats.meter_id] = stats
+
+
+class ValveFlowAudit:
+    """Collect a datapath's existing flows, groups and meters on reconnect.
+
+    Rather than deleting everything and reprogramming, the datapath is
+    asked for its state, which is then compared with what a cold start
+    would send so only the differences need to be sent.
+    """
+
+    def __init__(self, now, ofmsgs, groups=False, meters=False):
+        self.start_time = now
+        self.ofmsgs = ofmsgs
+        self.shadow = ValveShadow()
+        self.requests = {
+            valve_of.parser.OFPFlowStatsReply: valve_of.flow_stats_request()}
+        if groups:
+            self.requests[valve_of.parser.OFPGroupDescStatsReply] = (
+                valve_of.group_desc_stats_request())
+        if meters:
+            self.requests[valve_of.parser.OFPMeterConfigStatsReply] = (
+                valve_of.meter_config_stats_request())
+        self._loaders = {
+            valve_of.parser.OFPFlowStatsReply: self.shadow.load_flow_stats,
+            valve_of.parser.OFPGroupDescStatsReply: self.shadow.load_group_desc_stats,
+            valve_of.parser.OFPMeterConfigStatsReply: self.shadow.load_meter_config_stats,
+        }
+        self._pending = set(self.requests.keys())
+
+    def stats_requests(self):
+        """Return stats requests to send to the datapath."""
+        return list(self.requests.values())
+
+    def is_request_xid(self, xid):
+        """Return True if xid is that of one of our requests."""
+        return xid is not None and xid in {request.xid for request in self.requests.values()}
+
+    def stats_reply(self, msg):
+        """Process a (possibly partial) stats reply.
+
+        Args:
+            msg (ryu.ofproto.ofproto_v1_3_parser.OFPMultipartReply): reply from datapath.
+        Returns:
+            bool: True if all replies have been received.
+        """
+        reply_type = type(msg)
+        if reply_type not in self._pending:
+            return False
+        request = self.requests[reply_type]
+        if request.xid is not None and msg.xid != request.xid:
+            return False
+        self._loaders[reply_type](msg.body)
+        if not msg.flags & valve_of.ofp.OFPMPF_REPLY_MORE:
+            self._pending.remove(reply_type)
+        return not self._pending
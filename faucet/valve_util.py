@@ -16,10 +16,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ctypes
+import ctypes.util
 import logging
 from logging.handlers import WatchedFileHandler
 import os
+import select
 import signal
+import struct
 import sys
 from functools import wraps
 
@@ -79,6 +83,8 @@ DEFAULTS = {
     'FAUCET_EXCEPTION_LOG': _PREFIX + '/var/log/faucet/faucet_exception.log',
     'FAUCET_PROMETHEUS_PORT': '9302',
     'FAUCET_PROMETHEUS_ADDR': '0.0.0.0',
+    'FAUCET_SHARD': '0',
+    'FAUCET_SHARDS': '1',
     'GAUGE_CONFIG': ''.join((
         _PREFIX,
         '/etc/faucet/gauge.yaml',
@@ -184,3 +190,95 @@ def stat_config_files(config_hashes):
             config_file_stat.st_mtime,
             config_file_stat.st_ctime)
     return config_files_stats
+
+
+class Inotify:
+    """Watch files for changes, with Linux inotify.
+
+    The directories containing the files (and the targets of any symlinks)
+    are watched, so files replaced by rename are detected too. Only changes
+    that complete a write (not each modification) are reported.
+    """
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    FILE_EVENTS = (
+        IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+    DIR_EVENTS = IN_DELETE_SELF | IN_MOVE_SELF | IN_Q_OVERFLOW | IN_IGNORED
+    EVENT_HEADER = struct.Struct('iIII')
+    READ_SIZE = 65536
+
+    def __init__(self):
+        """Create an inotify instance, or raise OSError if not supported."""
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify not supported')
+        self._libc = libc
+        self._fd = self._check_errno(libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+        self._wds = {}
+        self._names_by_wd = {}
+
+    @staticmethod
+    def _check_errno(result):
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return result
+
+    def fileno(self):
+        """Return inotify file descriptor, readable when there are changes."""
+        return self._fd
+
+    def watch_files(self, file_names):
+        """Watch only these files for changes (raise OSError if cannot)."""
+        names_by_dir = {}
+        for file_name in file_names:
+            for path in (os.path.abspath(file_name), os.path.realpath(file_name)):
+                dir_name, name = os.path.split(path)
+                names_by_dir.setdefault(dir_name, set()).add(name)
+        for dir_name in set(self._wds) - set(names_by_dir):
+            wd = self._wds.pop(dir_name)
+            del self._names_by_wd[wd]
+            self._libc.inotify_rm_watch(self._fd, wd)
+        for dir_name, names in names_by_dir.items():
+            wd = self._wds.get(dir_name, None)
+            if wd is None:
+                wd = self._check_errno(self._libc.inotify_add_watch(
+                    self._fd, os.fsencode(dir_name), self.FILE_EVENTS))
+                self._wds[dir_name] = wd
+            self._names_by_wd[wd] = frozenset(names)
+
+    def changed(self):
+        """Return True if watched files changed since last called (does not block)."""
+        changed = False
+        # os.read() may be eventlet's, which waits rather than fail if
+        # there are no events, so read only when events are ready.
+        while select.select([self._fd], [], [], 0)[0]:
+            events = os.read(self._fd, self.READ_SIZE)
+            offset = 0
+            while offset < len(events):
+                wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(events, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(events[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+                if mask & self.IN_IGNORED:
+                    # Watch removed, e.g. directory deleted.
+                    for dir_name, dir_wd in list(self._wds.items()):
+                        if dir_wd == wd:
+                            del self._wds[dir_name]
+                    self._names_by_wd.pop(wd, None)
+                if mask & self.DIR_EVENTS or name in self._names_by_wd.get(wd, ()):
+                    changed = True
+        return changed
+
+    def close(self):
+        """Close inotify instance."""
+        os.close(self._fd)
@@ -17,13 +17,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
+import random
+
 from collections import defaultdict
 
 from faucet.conf import InvalidConfigError
 from faucet.config_parser_util import config_changed, CONFIG_HASH_FUNC
 from faucet.config_parser import dp_parser
 from faucet.valve import valve_factory, SUPPORTED_HARDWARE
-from faucet.valve_util import dpid_log, stat_config_files
+from faucet.valve_util import dpid_log, stat_config_files, Inotify
+from faucet.vlan import EdgeHostIndex
 
 
 class ConfigWatcher:
@@ -32,10 +36,49 @@ class ConfigWatcher:
     config_file = None
     config_hashes = None
     config_file_stats = None
+    inotify = None
+    poll = False
+
+    def watch(self):
+        """Watch config files for changes with inotify, if available.
+
+        Returns:
+            int: file descriptor readable when config files may have changed,
+                or None if config files must be polled.
+        """
+        if self.poll:
+            return None
+        if self.inotify is None:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                self.poll = True
+                return None
+            if self.config_hashes and self.config_file_stats is None:
+                self.config_file_stats = stat_config_files(self.config_hashes)
+            self._watch_files()
+        if self.poll:
+            return None
+        return self.inotify.fileno()
+
+    def _watch_files(self):
+        """Update inotify watches to the current config files, else revert to polling."""
+        if self.inotify is None or not self.config_hashes:
+            return
+        try:
+            self.inotify.watch_files(self.config_hashes)
+        except OSError:
+            self.inotify.close()
+            self.inotify = None
+            self.poll = True
 
     def files_changed(self):
         """Return True if any config files changed."""
-        # TODO: Better to use an inotify method that doesn't conflict with eventlets.
+        if self.inotify is not None:
+            if not self.inotify.changed():
+                return False
+            # Files may have been replaced, so refresh watches.
+            self._watch_files()
         changed = False
         if self.config_hashes:
             new_config_file_stats = stat_config_files(self.config_hashes)
@@ -52,21 +95,58 @@ class ConfigWatcher:
         """Return True if config file content actually changed."""
         return config_changed(self.config_file, new_config_file, self.config_hashes)
 
+    def close(self):
+        """Stop watching config files with inotify."""
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
     def update(self, new_config_file, new_config_hashes=None):
         """Update state with new config file/hashes."""
         self.config_file = new_config_file
         if new_config_hashes is None:
             new_config_hashes = {new_config_file: None}
         self.config_hashes = new_config_hashes
+        self._watch_files()
+
+
+def dp_shard(dp, shards):
+    """Return shard number for a DP.
+
+    All DPs in a stack share their root DP's shard, as stacked Valves
+    need the state of the other Valves in the stack.
+    """
+    shard_dp_id = dp.dp_id
+    if dp.stack and 'root_dp' in dp.stack:
+        shard_dp_id = dp.stack['root_dp'].dp_id
+    return shard_dp_id % shards
 
 
 class ValvesManager:
     """Manage a collection of Valves."""
 
+    # Periodic Valve services, and how often each is called on each Valve.
+    VALVE_SERVICE_INTERVALS = {
+        'resolve_gateways': 2,
+        'state_expire': 5,
+        'fast_state_expire': 2,
+        'advertise': 15,
+        'fast_advertise': 5,
+    }
+    # Services whose interval is at least a configured DP interval.
+    VALVE_SERVICE_DP_INTERVALS = {
+        'advertise': 'advertise_interval',
+        'fast_advertise': 'fast_advertise_interval',
+    }
+    # Services only scheduled on Valves for which a method returns True.
+    VALVE_SERVICE_NEEDED = {
+        'resolve_gateways': 'routing_active',
+    }
+
     valves = None # type: dict
 
     def __init__(self, logname, logger, metrics, notifier, bgp,
-                 dot1x, send_flows_to_dp_by_id):
+                 dot1x, send_flows_to_dp_by_id, shard=0, shards=1):
         """Initialize ValvesManager.
 
         Args:
@@ -76,7 +156,11 @@ class ValvesManager:
             notifier (FaucetEvent): event notifier instance.
             bgp (FaucetBgp): BGP instance.
             send_flows_to_dp_by_id: callable, two args - DP ID and list of flows to send to DP.
+            shard (int): shard of DPs managed by this instance.
+            shards (int): total number of shards (instances) DPs are partitioned across.
         """
+        if shards < 1 or not 0 <= shard < shards:
+            raise ValueError('invalid shard %s of %s shards' % (shard, shards))
         self.logname = logname
         self.logger = logger
         self.metrics = metrics
@@ -84,9 +168,15 @@ class ValvesManager:
         self.bgp = bgp
         self.dot1x = dot1x
         self.send_flows_to_dp_by_id = send_flows_to_dp_by_id
+        self.shard = shard
+        self.shards = shards
         self.valves = {}
+        self.edge_host_index = EdgeHostIndex()
         self.config_applied = {}
         self.config_watcher = ConfigWatcher()
+        self._service_due = {}
+        self._service_heap = []
+        self.metrics.learned_hosts.dps_func = self._dps
 
     def parse_configs(self, new_config_file):
         """Return parsed configs for Valves, or None."""
@@ -108,12 +198,24 @@ class ValvesManager:
                 dict(config_files=new_config_file, hashes=''))
             self.metrics.faucet_config_load_error.set(1)
             return None
-        return new_dps
+        return self._shard_dps(new_dps)
+
+    def _shard_dps(self, dps):
+        """Return only DPs in this instance's shard."""
+        if self.shards == 1:
+            return dps
+        shard_dps = [dp for dp in dps if dp_shard(dp, self.shards) == self.shard]
+        self.logger.info(
+            'shard %u of %u managing %u of %u DPs',
+            self.shard, self.shards, len(shard_dps), len(dps))
+        return shard_dps
 
     def new_valve(self, new_dp):
         valve_cl = valve_factory(new_dp)
         if valve_cl is not None:
-            return valve_cl(new_dp, self.logname, self.metrics, self.notifier, self.dot1x)
+            return valve_cl(
+                new_dp, self.logname, self.metrics, self.notifier, self.dot1x,
+                edge_host_index=self.edge_host_index)
         self.logger.error(
             '%s hardware %s must be one of %s',
             new_dp.name,
@@ -146,10 +248,12 @@ class ValvesManager:
                     continue
             valve.update_config_metrics()
             self.valves[dp_id] = valve
+            self._schedule_valve_services(now, valve)
         if delete_dp is not None:
             for deleted_dp in deleted_dpids:
                 delete_dp(deleted_dp)
                 del self.valves[deleted_dp]
+                self.edge_host_index.remove_dp(deleted_dp)
         self.bgp.reset(self.valves)
         self.dot1x.reset(self.valves)
         self.update_config_applied(sent)
@@ -178,22 +282,90 @@ class ValvesManager:
     def update_metrics(self, now):
         """Update metrics in all Valves."""
         for valve in self.valves.values():
-            valve.update_metrics(now, rate_limited=False)
+            valve.update_metrics(now)
         self.bgp.update_metrics(now)
 
     def valve_flow_services(self, now, valve_service):
-        """Call a method on all Valves and send any resulting flows."""
+        """Call a method on all Valves now and send any resulting flows."""
         ofmsgs_by_valve = defaultdict(list)
         for valve in self.valves.values():
-            other_valves = self._other_running_valves(valve)
+            self._call_valve_service(now, valve, valve_service, ofmsgs_by_valve)
+        self._send_ofmsgs_by_valve(ofmsgs_by_valve)
+
+    def _valve_service_interval(self, valve, valve_service):
+        needed_method = self.VALVE_SERVICE_NEEDED.get(valve_service, None)
+        if needed_method is not None and not getattr(valve, needed_method)():
+            return None
+        interval = self.VALVE_SERVICE_INTERVALS[valve_service]
+        dp_interval_attr = self.VALVE_SERVICE_DP_INTERVALS.get(valve_service, None)
+        if dp_interval_attr is not None:
+            dp_interval = getattr(valve.dp, dp_interval_attr)
+            if not dp_interval:
+                return None
+            interval = max(interval, dp_interval)
+        return interval
+
+    def _schedule_valve_service(self, due, valve, valve_service):
+        dp_id = valve.dp.dp_id
+        self._service_due[(dp_id, valve_service)] = due
+        heapq.heappush(self._service_heap, (due, dp_id, valve_service))
+
+    def _schedule_valve_services(self, now, valve):
+        """Schedule all services on a new or reconfigured Valve, spread over their intervals."""
+        for valve_service in self.VALVE_SERVICE_INTERVALS:
+            key = (valve.dp.dp_id, valve_service)
+            interval = self._valve_service_interval(valve, valve_service)
+            if interval is None:
+                self._service_due.pop(key, None)
+                continue
+            due = self._service_due.get(key, None)
+            if due is None or due > now + interval:
+                self._schedule_valve_service(
+                    now + (random.random() * interval), valve, valve_service)
+
+    def valve_services_next_due(self):
+        """Return time the next Valve service is due, or None."""
+        if self._service_heap:
+            return self._service_heap[0][0]
+        return None
+
+    def valve_flow_services_due(self, now):
+        """Call Valve services that are due and send any resulting flows."""
+        ofmsgs_by_valve = defaultdict(list)
+        service_heap = self._service_heap
+        while service_heap and service_heap[0][0] <= now:
+            due, dp_id, valve_service = heapq.heappop(service_heap)
+            key = (dp_id, valve_service)
+            # Skip services rescheduled or on deleted Valves.
+            if self._service_due.get(key, None) != due:
+                continue
+            valve = self.valves.get(dp_id, None)
+            if valve is None:
+                del self._service_due[key]
+                continue
+            interval = self._valve_service_interval(valve, valve_service)
+            if interval is None:
+                del self._service_due[key]
+                continue
             valve_service_labels = dict(valve.dp.base_prom_labels(), valve_service=valve_service)
-            valve_service_func = getattr(valve, valve_service)
-            with self.metrics.faucet_valve_service_secs.labels( # pylint: disable=no-member
-                    **valve_service_labels).time():
-                for service_valve, ofmsgs in valve_service_func(now, other_valves).items():
-                    ofmsgs_by_valve[service_valve].extend(ofmsgs)
+            self.metrics.faucet_valve_service_lateness_secs.labels( # pylint: disable=no-member
+                **valve_service_labels).observe(now - due)
+            self._call_valve_service(now, valve, valve_service, ofmsgs_by_valve)
+            self._schedule_valve_service(now + interval, valve, valve_service)
         self._send_ofmsgs_by_valve(ofmsgs_by_valve)
 
+    def _call_valve_service(self, now, valve, valve_service, ofmsgs_by_valve):
+        other_valves = self._other_running_valves(valve)
+        valve_service_labels = dict(valve.dp.base_prom_labels(), valve_service=valve_service)
+        valve_service_func = getattr(valve, valve_service)
+        with self.metrics.faucet_valve_service_secs.labels( # pylint: disable=no-member
+                **valve_service_labels).time():
+            for service_valve, ofmsgs in valve_service_func(now, other_valves).items():
+                ofmsgs_by_valve[service_valve].extend(ofmsgs)
+
+    def _dps(self):
+        return [valve.dp for valve in list(self.valves.values())]
+
     def _other_running_valves(self, valve):
         return [other_valve for other_valve in self.valves.values()
                 if valve != other_valve and other_valve.dp.dyn_running]
@@ -206,21 +378,17 @@ class ValvesManager:
 
     def valve_packet_in(self, now, valve, msg):
         """Time a call to Valve packet in handler."""
-        self.metrics.of_packet_ins.labels( # pylint: disable=no-member
-            **valve.dp.base_prom_labels()).inc()
-        if valve.rate_limit_packet_ins(now):
-            return
+        valve.dp_metrics.of_packet_ins.inc()
         pkt_meta = valve.parse_pkt_meta(msg)
         if pkt_meta is None:
-            self.metrics.of_unexpected_packet_ins.labels( # pylint: disable=no-member
-                **valve.dp.base_prom_labels()).inc()
+            valve.dp_metrics.of_unexpected_packet_ins.inc()
+            return
+        if not valve.admit_packet_in(now, pkt_meta):
             return
-        with self.metrics.faucet_packet_in_secs.labels( # pylint: disable=no-member
-                **valve.dp.base_prom_labels()).time():
+        with valve.dp_metrics.faucet_packet_in_secs.time():
             ofmsgs_by_valve = valve.rcv_packet(now, self._other_running_valves(valve), pkt_meta)
         if ofmsgs_by_valve:
             self._send_ofmsgs_by_valve(ofmsgs_by_valve)
-            valve.update_metrics(now, pkt_meta.port, rate_limited=True)
 
 
     def update_config_applied(self, sent=None, reset=False):
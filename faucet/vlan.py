@@ -16,7 +16,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
 import collections
+import heapq
 import ipaddress
 import random
 import netaddr
@@ -25,6 +27,7 @@ from faucet import valve_of
 from faucet.conf import Conf, test_config_condition, InvalidConfigError
 from faucet.faucet_pipeline import STACK_LOOP_PROTECT_FIELD
 from faucet.valve_packet import FAUCET_MAC
+from faucet.valve_rib import Rib
 
 
 class NullVLAN:
@@ -52,11 +55,13 @@ class HostCacheEntry:
         'port',
     ]
 
-    def __init__(self, eth_src, port, cache_time):
+    def __init__(self, eth_src, port, cache_time, eth_src_int=None):
         self.eth_src = eth_src
         self.port = port
         self.cache_time = cache_time
-        self.eth_src_int = int(eth_src.replace(':', ''), 16)
+        if eth_src_int is None:
+            eth_src_int = int(eth_src.replace(':', ''), 16)
+        self.eth_src_int = eth_src_int
 
     def __hash__(self):
         return hash((self.eth_src_int, self.port.number))
@@ -74,6 +79,289 @@ class HostCacheEntry:
         return self.__hash__() < other.__hash__()
 
 
+class HostCache:
+    """Compact table of hosts learned on a VLAN.
+
+    Hosts are stored by slot as arrays of integer MAC, port number and
+    cache time, with Port objects interned by port number. HostCacheEntry
+    objects are created only when hosts are looked up.
+    """
+
+    __slots__ = [
+        '_by_expiry',
+        '_by_port',
+        '_cache_times',
+        '_eth_src_ints',
+        '_expiry_heap',
+        '_free_slots',
+        '_port_nos',
+        '_ports',
+        '_slots',
+    ]
+
+    def __init__(self):
+        self._slots = {}
+        self._eth_src_ints = array.array('Q')
+        self._port_nos = array.array('I')
+        self._cache_times = array.array('d')
+        self._free_slots = []
+        self._ports = {}
+        self._by_port = {}
+        self._by_expiry = {}
+        self._expiry_heap = []
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, eth_src):
+        return self._eth_src_int(eth_src) in self._slots
+
+    @staticmethod
+    def _eth_src_int(eth_src):
+        return int(eth_src.replace(':', ''), 16)
+
+    def _entry(self, slot):
+        eth_src_int = self._eth_src_ints[slot]
+        eth_src = ':'.join(['%02x' % i for i in eth_src_int.to_bytes(6, 'big')])
+        return HostCacheEntry(
+            eth_src,
+            self._ports[self._port_nos[slot]],
+            self._cache_times[slot],
+            eth_src_int=eth_src_int)
+
+    def _index(self, slot):
+        port_no = self._port_nos[slot]
+        port_slots = self._by_port.get(port_no, None)
+        if port_slots is None:
+            port_slots = set()
+            self._by_port[port_no] = port_slots
+        port_slots.add(slot)
+        # Bucket by second of cache time, for expiry.
+        bucket = int(self._cache_times[slot])
+        bucket_slots = self._by_expiry.get(bucket, None)
+        if bucket_slots is None:
+            bucket_slots = set()
+            self._by_expiry[bucket] = bucket_slots
+            heapq.heappush(self._expiry_heap, bucket)
+        bucket_slots.add(slot)
+
+    def _unindex(self, slot):
+        port_no = self._port_nos[slot]
+        self._by_port[port_no].discard(slot)
+        # Empty expiry buckets are removed on expiry.
+        bucket_slots = self._by_expiry.get(int(self._cache_times[slot]), None)
+        if bucket_slots is not None:
+            bucket_slots.discard(slot)
+
+    def get(self, eth_src):
+        """Return host cache entry or None."""
+        slot = self._slots.get(self._eth_src_int(eth_src), None)
+        if slot is None:
+            return None
+        return self._entry(slot)
+
+    def values(self):
+        """Yield all host cache entries."""
+        for slot in self._slots.values():
+            yield self._entry(slot)
+
+    def add(self, eth_src, port, cache_time):
+        """Add/update a host on a port at a time, return True if a new host."""
+        self._ports[port.number] = port
+        eth_src_int = self._eth_src_int(eth_src)
+        slot = self._slots.get(eth_src_int, None)
+        if slot is not None:
+            self._unindex(slot)
+            self._port_nos[slot] = port.number
+            self._cache_times[slot] = cache_time
+            self._index(slot)
+            return False
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._eth_src_ints[slot] = eth_src_int
+            self._port_nos[slot] = port.number
+            self._cache_times[slot] = cache_time
+        else:
+            slot = len(self._eth_src_ints)
+            self._eth_src_ints.append(eth_src_int)
+            self._port_nos.append(port.number)
+            self._cache_times.append(cache_time)
+        self._slots[eth_src_int] = slot
+        self._index(slot)
+        return True
+
+    def remove(self, eth_src):
+        """Remove a host, returning its host cache entry or None."""
+        return self._remove_slot(self._slots.get(self._eth_src_int(eth_src), None))
+
+    def _remove_slot(self, slot):
+        if slot is None:
+            return None
+        entry = self._entry(slot)
+        del self._slots[self._eth_src_ints[slot]]
+        self._unindex(slot)
+        self._free_slots.append(slot)
+        return entry
+
+    def hosts_on_port(self, port_no):
+        """Return tuple of host cache entries on a port."""
+        return tuple([self._entry(slot) for slot in self._by_port.get(port_no, ())])
+
+    def hosts_count_on_port(self, port_no):
+        """Return count of hosts on a port."""
+        port_slots = self._by_port.get(port_no, None)
+        if port_slots is None:
+            return 0
+        return len(port_slots)
+
+    def expire(self, min_cache_time):
+        """Remove and return hosts cached before a time, unless permanently learned."""
+        expired_hosts = []
+        expiry_heap = self._expiry_heap
+        # Only visit buckets that hold at least some expired hosts.
+        while expiry_heap and expiry_heap[0] <= min_cache_time:
+            bucket = expiry_heap[0]
+            for slot in list(self._by_expiry[bucket]):
+                if self._cache_times[slot] >= min_cache_time:
+                    continue
+                if self._ports[self._port_nos[slot]].permanent_learn:
+                    continue
+                expired_hosts.append(self._remove_slot(slot))
+            if bucket + 1 > min_cache_time:
+                # Rest of this bucket is not yet expired.
+                break
+            # Hosts remaining are permanently learned, so need not be visited again.
+            heapq.heappop(expiry_heap)
+            del self._by_expiry[bucket]
+        return expired_hosts
+
+
+class EdgeHostIndex:
+    """Hosts learned on edge (not stack) ports, by VLAN and MAC, across all DPs in a stack.
+
+    So a DP receiving a packet on a stack port can find the DP the host is
+    attached to, without looking in every other DP's host cache.
+    """
+
+    __slots__ = [
+        '_dp_names',
+        '_edge_hosts',
+        '_eth_srcs_by_dp_vlan',
+    ]
+
+    def __init__(self):
+        self._dp_names = {}
+        self._edge_hosts = {}
+        self._eth_srcs_by_dp_vlan = collections.defaultdict(set)
+
+    def __len__(self):
+        return len(self._edge_hosts)
+
+    def add_dp(self, dp_id, dp_name):
+        """Add a DP whose hosts are indexed."""
+        self._dp_names[dp_id] = dp_name
+
+    def remove_dp(self, dp_id):
+        """Remove a DP and all its hosts."""
+        for dp_vlan in [dp_vlan for dp_vlan in self._eth_srcs_by_dp_vlan if dp_vlan[0] == dp_id]:
+            self.remove_vlan(*dp_vlan)
+        self._dp_names.pop(dp_id, None)
+
+    def remove_vlan(self, dp_id, vid):
+        """Remove all hosts on a VLAN on a DP."""
+        for eth_src in self._eth_srcs_by_dp_vlan.pop((dp_id, vid), ()):
+            edge_ports = self._edge_hosts[(vid, eth_src)]
+            del edge_ports[dp_id]
+            if not edge_ports:
+                del self._edge_hosts[(vid, eth_src)]
+
+    def add(self, dp_id, vid, eth_src, port):
+        """Add or move a host learned on an edge port of a DP."""
+        self._edge_hosts.setdefault((vid, eth_src), {})[dp_id] = port
+        self._eth_srcs_by_dp_vlan[(dp_id, vid)].add(eth_src)
+
+    def remove(self, dp_id, vid, eth_src):
+        """Remove a host from a DP."""
+        edge_ports = self._edge_hosts.get((vid, eth_src), None)
+        if edge_ports is None or dp_id not in edge_ports:
+            return
+        del edge_ports[dp_id]
+        if not edge_ports:
+            del self._edge_hosts[(vid, eth_src)]
+        eth_srcs = self._eth_srcs_by_dp_vlan[(dp_id, vid)]
+        eth_srcs.discard(eth_src)
+        if not eth_srcs:
+            del self._eth_srcs_by_dp_vlan[(dp_id, vid)]
+
+    def edge_dp(self, vid, eth_src, exclude_dp_id=None):
+        """Return name of a DP (other than an excluded DP) with a host on an edge port, or None."""
+        for dp_id in self._edge_hosts.get((vid, eth_src), ()):
+            if dp_id != exclude_dp_id:
+                return self._dp_names.get(dp_id, None)
+        return None
+
+
+class NextHopQueue:
+    """Gateways, in order of the time they are next due to be resolved.
+
+    A gateway is queued at most once; rescheduling it supersedes its
+    previous due time, which is discarded lazily when popped.
+    """
+
+    __slots__ = [
+        '_due_times',
+        '_heap',
+    ]
+
+    def __init__(self):
+        self._due_times = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._due_times)
+
+    def __contains__(self, ip_gw):
+        return ip_gw in self._due_times
+
+    def schedule(self, ip_gw, due_time):
+        """Queue a gateway to be resolved at a time."""
+        if self._due_times.get(ip_gw, None) == due_time:
+            return
+        self._due_times[ip_gw] = due_time
+        heapq.heappush(self._heap, (due_time, ip_gw))
+
+    def unschedule(self, ip_gw):
+        """Remove a gateway from the queue."""
+        self._due_times.pop(ip_gw, None)
+
+    def pop_due(self, now):
+        """Remove and return (due time, gateway) for the earliest gateway due before now, or None."""
+        heap = self._heap
+        while heap and heap[0][0] < now:
+            due_time, ip_gw = heapq.heappop(heap)
+            if self._due_times.get(ip_gw, None) == due_time:
+                del self._due_times[ip_gw]
+                return (due_time, ip_gw)
+        return None
+
+    def due_count(self, now):
+        """Return number of gateways due before now."""
+        heap = self._heap
+        count = 0
+        # Only visit the part of the heap due before now.
+        indexes = [0] if heap else []
+        while indexes:
+            index = indexes.pop()
+            due_time, ip_gw = heap[index]
+            if due_time >= now:
+                continue
+            if self._due_times.get(ip_gw, None) == due_time:
+                count += 1
+            indexes.extend([
+                child for child in (2 * index + 1, 2 * index + 2) if child < len(heap)])
+        return count
+
+
 class VLAN(Conf):
     """Contains state for one VLAN, including its configuration."""
 
@@ -162,15 +450,12 @@ class VLAN(Conf):
         self.dot1x_untagged = []
 
         self.dyn_host_cache = None
-        self.dyn_host_cache_by_port = None
-        self.dyn_host_cache_stats_stale = None
+        self.dyn_edge_host_index = None
         self.dyn_last_time_hosts_expired = None
         self.dyn_learn_ban_count = 0
         self.dyn_neigh_cache_by_ipv = None
-        self.dyn_oldest_host_time = None
-        self.dyn_last_updated_metrics_sec = None
 
-        self.dyn_routes_by_ipv = collections.defaultdict(dict)
+        self.dyn_routes_by_ipv = collections.defaultdict(Rib)
         self.dyn_gws_by_ipv = collections.defaultdict(dict)
         self.dyn_host_gws_by_ipv = collections.defaultdict(set)
         self.dyn_route_gws_by_ipv = collections.defaultdict(set)
@@ -245,12 +530,18 @@ class VLAN(Conf):
 
     def reset_caches(self):
         """Reset dynamic caches."""
-        self.dyn_host_cache = {}
-        self.dyn_host_cache_by_port = {}
-        self.dyn_host_cache_stats_stale = {}
+        if self.dyn_edge_host_index is not None:
+            self.dyn_edge_host_index.remove_vlan(self.dp_id, self.vid)
+        self.dyn_host_cache = HostCache()
         self.dyn_neigh_cache_by_ipv = collections.defaultdict(dict)
-        self.dyn_unresolved_route_ip_gws = collections.defaultdict(list)
-        self.dyn_unresolved_host_ip_gws = collections.defaultdict(list)
+        self.dyn_route_gw_queue_by_ipv = collections.defaultdict(NextHopQueue)
+        self.dyn_host_gw_queue_by_ipv = collections.defaultdict(NextHopQueue)
+        for ipv, ip_gws in self.dyn_route_gws_by_ipv.items():
+            for ip_gw in ip_gws:
+                self.dyn_route_gw_queue_by_ipv[ipv].schedule(ip_gw, 0)
+        for ipv, ip_gws in self.dyn_host_gws_by_ipv.items():
+            for ip_gw in ip_gws:
+                self.dyn_host_gw_queue_by_ipv[ipv].schedule(ip_gw, 0)
 
     def reset_ports(self, ports):
         """Reset tagged and untagged port lists."""
@@ -263,42 +554,30 @@ class VLAN(Conf):
 
     def add_cache_host(self, eth_src, port, cache_time):
         """Add/update a host to the cache on a port at at time."""
-        existing_entry = self.cached_host(eth_src)
-        if existing_entry is None:
-            self.dyn_host_cache_stats_stale[port.number] = True
-        else:
-            self.dyn_host_cache_by_port[existing_entry.port.number].remove(
-                existing_entry)
-        entry = HostCacheEntry(eth_src, port, cache_time)
-        if port.number not in self.dyn_host_cache_by_port:
-            self.dyn_host_cache_by_port[port.number] = set()
-        self.dyn_host_cache_by_port[port.number].add(entry)
-        self.dyn_host_cache[eth_src] = entry
+        self.dyn_host_cache.add(eth_src, port, cache_time)
+        if self.dyn_edge_host_index is not None:
+            if port.stack:
+                self.dyn_edge_host_index.remove(self.dp_id, self.vid, eth_src)
+            else:
+                self.dyn_edge_host_index.add(self.dp_id, self.vid, eth_src, port)
 
     def expire_cache_host(self, eth_src):
         """Expire a host from caches."""
-        entry = self.cached_host(eth_src)
-        if entry is not None:
-            self.dyn_host_cache_stats_stale[entry.port.number] = True
-            self.dyn_host_cache_by_port[entry.port.number].remove(entry)
-            del self.dyn_host_cache[eth_src]
+        self.dyn_host_cache.remove(eth_src)
+        if self.dyn_edge_host_index is not None:
+            self.dyn_edge_host_index.remove(self.dp_id, self.vid, eth_src)
 
     def cached_hosts_on_port(self, port):
         """Return all hosts learned on a port."""
-        if port.number in self.dyn_host_cache_by_port:
-            return list(self.dyn_host_cache_by_port[port.number])
-        return []
+        return self.dyn_host_cache.hosts_on_port(port.number)
 
     def cached_hosts_count_on_port(self, port):
         """Return count of all hosts learned on a port."""
-        hosts_count = 0
-        if port.number in self.dyn_host_cache_by_port:
-            hosts_count = len(self.dyn_host_cache_by_port[port.number])
-        return hosts_count
+        return self.dyn_host_cache.hosts_count_on_port(port.number)
 
     def cached_host(self, eth_src):
         """Return host from cache or None."""
-        return self.dyn_host_cache.get(eth_src, None)
+        return self.dyn_host_cache.get(eth_src)
 
     def cached_host_on_port(self, eth_src, port):
         """Return host cache entry if host in cache and on specified port."""
@@ -314,21 +593,22 @@ class VLAN(Conf):
 
     def expire_cache_hosts(self, now, learn_timeout):
         """Expire stale host entries."""
-        expired_hosts = []
-        min_cache_time = now - learn_timeout
-
-        if self.dyn_oldest_host_time is None or self.dyn_oldest_host_time < min_cache_time:
-            expired_hosts = [
-                entry for entry in self.dyn_host_cache.values()
-                if entry.cache_time < min_cache_time and not entry.port.permanent_learn]
+        expired_hosts = self.dyn_host_cache.expire(now - learn_timeout)
+        if self.dyn_edge_host_index is not None:
             for entry in expired_hosts:
-                self.expire_cache_host(entry.eth_src)
-            self.dyn_oldest_host_time = now
-            if self.dyn_host_cache:
-                self.dyn_oldest_host_time = min(
-                    [entry.cache_time for entry in self.dyn_host_cache.values()])
+                self.dyn_edge_host_index.remove(self.dp_id, self.vid, entry.eth_src)
         return expired_hosts
 
+    def index_edge_hosts(self, edge_host_index):
+        """Index hosts on edge ports of this VLAN (and any later learned), in a stack wide index."""
+        self.dyn_edge_host_index = edge_host_index
+        if edge_host_index is not None:
+            edge_host_index.remove_vlan(self.dp_id, self.vid)
+            for port in self.get_ports():
+                if not port.stack:
+                    for entry in self.cached_hosts_on_port(port):
+                        edge_host_index.add(self.dp_id, self.vid, entry.eth_src, port)
+
     def faucet_vips_by_ipv(self, ipv):
         """Return VIPs with specified IP version on this VLAN."""
         return self._by_ipv(self.faucet_vips, ipv)
@@ -360,20 +640,27 @@ class VLAN(Conf):
         Returns:
             True if a host FIB route (and not used as a gateway).
         """
-        ip_dsts = self.ip_dsts_for_ip_gw(host_ip)
-        if (len(ip_dsts) == 1 and
-                ip_dsts[0].prefixlen == ip_dsts[0].max_prefixlen and
-                ip_dsts[0].network_address == host_ip):
-            return True
-        return False
+        ip_dsts = self.dyn_gws_by_ipv[host_ip.version].get(host_ip, None)
+        if ip_dsts is None or len(ip_dsts) != 1:
+            return False
+        ip_dst = next(iter(ip_dsts))
+        return ip_dst.prefixlen == ip_dst.max_prefixlen and ip_dst.network_address == host_ip
 
     def _update_gw_types(self, ip_gw):
+        host_gws = self.dyn_host_gws_by_ipv[ip_gw.version]
+        route_gws = self.dyn_route_gws_by_ipv[ip_gw.version]
+        host_queue = self.dyn_host_gw_queue_by_ipv[ip_gw.version]
+        route_queue = self.dyn_route_gw_queue_by_ipv[ip_gw.version]
         if self.is_host_fib_route(ip_gw):
-            self.dyn_host_gws_by_ipv[ip_gw.version].add(ip_gw)
-            self.dyn_route_gws_by_ipv[ip_gw.version] -= set([ip_gw])
+            gws, queue, other_gws, other_queue = host_gws, host_queue, route_gws, route_queue
         else:
-            self.dyn_route_gws_by_ipv[ip_gw.version].add(ip_gw)
-            self.dyn_host_gws_by_ipv[ip_gw.version] -= set([ip_gw])
+            gws, queue, other_gws, other_queue = route_gws, route_queue, host_gws, host_queue
+        if ip_gw not in gws:
+            gws.add(ip_gw)
+            # Due immediately, to be resolved as this type of gateway.
+            queue.schedule(ip_gw, 0)
+        other_gws.discard(ip_gw)
+        other_queue.unschedule(ip_gw)
 
     def add_route(self, ip_dst, ip_gw):
         """Add an IP route."""
@@ -398,6 +685,10 @@ class VLAN(Conf):
             return list(self.dyn_gws_by_ipv[ip_gw.version][ip_gw])
         return []
 
+    def is_ip_gw(self, ip_gw):
+        """Return True if IP address is the gateway of any route."""
+        return ip_gw in self.dyn_gws_by_ipv[ip_gw.version]
+
     def all_ip_gws(self, ipv):
         """Return all IP gateways for specified IP version."""
         return frozenset(self.dyn_gws_by_ipv[ipv].keys())
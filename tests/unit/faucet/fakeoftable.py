@@ -18,6 +18,8 @@ from ryu.ofproto import ofproto_v1_3 as ofp
 from ryu.ofproto import ofproto_v1_3_parser as parser
 from ryu.lib import addrconv
 
+from faucet import valve_of
+
 
 class FakeOFTableException(Exception):
 
@@ -36,6 +38,7 @@ class FakeOFTable:
         self.groups = {}
         self.requires_tfm = requires_tfm
         self.tfm = {}
+        self.bundles = {}
 
     def _apply_groupmod(self, ofmsg):
         """Maintain group table."""
@@ -150,6 +153,18 @@ class FakeOFTable:
         for table in tables:
             _flowmod_handlers[ofmsg.command](table, flowmod)
 
+    def _apply_bundlectrl(self, ofmsg):
+        """Stage bundled messages and apply them on commit."""
+        bundle_id = ofmsg.bundle_id
+        if ofmsg.type == ofp.ONF_BCT_OPEN_REQUEST:
+            if bundle_id in self.bundles:
+                raise FakeOFTableException('bundle %u already open' % bundle_id)
+            self.bundles[bundle_id] = []
+        elif ofmsg.type == ofp.ONF_BCT_COMMIT_REQUEST:
+            self.apply_ofmsgs(self.bundles.pop(bundle_id))
+        elif ofmsg.type == ofp.ONF_BCT_DISCARD_REQUEST:
+            del self.bundles[bundle_id]
+
     def _apply_tfm(self, ofmsg):
         for body in ofmsg.body:
             self.tfm[body.table_id] = body
@@ -157,6 +172,7 @@ class FakeOFTable:
     def apply_ofmsgs(self, ofmsgs):
         """Update state of test flow tables."""
         for ofmsg in ofmsgs:
+            ofmsg = valve_of.to_ryu_ofmsg(ofmsg)
             if isinstance(ofmsg, parser.OFPBarrierRequest):
                 continue
             if isinstance(ofmsg, parser.OFPPacketOut):
@@ -170,6 +186,14 @@ class FakeOFTable:
             if isinstance(ofmsg, parser.OFPMeterMod):
                 # TODO: handle OFPMeterMod
                 continue
+            if isinstance(ofmsg, parser.ONFBundleCtrlMsg):
+                self._apply_bundlectrl(ofmsg)
+                continue
+            if isinstance(ofmsg, parser.ONFBundleAddMsg):
+                if ofmsg.bundle_id not in self.bundles:
+                    raise FakeOFTableException('bundle %u not open' % ofmsg.bundle_id)
+                self.bundles[ofmsg.bundle_id].append(ofmsg.message)
+                continue
             if isinstance(ofmsg, parser.OFPTableFeaturesStatsRequest):
                 self._apply_tfm(ofmsg)
                 continue
@@ -338,6 +362,7 @@ class FlowMod:
 
     def __init__(self, flowmod):
         """flowmod is a ryu flow modification message object"""
+        self.flowmod = flowmod
         self.priority = flowmod.priority
         self.instructions = flowmod.instructions
         self.validate_instructions()
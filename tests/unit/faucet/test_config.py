@@ -852,6 +852,61 @@ dps:
         dp = dps[0]
         self.assertEqual(len(dp.ports), 1)
 
+    def test_include_reparse(self):
+        """Test changed include reparsed, and only current config files cached."""
+        include_file_name = os.path.join(self.tmpdir, 'vlans.yaml')
+        include_config = """
+vlans:
+    office:
+        vid: %u
+"""
+        config = """
+include:
+    - vlans.yaml
+dps:
+    sw1:
+        dp_id: 0x1
+        interfaces:
+            1:
+                native_vlan: office
+"""
+        conf_file = self.create_config_file(config)
+        for vid in (100, 200, 200):
+            with open(include_file_name, 'w') as include_file:
+                include_file.write(include_config % vid)
+            config_hashes, dps = cp.dp_parser(conf_file, LOGNAME)
+            self.assertEqual(list(dps[0].vlans), [vid])
+            self.assertEqual(
+                set(cp.config_parser_util._PARSED_CONFIG_CACHE), # pylint: disable=protected-access
+                set(config_hashes.values()))
+
+    def test_conf_digests(self):
+        """Test only digests of changed config objects change."""
+        config = """
+vlans:
+    office:
+        vid: 100
+dps:
+    sw1:
+        dp_id: 0x1
+        interfaces:
+            1:
+                native_vlan: office
+            2:
+                native_vlan: office
+                description: %s
+"""
+        old_dp = self._get_dps_as_dict(config % 'old')[0x1]
+        same_dp = self._get_dps_as_dict(config % 'old')[0x1]
+        new_dp = self._get_dps_as_dict(config % 'new')[0x1]
+        for dp in (same_dp, new_dp):
+            self.assertEqual(old_dp.ports[1].dyn_digest, dp.ports[1].dyn_digest)
+            self.assertEqual(old_dp.ports[1], dp.ports[1])
+        self.assertEqual(old_dp.ports[2].dyn_digest, same_dp.ports[2].dyn_digest)
+        self.assertNotEqual(old_dp.ports[2].dyn_digest, new_dp.ports[2].dyn_digest)
+        self.assertNotEqual(old_dp.ports[2], new_dp.ports[2])
+        self.assertTrue(old_dp.vlans[100].ignore_subconf(new_dp.vlans[100]))
+
     def _check_table_names_numbers(self, dp, tables):
         for table_name, table in dp.tables.items():
             self.assertTrue(
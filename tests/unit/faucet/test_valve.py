@@ -20,10 +20,12 @@
 from collections import namedtuple
 from functools import partial
 
+import copy
 import cProfile
 import hashlib
 import io
 import ipaddress
+import json
 import logging
 import os
 import pstats
@@ -38,6 +40,7 @@ from ryu.controller.ofp_event import EventOFPMsgBase
 from ryu.lib import mac
 from ryu.lib.packet import arp, ethernet, icmp, icmpv6, ipv4, ipv6, lldp, slow, packet, vlan
 from ryu.ofproto import ether, inet
+from ryu.ofproto import ofproto_parser
 from ryu.ofproto import ofproto_v1_3 as ofp
 from ryu.ofproto import ofproto_v1_3_parser as parser
 
@@ -54,8 +57,10 @@ from faucet import faucet_experimental_api
 from faucet import faucet_event
 from faucet import faucet_metrics
 from faucet import valves_manager
+from faucet import valve_admission
 from faucet import valve_of
 from faucet import valve_packet
+from faucet import valve_shadow
 from faucet import valve_util
 from faucet.valve import TfmValve
 
@@ -402,6 +407,7 @@ class ValveTestBases:
         def teardown_valve(self):
             """Tear down test DP."""
             self.bgp.shutdown_bgp_speakers()
+            self.valves_manager.config_watcher.close()
             valve_util.close_logger(self.logger)
             for valve in list(self.valves_manager.valves.values()):
                 valve.close_logs()
@@ -541,7 +547,7 @@ class ValveTestBases:
         @staticmethod
         def flowmods_from_flows(flows):
             """Return flows that are flowmods actions."""
-            return [flow for flow in flows if isinstance(flow, valve_of.parser.OFPFlowMod)]
+            return [flow for flow in flows if valve_of.is_flowmod(flow)]
 
         def learn_hosts(self):
             """Learn some hosts."""
@@ -879,7 +885,7 @@ class ValveTestBases:
             self.assertFalse(route_add_replies)
             resolve_replies = self.valve.resolve_gateways(
                 time.time(), None)
-            self.assertFalse(resolve_replies)
+            self.assertTrue(resolve_replies)
             resolve_replies = self.valve.resolve_gateways(
                 time.time() + 99, None)
             self.assertTrue(resolve_replies)
@@ -1176,6 +1182,28 @@ class ValveTestBases:
                     msg=('mac address being seen on a vlan affects eth_dst rule on '
                          'other vlan'))
 
+        def test_learned_hosts_metrics(self):
+            """Test learned host metrics are generated from host caches when scraped."""
+
+            def verify_learned_hosts_metrics():
+                vlan = self.valve.dp.vlans[0x100]
+                self.assertEqual(
+                    vlan.hosts_count(),
+                    self.get_prom('vlan_hosts_learned', labels={'vlan': str(0x100)}))
+                learned_macs = [
+                    sample.value for metric in self.registry.collect()
+                    if metric.name == 'learned_macs'
+                    for sample in metric.samples if sample.labels['vlan'] == str(0x100)]
+                self.assertEqual(
+                    sorted([entry.eth_src_int for entry in vlan.dyn_host_cache.values()]),
+                    sorted(learned_macs))
+                return learned_macs
+
+            self.learn_hosts()
+            self.assertTrue(verify_learned_hosts_metrics())
+            self.valve.state_expire(time.time() + self.valve.dp.timeout * 2, None)
+            verify_learned_hosts_metrics()
+
         def test_known_eth_dst_rule_deletion(self):
             """Test that eth_dst rules are deleted when the mac is learned on
             another port.
@@ -1430,6 +1458,9 @@ meters:
             self.bgp._bgp_route_handler(
                 del_event,
                 faucet_bgp.BgpSpeakerKey(self.DP_ID, 0x100, 4))
+            self.bgp.flush_route_changes()
+            self.assertNotIn(
+                ipaddress.ip_network(prefix), self.valve.dp.vlans[0x100].routes_by_ipv(4))
             self.bgp._bgp_up_handler(nexthop, 65001)
             self.bgp._bgp_down_handler(nexthop, 65001)
 
@@ -1818,6 +1849,979 @@ dps:
         self.update_config(self.WARM_CONFIG, reload_type='warm')
 
 
+class ValveWarmStartDeltaTestCase(ValveTestBases.ValveTestSmall):
+    """Test warm start only sends the difference to what is installed."""
+
+    CONFIG = """
+dps:
+    s1:
+%s
+        interfaces:
+            p1:
+                number: 1
+                tagged_vlans: [0x100]
+            p2:
+                number: 2
+                tagged_vlans: [0x100]
+            p3:
+                number: 3
+                native_vlan: 0x100
+            p4:
+                number: 4
+                native_vlan: 0x200
+""" % DP1_CONFIG
+
+    WARM_CONFIG = """
+dps:
+    s1:
+%s
+        interfaces:
+            p1:
+                number: 1
+                tagged_vlans: [0x100]
+            p2:
+                number: 2
+                tagged_vlans: [0x100, 0x200]
+            p3:
+                number: 3
+                native_vlan: 0x100
+            p4:
+                number: 4
+                native_vlan: 0x200
+""" % DP1_CONFIG
+
+    connect_ofmsgs = None
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def connect_dp(self):
+        self.connect_ofmsgs = super(ValveWarmStartDeltaTestCase, self).connect_dp()
+        return self.connect_ofmsgs
+
+    @staticmethod
+    def _table_flows(table):
+        return sorted(str(table).splitlines())
+
+    def test_warm_start_delta(self):
+        """Test warm start delta has the same result as all warm start messages."""
+        full_table = FakeOFTable(self.NUM_TABLES)
+        full_table.apply_ofmsgs(valve_of.valve_flowreorder(self.connect_ofmsgs))
+        full_ofmsgs = []
+        shadow_delta = self.valve.shadow.delta
+
+        def _delta(ofmsgs):
+            full_ofmsgs.extend(ofmsgs)
+            return shadow_delta(ofmsgs)
+
+        self.valve.shadow.delta = _delta
+        warm_ofmsgs = self.update_config(self.WARM_CONFIG, reload_type='warm')
+        self.assertLess(len(warm_ofmsgs), len(full_ofmsgs))
+        unchanged_port_ofmsgs = [
+            ofmsg for ofmsg in warm_ofmsgs
+            if valve_of.is_flowmod(ofmsg) and ofmsg.match.get('in_port', None) == 1]
+        self.assertFalse(unchanged_port_ofmsgs, msg=unchanged_port_ofmsgs)
+        full_table.apply_ofmsgs(valve_of.valve_flowreorder(full_ofmsgs))
+        self.assertEqual(self._table_flows(full_table), self._table_flows(self.table))
+
+
+    def test_shadow_expire(self):
+        """Test shadow forgets flows the datapath will have timed out."""
+        eth_dst_table = self.valve.dp.tables['eth_dst']
+        now = time.time()
+        timeouts = {
+            'hard': {'hard_timeout': 10},
+            'idle': {'idle_timeout': 10},
+            'notified_idle': {'idle_timeout': 10, 'flags': ofp.OFPFF_SEND_FLOW_REM},
+        }
+        keys = {}
+        for vid, (name, flow_timeouts) in enumerate(timeouts.items(), start=0x300):
+            flowmod = valve_of.flowmod(
+                0, ofp.OFPFC_ADD, eth_dst_table.table_id, 1, 0, 0,
+                eth_dst_table.match(vlan=vid | ofp.OFPVID_PRESENT, eth_dst=self.P1_V100_MAC),
+                [], flow_timeouts.get('hard_timeout', 0), flow_timeouts.get('idle_timeout', 0),
+                flow_timeouts.get('flags', 0))
+            self.valve.shadow.apply_ofmsgs([flowmod], now=now)
+            keys[name] = valve_shadow.flow_key(
+                eth_dst_table.table_id, 1, valve_shadow.match_ints(flowmod.match))
+        self.valve.shadow.expire(now + 10)
+        for key in keys.values():
+            self.assertIn(key, self.valve.shadow.flows)
+        self.valve.shadow.expire(now + 10 + valve_shadow.TIMEOUT_GRACE_SEC + 1)
+        self.assertNotIn(keys['hard'], self.valve.shadow.flows)
+        self.assertNotIn(keys['idle'], self.valve.shadow.flows)
+        self.assertIn(keys['notified_idle'], self.valve.shadow.flows)
+
+
+class ValveFlowAuditTestCase(ValveTestBases.ValveTestSmall):
+    """Test reconnect with flow audit only sends differences."""
+
+    CONFIG = """
+dps:
+    s1:
+        dp_id: 1
+        hardware: 'Open vSwitch'
+        flow_audit: True
+        group_table: True
+        ignore_learn_ins: 0
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: 0x100
+            p2:
+                number: 2
+                native_vlan: 0x100
+            p3:
+                number: 3
+                tagged_vlans: [0x100, 0x200]
+"""
+
+    audit_ofmsgs = None
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    @staticmethod
+    def _wire(ofobj, parser_cls):
+        """Return ofobj as parsed by Ryu from the wire, as a switch would report it."""
+        buf = bytearray()
+        copy.deepcopy(ofobj).serialize(buf, 0)
+        return parser_cls.parser(bytes(buf), 0)
+
+    def _stats_replies(self):
+        flow_stats = []
+        for table_id, table in enumerate(self.table.tables):
+            for fte in table:
+                flowmod = fte.flowmod
+                flow_stats.append(parser.OFPFlowStats(
+                    table_id=table_id, duration_sec=0, duration_nsec=0,
+                    priority=flowmod.priority, idle_timeout=flowmod.idle_timeout,
+                    hard_timeout=flowmod.hard_timeout, flags=flowmod.flags,
+                    cookie=flowmod.cookie, packet_count=0, byte_count=0,
+                    match=self._wire(flowmod.match, parser.OFPMatch),
+                    instructions=[
+                        self._wire(inst, parser.OFPInstruction) for inst in fte.instructions]))
+        group_stats = [
+            parser.OFPGroupDescStats(
+                type_=groupmod.type, group_id=group_id,
+                buckets=[self._wire(bucket, parser.OFPBucket) for bucket in groupmod.buckets])
+            for group_id, groupmod in self.table.groups.items()]
+        # Flow stats split over two multipart replies.
+        half = len(flow_stats) // 2
+        return [
+            parser.OFPFlowStatsReply(
+                None, body=flow_stats[:half], flags=ofp.OFPMPF_REPLY_MORE),
+            parser.OFPGroupDescStatsReply(None, body=group_stats, flags=0),
+            parser.OFPFlowStatsReply(None, body=flow_stats[half:], flags=0)]
+
+    def connect_dp(self):
+        """Connect DP, replying to flow audit requests from the simulated switch."""
+        self.table.requires_tfm = False
+        discovered_up_ports = set(list(self.valve.dp.ports.keys())[:self.NUM_PORTS])
+        connect_msgs = (
+            self.valve.switch_features(None) +
+            self.valve.datapath_connect(time.time(), discovered_up_ports))
+        self.assertFalse([ofmsg for ofmsg in connect_msgs if valve_of.is_flowmod(ofmsg)])
+        self.assertTrue([
+            ofmsg for ofmsg in connect_msgs if isinstance(ofmsg, parser.OFPFlowStatsRequest)])
+        self.audit_ofmsgs = []
+        for reply in self._stats_replies():
+            self.audit_ofmsgs.extend(self.valve.flow_audit_reply(reply))
+        self.apply_ofmsgs(self.audit_ofmsgs)
+        self.valves_manager.update_config_applied(sent={self.DP_ID: True})
+        self.assertEqual(1, int(self.get_prom('dp_status')))
+        return connect_msgs
+
+    def _table_flows(self):
+        return sorted(str(self.table).splitlines())
+
+    def test_reconnect_unchanged(self):
+        """Test reconnect sends no flows when the switch is already programmed."""
+        self.assertTrue([ofmsg for ofmsg in self.audit_ofmsgs if valve_of.is_flowmod(ofmsg)])
+        flows = self._table_flows()
+        self.valve.datapath_disconnect()
+        self.connect_dp()
+        self.assertFalse(
+            [ofmsg for ofmsg in self.audit_ofmsgs
+             if valve_of.is_flowmod(ofmsg) or valve_of.is_groupmod(ofmsg)],
+            msg=self.audit_ofmsgs)
+        self.assertEqual(flows, self._table_flows())
+
+    def test_reconnect_stale(self):
+        """Test reconnect removes stale flows and replaces missing ones."""
+        flows = self._table_flows()
+        vlan_table = self.valve.dp.tables['vlan']
+        eth_src_table = self.valve.dp.tables['eth_src']
+        self.table.apply_ofmsgs([
+            vlan_table.flowdrop(
+                vlan_table.match(in_port=99), priority=self.valve.dp.high_priority),
+            eth_src_table.flowdel(eth_src_table.match(in_port=1))])
+        self.assertNotEqual(flows, self._table_flows())
+        self.valve.datapath_disconnect()
+        self.connect_dp()
+        self.assertEqual(flows, self._table_flows())
+
+    def _host_flows(self, eth_addr):
+        return [
+            fte.flowmod for table in self.table.tables for fte in table
+            if eth_addr in (fte.flowmod.match.get('eth_src'), fte.flowmod.match.get('eth_dst'))]
+
+    def test_learn_during_audit(self):
+        """Test flows sent while the audit is in progress are not deleted by it."""
+        self.valve.datapath_disconnect()
+        self.valve.switch_features(None)
+        self.valve.datapath_connect(time.time(), set(self.valve.dp.ports.keys()))
+        self.assertFalse(self._host_flows(self.P1_V100_MAC))
+        self.rcv_packet(1, 0x100, {
+            'eth_src': self.P1_V100_MAC,
+            'eth_dst': self.UNKNOWN_MAC,
+            'ipv4_src': '10.0.0.1',
+            'ipv4_dst': '10.0.0.2'})
+        host_flows = self._host_flows(self.P1_V100_MAC)
+        self.assertTrue(host_flows)
+        # Switch replies to the audit after the host flows were added.
+        audit_ofmsgs = []
+        for reply in self._stats_replies():
+            audit_ofmsgs.extend(self.valve.flow_audit_reply(reply))
+        self.assertTrue(audit_ofmsgs)
+        self.apply_ofmsgs(audit_ofmsgs)
+        self.assertEqual(len(host_flows), len(self._host_flows(self.P1_V100_MAC)))
+
+    def test_audit_error(self):
+        """Test flow audit falls back to cold start if the switch can't reply."""
+        self.valve.datapath_disconnect()
+        self.valve.switch_features(None)
+        stats_requests = self.valve.datapath_connect(time.time(), set())
+        for xid, stats_request in enumerate(stats_requests, start=1):
+            stats_request.xid = xid
+        test_err = parser.OFPErrorMsg(
+            datapath=None, type_=ofp.OFPET_BAD_REQUEST, code=ofp.OFPBRC_BAD_MULTIPART)
+        test_err.xid = stats_requests[0].xid
+        ofmsgs = self.valve.oferror(test_err)
+        self.assertTrue([ofmsg for ofmsg in ofmsgs if valve_of.is_global_flowdel(ofmsg)])
+
+
+class ValveBundleTestCase(ValveTestBases.ValveTestSmall):
+    """Test flow changes are sent as an atomic bundle."""
+
+    CONFIG = """
+dps:
+    s1:
+        bundles: True
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: 0x100
+            p2:
+                number: 2
+                native_vlan: 0x100
+            p3:
+                number: 3
+                tagged_vlans: [0x200]
+""" % DP1_CONFIG
+
+    MORE_CONFIG = """
+dps:
+    s1:
+        bundles: True
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: 0x100
+            p2:
+                number: 2
+                native_vlan: 0x100
+            p3:
+                number: 3
+                tagged_vlans: [0x100, 0x200]
+""" % DP1_CONFIG
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def _bundle_types(self, ofmsgs):
+        return [ofmsg.type for ofmsg in ofmsgs if isinstance(ofmsg, parser.ONFBundleCtrlMsg)]
+
+    def _connect_ofmsgs(self):
+        self.valve.datapath_disconnect()
+        discovered_up_ports = set(list(self.valve.dp.ports.keys())[:self.NUM_PORTS])
+        return self.apply_ofmsgs(
+            self.valve.switch_features(None) +
+            self.valve.datapath_connect(time.time(), discovered_up_ports))
+
+    def test_bundle_connect(self):
+        """Test cold start is sent as one bundle, after table features."""
+        flows = str(self.table)
+        connect_ofmsgs = self._connect_ofmsgs()
+        self.assertEqual(
+            [ofp.ONF_BCT_OPEN_REQUEST, ofp.ONF_BCT_COMMIT_REQUEST],
+            self._bundle_types(connect_ofmsgs))
+        bundle_open = [
+            i for i, ofmsg in enumerate(connect_ofmsgs)
+            if isinstance(ofmsg, parser.ONFBundleCtrlMsg)][0]
+        self.assertTrue(valve_of.is_table_features_req(connect_ofmsgs[bundle_open - 2]))
+        self.assertFalse([
+            ofmsg for ofmsg in connect_ofmsgs[bundle_open:]
+            if valve_of.is_bundleable(ofmsg) or valve_of.is_barrier(ofmsg)])
+        self.assertFalse(self.table.bundles)
+        self.assertEqual(flows, str(self.table))
+
+    def test_bundle_reload(self):
+        """Test reload applies bundled changes."""
+        match = {'in_port': 1, 'vlan_vid': 0, 'eth_src': self.P1_V100_MAC}
+        vid = 0x100|ofp.OFPVID_PRESENT
+        self.assertFalse(self.table.is_output(match, port=3, vid=vid))
+        self.update_config(self.MORE_CONFIG, reload_type='cold')
+        self.assertTrue(self.table.is_output(match, port=3, vid=vid))
+
+    def test_bundle_error(self):
+        """Test bundles are disabled if the switch rejects one."""
+        test_err = parser.OFPErrorMsg(
+            datapath=None, type_=ofp.OFPET_BAD_REQUEST, code=ofp.OFPBRC_BAD_EXPERIMENTER,
+            data=bytes([ofp.OFP_VERSION, ofp.OFPT_EXPERIMENTER, 0, 8, 0, 0, 0, 1]))
+        self.assertEqual(None, self.valve.oferror(test_err))
+        self.assertEqual([], self.valve.oferror(test_err))
+        connect_ofmsgs = self._connect_ofmsgs()
+        self.assertFalse(self._bundle_types(connect_ofmsgs))
+        self.assertTrue([ofmsg for ofmsg in connect_ofmsgs if valve_of.is_flowmod(ofmsg)])
+
+
+class ValveOutQueueTestCase(ValveTestBases.ValveTestSmall):
+    """Test queued flows are coalesced before being sent."""
+
+    CONFIG = """
+dps:
+    s1:
+        ofmsg_coalesce_ms: 1000
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: 0x100
+""" % DP1_CONFIG
+
+    class FakeRyuDp:
+        """Fake Ryu datapath that records sent messages."""
+
+        ofproto = ofp
+        ofproto_parser = parser
+
+        def __init__(self):
+            self.ofmsgs = []
+            self.writes = 0
+            self.xid = 0
+            self.closed = False
+
+        def set_xid(self, ofmsg):
+            """Set next xid on message."""
+            self.xid += 1
+            ofmsg.set_xid(self.xid)
+
+        def send(self, buf):
+            """Record messages in a write."""
+            self.writes += 1
+            while buf:
+                header = ofproto_parser.header(buf)
+                msg_len = header[2]
+                self.ofmsgs.append(ofproto_parser.msg(self, *header, buf[:msg_len]))
+                buf = buf[msg_len:]
+
+        def close(self):
+            """Close connection."""
+            self.closed = True
+
+        def sent_flows(self):
+            """Return flowmods sent, as Faucet flowmods."""
+            return [
+                valve_of.flowmod(
+                    ofmsg.cookie, ofmsg.command, ofmsg.table_id, ofmsg.priority,
+                    ofmsg.out_port, ofmsg.out_group, ofmsg.match, ofmsg.instructions,
+                    ofmsg.hard_timeout, ofmsg.idle_timeout, ofmsg.flags)
+                for ofmsg in self.ofmsgs if valve_of.is_flowmod(ofmsg)]
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def _flows(self, port):
+        eth_src_table = self.valve.dp.tables['eth_src']
+        match = eth_src_table.match(in_port=1, eth_src=self.P1_V100_MAC)
+        return (
+            eth_src_table.flowmod(
+                match, priority=self.valve.dp.high_priority,
+                inst=[valve_of.apply_actions([valve_of.output_port(port)])]),
+            eth_src_table.flowdel(match, priority=self.valve.dp.high_priority, strict=True))
+
+    def test_coalesce(self):
+        """Test superseded flows are not sent, and sent once due."""
+        ryu_dp = self.FakeRyuDp()
+        flow1, flowdel = self._flows(1)
+        flow2, _ = self._flows(2)
+        for ofmsgs in ([flow1], [flowdel], [flow2], [flow2]):
+            self.valve.send_flows(ryu_dp, ofmsgs)
+        self.assertFalse(ryu_dp.ofmsgs)
+        self.assertEqual(3, self.get_prom('of_outq_coalesced_total'))
+        self.assertEqual(self.valve.outq.depth, self.get_prom('of_outq_depth'))
+        now = time.time()
+        self.assertFalse(self.valve.flush_due(now))
+        self.assertTrue(self.valve.flush_due(now + 1))
+        self.valve.flush_flows(ryu_dp, now + 1)
+        self.assertEqual(0, self.get_prom('of_outq_depth'))
+        sent_flows = ryu_dp.sent_flows()
+        self.assertEqual([flow2], sent_flows)
+        self.assertEqual(1, len(ryu_dp.ofmsgs) - len(sent_flows))
+        self.assertEqual(1, ryu_dp.writes)
+
+    def test_overflow(self):
+        """Test a batch overflowing the queue is sent immediately, without disconnecting."""
+        ryu_dp = self.FakeRyuDp()
+        self.valve.outq.max_depth = 3
+        flow1, flowdel = self._flows(1)
+        self.valve.send_flows(ryu_dp, [flowdel])
+        self.assertFalse(ryu_dp.ofmsgs)
+        self.valve.send_flows(ryu_dp, [valve_of.barrier(), flow1])
+        self.assertFalse(ryu_dp.closed)
+        self.assertEqual([flow1], ryu_dp.sent_flows())
+        self.assertEqual(1, self.get_prom('of_outq_overflows_total'))
+        self.assertEqual(0, self.valve.outq.depth)
+
+    def test_batches(self):
+        """Test queued flows are sent in batches, one write per batch."""
+        ryu_dp = self.FakeRyuDp()
+        self.valve.OUTQ_BATCH_SIZE = 2
+        eth_src_table = self.valve.dp.tables['eth_src']
+        flows = [
+            eth_src_table.flowdrop(
+                eth_src_table.match(in_port=port), priority=self.valve.dp.high_priority)
+            for port in range(1, 6)]
+        self.valve.outq.put(time.time(), flows)
+        self.valve.flush_flows(ryu_dp, time.time(), max_ofmsgs=3)
+        self.assertEqual(2, ryu_dp.writes)
+        self.assertEqual(2, self.valve.outq.depth)
+        self.valve.flush_flows(ryu_dp, time.time())
+        self.assertEqual(3, ryu_dp.writes)
+        self.assertEqual(0, self.valve.outq.depth)
+        self.assertEqual(flows, ryu_dp.sent_flows())
+        self.assertEqual(
+            list(range(1, len(flows) + 1)), [ofmsg.xid for ofmsg in ryu_dp.ofmsgs])
+
+
+class ValveDPMetricsTestCase(ValveTestBases.ValveTestSmall):
+    """Test metric children bound to a DP."""
+
+    CONFIG = """
+dps:
+    s1:
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: 0x100
+""" % DP1_CONFIG
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def test_packet_in_metrics(self):
+        """Test per packet in metric updates use the child bound to the DP's labels."""
+        bound_child = self.valve.dp_metrics.of_vlan_packet_ins
+        self.assertIs(
+            self.metrics.of_vlan_packet_ins.labels( # pylint: disable=no-member
+                **self.valve.dp.base_prom_labels()),
+            bound_child)
+        before = self.get_prom('of_vlan_packet_ins_total')
+        bound_child.inc()
+        self.assertEqual(before + 1, self.get_prom('of_vlan_packet_ins_total'))
+
+    def test_port_vlan_metrics(self):
+        """Test port and VLAN children are bound once, to the right labels."""
+        port_metrics = self.valve.dp_metrics.ports[1]
+        self.assertIs(port_metrics.port_learn_bans, port_metrics.port_learn_bans)
+        port_metrics.port_learn_bans.set(2)
+        self.assertEqual(2, self.get_prom('port_learn_bans', labels=self.port_labels(1)))
+        self.valve.dp_metrics.vlans[0x100].vlan_learn_bans.set(3)
+        self.assertEqual(3, self.get_prom('vlan_learn_bans', labels={'vlan': str(0x100)}))
+
+
+class ValvePacketAdmissionTestCase(ValveTestBases.ValveTestSmall):
+    """Test packet in admission control."""
+
+    CONFIG = """
+dps:
+    s1:
+        packet_in_admission:
+            port_learn_rate: 2
+            control_rate: 3
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+            p2:
+                number: 2
+                native_vlan: v100
+vlans:
+    v100:
+        vid: 0x100
+        faucet_vips: ['10.0.0.254/24', 'fc00::1:254/112']
+""" % DP1_CONFIG.replace('ignore_learn_ins: 100', 'ignore_learn_ins: 0')
+
+    class PktMeta(namedtuple('pkt_meta', ['eth_type', 'eth_dst', 'port', 'vlan', 'l3_dst'])):
+        """Packet metadata with L3 addresses already parsed."""
+
+        def parse_l3_addrs(self):
+            """Addresses are already parsed."""
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def _pkt_meta(self, eth_type, eth_dst, port_no, l3_dst=None):
+        if l3_dst is not None:
+            l3_dst = ipaddress.ip_address(l3_dst)
+        return self.PktMeta(
+            eth_type, eth_dst, self.valve.dp.ports[port_no], self.valve.dp.vlans[0x100], l3_dst)
+
+    def _admitted(self, now, pkt_meta, count):
+        return [self.valve.admit_packet_in(now, pkt_meta) for _ in range(count)].count(True)
+
+    def test_classify(self):
+        """Test packet ins are classed on Ethernet header."""
+        admission = self.valve.admission
+        for eth_type, eth_dst, l3_dst, packet_class in (
+                (valve_of.ether.ETH_TYPE_SLOW, '01:80:c2:00:00:02', None, 'lacp'),
+                (valve_of.ether.ETH_TYPE_LLDP, '01:80:c2:00:00:0e', None, 'lldp'),
+                (valve_of.ether.ETH_TYPE_ARP, 'ff:ff:ff:ff:ff:ff', '10.0.0.254', 'l3'),
+                (valve_of.ether.ETH_TYPE_ARP, FAUCET_MAC, '10.0.0.254', 'l3'),
+                (valve_of.ether.ETH_TYPE_ARP, 'ff:ff:ff:ff:ff:ff', '10.0.0.2', 'learn'),
+                (valve_of.ether.ETH_TYPE_IP, FAUCET_MAC, None, 'l3'),
+                (valve_of.ether.ETH_TYPE_IPV6, '33:33:ff:01:02:54', None, 'l3'),
+                (valve_of.ether.ETH_TYPE_IPV6, '33:33:ff:00:00:02', None, 'learn'),
+                (valve_of.ether.ETH_TYPE_IP, self.UNKNOWN_MAC, None, 'learn')):
+            self.assertEqual(
+                packet_class,
+                admission.classify(self._pkt_meta(eth_type, eth_dst, 1, l3_dst=l3_dst)))
+
+    def test_learn_storm(self):
+        """Test learning storm on a port does not starve control plane or other ports."""
+        now = time.time()
+        learn_pkt_meta = self._pkt_meta(valve_of.ether.ETH_TYPE_IP, self.UNKNOWN_MAC, 1)
+        lacp_pkt_meta = self._pkt_meta(valve_of.ether.ETH_TYPE_SLOW, '01:80:c2:00:00:02', 1)
+        self.assertEqual(2, self._admitted(now, learn_pkt_meta, 100))
+        self.assertEqual(98, self.get_prom(
+            'of_packet_in_drops_total', labels={'packet_class': 'learn'}))
+        self.assertEqual(3, self._admitted(now, lacp_pkt_meta, 10))
+        self.assertEqual(7, self.get_prom(
+            'of_packet_in_drops_total', labels={'packet_class': 'lacp'}))
+        self.assertEqual(2, self._admitted(
+            now, self._pkt_meta(valve_of.ether.ETH_TYPE_IP, self.UNKNOWN_MAC, 2), 10))
+        # Buckets refill over time.
+        self.assertEqual(2, self._admitted(now + 1, learn_pkt_meta, 10))
+        self.assertEqual(3, self._admitted(now + 1, lacp_pkt_meta, 10))
+
+
+class ValvePendingLearnTestCase(ValveTestBases.ValveTestSmall):
+    """Test packet ins from hosts being learned are suppressed."""
+
+    CONFIG = """
+dps:
+    s1:
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+            p2:
+                number: 2
+                native_vlan: v100
+vlans:
+    v100:
+        vid: 0x100
+""" % DP1_CONFIG.replace('ignore_learn_ins: 100', 'ignore_learn_ins: 0')
+
+    PKT_META = namedtuple('pkt_meta', ['eth_type', 'eth_src', 'eth_dst', 'port', 'vlan'])
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def _pkt_meta(self, port_no):
+        return self.PKT_META(
+            valve_of.ether.ETH_TYPE_IP, self.P1_V100_MAC, self.UNKNOWN_MAC,
+            self.valve.dp.ports[port_no], self.valve.dp.vlans[0x100])
+
+    def test_pending_learn(self):
+        """Test duplicate learning packet ins are suppressed until learning completes."""
+        self.rcv_packet(1, 0x100, {
+            'eth_src': self.P1_V100_MAC,
+            'eth_dst': self.UNKNOWN_MAC,
+            'ipv4_src': '10.0.0.1',
+            'ipv4_dst': '10.0.0.2'})
+        now = time.time()
+        self.assertFalse(self.valve.admit_packet_in(now, self._pkt_meta(1)))
+        self.assertEqual(1, self.get_prom('of_suppressed_packet_ins_total'))
+        # A host moving port is not suppressed.
+        self.assertTrue(self.valve.admit_packet_in(now, self._pkt_meta(2)))
+        later = now + valve_admission.LEARN_PENDING_SEC + 1
+        self.assertTrue(self.valve.admit_packet_in(later, self._pkt_meta(1)))
+        self.valve.admission.expire_pending_learns(later)
+        self.assertFalse(self.valve.admission.pending_learns)
+
+
+class ValveBgpRouteBatchTestCase(ValveTestBases.ValveTestSmall):
+    """Test BGP route changes are applied in batches."""
+
+    CONFIG = """
+dps:
+    s1:
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+vlans:
+    v100:
+        vid: 0x100
+        faucet_vips: ['10.0.0.254/24']
+""" % DP1_CONFIG
+
+    NEXTHOP = '10.0.0.1'
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+        self.rcv_packet(1, 0x100, {
+            'eth_src': self.P1_V100_MAC,
+            'eth_dst': FAUCET_MAC,
+            'arp_code': arp.ARP_REPLY,
+            'arp_source_ip': self.NEXTHOP,
+            'arp_target_ip': '10.0.0.254'})
+        self.sent_flows = []
+        self.bgp._send_flow_msgs = lambda valve, flows: self.sent_flows.append(flows)
+
+    def _route_change(self, prefix, withdraw=False):
+        if withdraw:
+            event = RouteRemoval(IPPrefix.from_string(prefix))
+        else:
+            event = RouteAddition(
+                IPPrefix.from_string(prefix), IPAddress.from_string(self.NEXTHOP), '65001', 'IGP')
+        self.bgp._bgp_route_handler(event, faucet_bgp.BgpSpeakerKey(self.DP_ID, 0x100, 4))
+
+    def test_coalesce(self):
+        """Test only the latest change to a prefix is applied."""
+        self._route_change('192.168.1.0/24')
+        self._route_change('192.168.1.0/24', withdraw=True)
+        self._route_change('192.168.2.0/24')
+        self.assertFalse(self.sent_flows)
+        self.bgp.flush_route_changes()
+        self.assertEqual(1, len(self.sent_flows))
+        self.assertEqual(
+            {ipaddress.ip_network('192.168.2.0/24'): ipaddress.ip_address(self.NEXTHOP)},
+            self.valve.dp.vlans[0x100].routes_by_ipv(4))
+
+    def _initial_convergence(self, prefixes):
+        for i in range(prefixes):
+            self._route_change(str(ipaddress.ip_network((0x0b000000 + (i << 8), 24))))
+        self.bgp.flush_route_changes()
+        self.assertEqual(1, len(self.sent_flows))
+        self.assertEqual(prefixes, len(self.sent_flows[0]))
+        routes = self.valve.dp.vlans[0x100].routes_by_ipv(4)
+        self.assertEqual(prefixes, len(routes))
+        self.assertEqual(
+            ipaddress.ip_network('11.0.1.0/24'),
+            routes.longest_match(ipaddress.ip_address('11.0.1.1')))
+
+    def test_initial_convergence(self):
+        """Test a table of many prefixes is applied in one batch."""
+        self._initial_convergence(1000)
+
+    @unittest.skipUnless(os.environ.get('FAUCET_BENCHMARK'), 'FAUCET_BENCHMARK not set')
+    def test_initial_convergence_benchmark(self):
+        """Benchmark initial convergence of a full table of 100k prefixes."""
+        prefixes = 100000
+        start = time.process_time()
+        self._initial_convergence(prefixes)
+        print('initial convergence of %u prefixes: %.2fs' % (
+            prefixes, time.process_time() - start))
+
+
+class ValveRoutedVipSubnetTestCase(ValveTestBases.ValveTestSmall):
+    """Test destinations routed within a VIP subnet are not resolved as neighbors."""
+
+    CONFIG = """
+dps:
+    s1:
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+vlans:
+    v100:
+        vid: 0x100
+        faucet_vips: ['10.0.0.254/24']
+        routes:
+            - route:
+                ip_dst: 10.0.0.128/25
+                ip_gw: 10.0.0.1
+            - route:
+                ip_dst: 0.0.0.0/0
+                ip_gw: 10.0.0.1
+""" % DP1_CONFIG
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def test_proactive_learn(self):
+        """Test only destinations not routed more specifically are proactively resolved."""
+        routes = self.valve.dp.vlans[0x100].routes_by_ipv(4)
+        for dst_ip, neighbor in (('10.0.0.130', False), ('10.0.0.99', True)):
+            self.rcv_packet(1, 0x100, {
+                'eth_src': self.P1_V100_MAC,
+                'eth_dst': FAUCET_MAC,
+                'ipv4_src': '10.0.0.2',
+                'ipv4_dst': dst_ip,
+                'echo_request_data': self.ICMP_PAYLOAD})
+            self.assertEqual(
+                neighbor, ipaddress.ip_network(dst_ip + '/32') in routes, msg=dst_ip)
+
+
+class ValveFibCompressionTestCase(ValveTestBases.ValveTestSmall):
+    """Test FIB compression installs fewer routes with the same forwarding."""
+
+    CONFIG = """
+dps:
+    s1:
+        fib_compression: True
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+vlans:
+    v100:
+        vid: 0x100
+        faucet_vips: ['10.0.0.254/24']
+        routes:
+            - route:
+                ip_dst: 10.99.0.0/24
+                ip_gw: 10.0.0.1
+            - route:
+                ip_dst: 10.99.1.0/24
+                ip_gw: 10.0.0.1
+            - route:
+                ip_dst: 10.99.0.128/25
+                ip_gw: 10.0.0.1
+""" % DP1_CONFIG
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+        self._resolve_gw()
+
+    def _resolve_gw(self):
+        return self.rcv_packet(1, 0x100, {
+            'eth_src': self.P1_V100_MAC,
+            'eth_dst': FAUCET_MAC,
+            'arp_code': arp.ARP_REPLY,
+            'arp_source_ip': '10.0.0.1',
+            'arp_target_ip': '10.0.0.254'})
+
+    def test_reconnect(self):
+        """Test compressed FIB is reinstalled after the DP reconnects."""
+        fib_table_id = self.valve.dp.tables['ipv4_fib'].table_id
+        self.connect_dp()
+        fib_flowmods = [
+            ofmsg for ofmsg in self._resolve_gw()
+            if (valve_of.is_flowmod(ofmsg) and not valve_of.is_flowdel(ofmsg) and
+                ofmsg.table_id == fib_table_id)]
+        self.assertTrue(fib_flowmods)
+
+    def test_fib_compression(self):
+        """Test covered and adjacent routes with the same nexthop are compressed."""
+        vlan = self.valve.dp.vlans[0x100]
+        installed = self.valve._route_manager_by_ipv[4].fib_compressors[vlan.vid].installed
+        self.assertIn(ipaddress.ip_network('10.99.0.0/23'), installed)
+        for ip_dst in ('10.99.0.0/24', '10.99.1.0/24', '10.99.0.128/25'):
+            self.assertNotIn(ipaddress.ip_network(ip_dst), installed)
+        labels = {'vlan': str(vlan.vid), 'ipv': '4'}
+        logical_routes = self.get_prom('vlan_fib_routes_logical', labels=dict(labels))
+        self.assertEqual(2, logical_routes - self.get_prom(
+            'vlan_fib_routes_installed', labels=dict(labels)))
+        # Withdrawing a route splits the aggregate again.
+        ofmsgs = self.valve.del_route(vlan, ipaddress.ip_network('10.99.1.0/24'))
+        self.assertTrue(ofmsgs)
+        self.apply_ofmsgs(ofmsgs)
+        self.assertIn(ipaddress.ip_network('10.99.0.0/24'), installed)
+        self.assertNotIn(ipaddress.ip_network('10.99.0.0/23'), installed)
+
+
+class ValveNexthopResolveTestCase(ValveTestBases.ValveTestSmall):
+    """Test nexthops are resolved when due, sharing attempts between VLANs."""
+
+    CONFIG = """
+dps:
+    s1:
+        max_hosts_per_resolve_cycle: 2
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+            p2:
+                number: 2
+                native_vlan: v200
+vlans:
+    v100:
+        vid: 0x100
+        faucet_vips: ['10.0.0.254/24']
+    v200:
+        vid: 0x200
+        faucet_vips: ['10.0.1.254/24']
+""" % DP1_CONFIG
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def test_resolve_due(self):
+        """Test only due nexthops are attempted, and a busy VLAN does not starve another."""
+        vlan100 = self.valve.dp.vlans[0x100]
+        vlan200 = self.valve.dp.vlans[0x200]
+        for i in range(1, 21):
+            self.valve.add_route(
+                vlan100, ipaddress.ip_address('10.0.0.%u' % i),
+                ipaddress.ip_network('10.100.%u.0/24' % i))
+        for i in range(1, 3):
+            self.valve.add_route(
+                vlan200, ipaddress.ip_address('10.0.1.%u' % i),
+                ipaddress.ip_network('10.200.%u.0/24' % i))
+        route_manager = self.valve._route_manager_by_ipv[4] # pylint: disable=protected-access
+        now = time.time()
+
+        def retried(vlan):
+            return [
+                ip_gw for ip_gw, entry in vlan.neigh_cache_by_ipv(4).items()
+                if entry.resolve_retries]
+
+        # New nexthops are tried in the first cycle.
+        self.assertEqual(22, route_manager.resolve_backlog(vlan100, now) +
+                         route_manager.resolve_backlog(vlan200, now))
+        self.assertTrue(self.valve.resolve_gateways(now, None))
+        self.assertEqual(2, len(retried(vlan100)))
+        self.assertEqual(2, len(retried(vlan200)))
+        self.assertEqual(18, route_manager.resolve_backlog(vlan100, now))
+        self.assertEqual(0, route_manager.resolve_backlog(vlan200, now))
+        self.assertEqual(4, self.get_prom('nexthop_resolve_latency_secs_count'))
+        self.valve.update_metrics(now)
+        self.assertEqual(18, self.get_prom(
+            'vlan_nexthop_resolve_backlog', labels={'vlan': str(vlan100.vid), 'ipv': '4'}))
+        # Spare attempts go to the VLAN with a backlog.
+        self.assertTrue(self.valve.resolve_gateways(now, None))
+        self.assertEqual(6, len(retried(vlan100)))
+        self.assertEqual(2, len(retried(vlan200)))
+        for entry in vlan100.neigh_cache_by_ipv(4).values():
+            if entry.resolve_retries:
+                self.assertEqual(1, entry.resolve_retries)
+        self.assertEqual(14, route_manager.resolve_backlog(vlan100, now))
+
+
+class ValveEventNotifierTestCase(ValveTestBases.ValveTestSmall):
+    """Test event notifier buffers serialized events for clients."""
+
+    CONFIG = """
+dps:
+    s1:
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: 0x100
+""" % DP1_CONFIG
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    @staticmethod
+    def _events(event_bytes):
+        return [json.loads(event) for event in event_bytes.decode('UTF-8').splitlines()]
+
+    def test_events_since(self):
+        """Test events can be replayed from an event ID, filtered by type."""
+        notifier = self.notifier
+        first_event_id = notifier.event_id
+        for port_no in range(1, 4):
+            notifier.notify(self.DP_ID, self.DP, {'L2_LEARN': {'port_no': port_no}})
+            notifier.notify(self.DP_ID, self.DP, {'L2_EXPIRE': {'port_no': port_no}})
+        last_event_id, event_bytes = notifier.events_since(first_event_id)
+        self.assertEqual(first_event_id + 6, last_event_id)
+        events = self._events(event_bytes)
+        self.assertEqual(
+            list(range(first_event_id + 1, last_event_id + 1)),
+            [event['event_id'] for event in events])
+        _, event_bytes = notifier.events_since(
+            first_event_id + 2, frozenset(['L2_LEARN']))
+        self.assertEqual(
+            [2, 3], [event['L2_LEARN']['port_no'] for event in self._events(event_bytes)])
+
+    def test_no_socket(self):
+        """Test events are not serialized when there is no event socket."""
+        notifier = faucet_event.FaucetEventNotifier(None, self.metrics, self.logger)
+        notifier.notify(self.DP_ID, self.DP, {'L2_LEARN': {'port_no': 1}})
+        self.assertEqual(1, notifier.event_id)
+        self.assertFalse(any(notifier.event_buffer))
+
+    def test_buffer_wrap(self):
+        """Test only the most recent events are buffered."""
+        notifier = self.notifier
+        for port_no in range(notifier.EVENT_BUFFER_SIZE * 2):
+            notifier.notify(self.DP_ID, self.DP, {'L2_LEARN': {'port_no': port_no}})
+        last_event_id, event_bytes = notifier.events_since(0)
+        events = self._events(event_bytes)
+        self.assertEqual(notifier.EVENT_BUFFER_SIZE, len(events))
+        self.assertEqual(last_event_id, events[-1]['event_id'])
+
+
+class ValveServiceSchedulerTestCase(ValveTestBases.ValveTestSmall):
+    """Test Valve services are called only when due."""
+
+    CONFIG = """
+dps:
+    s1:
+        advertise_interval: 30
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: 0x100
+""" % DP1_CONFIG
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def test_services_due(self):
+        """Test services are called once due, then rescheduled."""
+        # No VLAN is routed, so there are no gateways to resolve.
+        self.assertNotIn(
+            (self.DP_ID, 'resolve_gateways'),
+            self.valves_manager._service_due) # pylint: disable=protected-access
+        now = time.time()
+        next_due = self.valves_manager.valve_services_next_due()
+        self.assertLess(next_due, now + 30)
+        self.valves_manager.valve_flow_services_due(next_due - 1)
+        self.assertEqual(next_due, self.valves_manager.valve_services_next_due())
+        later = now + 30
+        self.valves_manager.valve_flow_services_due(later)
+        self.assertEqual(later, self.valve._last_advertise_sec) # pylint: disable=protected-access
+        self.assertGreater(self.valves_manager.valve_services_next_due(), later)
+        lateness_labels = {'valve_service': 'advertise'}
+        self.assertEqual(1, self.get_prom(
+            'faucet_valve_service_lateness_secs_count', labels=lateness_labels))
+        # Advertise is not due again until its configured interval has passed.
+        self.valves_manager.valve_flow_services_due(later + 15)
+        self.assertEqual(1, self.get_prom(
+            'faucet_valve_service_lateness_secs_count', labels=lateness_labels))
+        self.valves_manager.valve_flow_services_due(later + 30)
+        self.assertEqual(2, self.get_prom(
+            'faucet_valve_service_lateness_secs_count', labels=lateness_labels))
+
+
 class ValveDeleteVLANTestCase(ValveTestBases.ValveTestSmall):
     """Test deleting VLAN."""
 
@@ -1855,6 +2859,49 @@ dps:
         self.update_config(self.LESS_CONFIG, reload_type='warm')
 
 
+class ValvePacketTestCase(unittest.TestCase): # pytype: disable=module-attr
+    """Test packet in header fast path agrees with Ryu parsing."""
+
+    PKTS = (
+        {'eth_src': '0e:00:00:00:00:01', 'eth_dst': 'ff:ff:ff:ff:ff:ff', 'vid': 0x100,
+         'arp_source_ip': '10.0.0.1', 'arp_target_ip': '10.0.0.254'},
+        {'eth_src': '0e:00:00:00:00:01', 'eth_dst': '0e:00:00:00:00:02', 'vid': 0x200,
+         'ipv4_src': '10.0.0.1', 'ipv4_dst': '10.0.0.2'},
+        {'eth_src': '0e:00:00:00:00:01', 'eth_dst': '33:33:00:00:00:01', 'vid': 0xfff,
+         'ipv6_src': 'fc00::1', 'ipv6_dst': 'fc00::2'},
+        {'eth_src': '0e:00:00:00:00:01', 'eth_dst': '0e:00:00:00:00:02',
+         'ipv4_src': '10.0.0.1', 'ipv4_dst': '10.0.0.2'},
+    )
+
+    def test_parse_eth_header(self):
+        """Test Ethernet/VLAN header and L3 addresses match Ryu parsed packet."""
+        for pkt in self.PKTS:
+            data = build_pkt(pkt).data
+            _, eth_pkt, eth_type, _, vlan_vid = valve_packet.parse_packet_in_pkt(
+                data, max_len=valve_packet.ETH_VLAN_HEADER_SIZE)
+            self.assertEqual(
+                (eth_pkt.src, eth_pkt.dst, eth_type, vlan_vid),
+                valve_packet.parse_eth_header(data))
+            if vlan_vid is None:
+                continue
+            pkt_meta = valve_packet.PacketMeta(
+                data, len(data), None, None, eth_pkt.src, eth_pkt.dst, eth_type)
+            pkt_meta.parse_l3_addrs()
+            l3_addrs = (pkt_meta.l3_src, pkt_meta.l3_dst)
+            self.assertTrue(all(l3_addrs))
+            pkt_meta.reparse_ip()
+            self.assertEqual(l3_addrs, (pkt_meta.l3_src, pkt_meta.l3_dst))
+        self.assertEqual(None, valve_packet.parse_eth_header(bytes(12)))
+        self.assertEqual(
+            None, valve_packet.parse_eth_header(bytes(12) + bytes([0x81, 0x00, 0])))
+
+    def test_mac_addr_is_unicast(self):
+        """Test unicast MAC detection."""
+        self.assertTrue(valve_packet.mac_addr_is_unicast('0e:00:00:00:00:01'))
+        self.assertFalse(valve_packet.mac_addr_is_unicast('ff:ff:ff:ff:ff:ff'))
+        self.assertFalse(valve_packet.mac_addr_is_unicast('01:80:C2:00:00:02'))
+
+
 class ValveOFErrorTestCase(ValveTestBases.ValveTestSmall):
     """Test decoding of OFErrors."""
 
@@ -2255,6 +3302,33 @@ class ValveRootStackTestCase(ValveTestBases.ValveTestSmall):
         self.verify_flooding(matches)
 
 
+class ValveShardTestCase(ValveTestBases.ValveTestSmall):
+    """Test partitioning DPs across shards."""
+
+    DP = 's3'
+    DP_ID = 0x3
+
+    def setUp(self):
+        self.setup_valve(CONFIG)
+
+    def test_shard_dps(self):
+        """Test each DP is in one shard, with stacked DPs in the same shard."""
+        shard_dp_ids = []
+        for shard in range(3):
+            shard_valves_manager = valves_manager.ValvesManager(
+                self.LOGNAME, self.logger, self.metrics, self.notifier,
+                self.bgp, self.dot1x, self.send_flows_to_dp_by_id,
+                shard=shard, shards=3)
+            shard_dp_ids.append(set([
+                dp.dp_id for dp in shard_valves_manager.parse_configs(self.config_file)]))
+        self.assertEqual([set([0x3, 0x4]), set([0x1]), set([0xdeadbeef])], shard_dp_ids)
+        with self.assertRaises(ValueError):
+            valves_manager.ValvesManager(
+                self.LOGNAME, self.logger, self.metrics, self.notifier,
+                self.bgp, self.dot1x, self.send_flows_to_dp_by_id,
+                shard=2, shards=2)
+
+
 class ValveEdgeStackTestCase(ValveTestBases.ValveTestSmall):
     """Test stacking/forwarding."""
 
@@ -2472,6 +3546,172 @@ class ValveStackGraphUpdateTestCase(ValveStackProbeTestCase):
         verify_stack_learn_edges(2, edges[0], self.assertTrue)
 
 
+class ValveStackEdgeHostIndexTestCase(ValveStackProbeTestCase):
+    """Test hosts learned on edge ports are indexed across the stack."""
+
+    def test_edge_host_index(self):
+        """Test edge DP for a host is found from the index, as hosts are learned and expire."""
+        edge_host_index = self.valves_manager.edge_host_index
+        self.assertIs(edge_host_index, self.valve.edge_host_index)
+        s3_valve = self.valves_manager.valves[0x3]
+        vlan = s3_valve.dp.vlans[100]
+        edge_port = s3_valve.dp.ports[1]
+        stack_port = s3_valve.dp.ports[2]
+        now = time.time()
+        vlan.add_cache_host(self.P1_V100_MAC, edge_port, now)
+        self.assertEqual('s3', edge_host_index.edge_dp(
+            100, self.P1_V100_MAC, exclude_dp_id=self.DP_ID))
+        self.assertIsNone(edge_host_index.edge_dp(
+            100, self.P1_V100_MAC, exclude_dp_id=0x3))
+        pkt_meta = namedtuple('pkt_meta', ('port', 'vlan', 'eth_src'))(
+            self.valve.dp.ports[1], self.valve.dp.vlans[100], self.P1_V100_MAC)
+        self.assertEqual(
+            's3', self.valve.flood_manager._edge_dp_for_host(pkt_meta)) # pylint: disable=protected-access
+        # A host learned from a stack port is not at the edge.
+        vlan.add_cache_host(self.P1_V100_MAC, stack_port, now)
+        self.assertIsNone(edge_host_index.edge_dp(100, self.P1_V100_MAC))
+        vlan.add_cache_host(self.P1_V100_MAC, edge_port, now)
+        self.assertEqual('s3', edge_host_index.edge_dp(100, self.P1_V100_MAC))
+        vlan.expire_cache_hosts(now + 1, 0)
+        self.assertIsNone(edge_host_index.edge_dp(100, self.P1_V100_MAC))
+        self.assertEqual(0, len(edge_host_index))
+
+
+class ValveStackLearnPropagationTestCase(ValveStackProbeTestCase):
+    """Test hosts learned on an edge DP are learned by other DPs in the stack."""
+
+    def test_learn_propagation(self):
+        """Test other DPs learn a host towards its edge DP, without a packet in."""
+        other_valves = [self.valves_manager.valves[dp_id] for dp_id in (0x2, 0x3)]
+        for valve in [self.valve] + other_valves:
+            valve.dp.dyn_running = True
+            for port in valve.dp.stack_ports:
+                port.dyn_phys_up = True
+        self.rcv_packet(3, 100, {
+            'eth_src': self.P1_V100_MAC,
+            'eth_dst': self.UNKNOWN_MAC,
+            'ipv4_src': '10.0.0.1',
+            'ipv4_dst': '10.0.0.2'})
+        for valve, towards_port_no in zip(other_valves, (1, 2)):
+            entry = valve.dp.vlans[100].cached_host(self.P1_V100_MAC)
+            self.assertIsNotNone(entry)
+            self.assertEqual(valve.dp.ports[towards_port_no], entry.port)
+            self.assertEqual(1, self.registry.get_sample_value(
+                'of_avoided_packet_ins_total',
+                labels={'dp_id': '0x%x' % valve.dp.dp_id, 'dp_name': valve.dp.name}))
+        self.assertEqual(0, self.get_prom('of_avoided_packet_ins_total'))
+
+
+def _stack_ring_config(stack_size):
+    """Return config for a ring of stacked DPs, with s1 as root."""
+    dps_config = []
+    for dp_no in range(1, stack_size + 1):
+        dp_config = DP1_CONFIG + """
+        stack:
+            priority: 1"""
+        if dp_no != 1:
+            dp_config = """
+        dp_id: %u
+        hardware: 'GenericTFM'""" % dp_no
+        dps_config.append("""
+    s%u:
+%s
+        interfaces:
+            1:
+                description: p1
+                stack:
+                    dp: s%u
+                    port: 2
+            2:
+                description: p2
+                stack:
+                    dp: s%u
+                    port: 1
+            3:
+                description: p3
+                native_vlan: v100""" % (
+                        dp_no, dp_config,
+                        (dp_no - 2) % stack_size + 1,
+                        dp_no % stack_size + 1))
+    return """
+dps:%s
+vlans:
+    v100:
+        vid: 100
+""" % ''.join(dps_config)
+
+
+class ValveStackPathsTestCase(ValveTestBases.ValveTestSmall):
+    """Test paths between stack DPs are computed once per stack topology change."""
+
+    STACK_SIZE = 50
+    CONFIG = _stack_ring_config(STACK_SIZE)
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def test_topology_change(self):
+        """Test paths are recomputed after the stack topology changes."""
+        dp = self.valve.dp
+        last_dp = 's%u' % self.STACK_SIZE
+        self.assertEqual(['s1', last_dp], dp.shortest_path(last_dp))
+        self.assertEqual(
+            self.STACK_SIZE // 2 + 1, len(dp.shortest_path('s%u' % (self.STACK_SIZE // 2 + 1))))
+        for port in dp.stack_ports:
+            port.dyn_phys_up = True
+        self.assertEqual(dp.ports[1], dp.shortest_path_port(last_dp))
+        self.assertEqual(dp.ports[2], dp.shortest_path_port('s2'))
+        graph_version = dp.dyn_stack_graph_version
+        self.valve.flood_manager.update_stack_topo(False, dp, dp.ports[1])
+        # Topology version is runtime state, not part of the stack config.
+        self.assertEqual(graph_version + 1, dp.dyn_stack_graph_version)
+        self.assertNotIn('graph_version', dp.stack)
+        self.assertEqual(self.STACK_SIZE, len(dp.shortest_path(last_dp)))
+        self.assertEqual(dp.ports[2], dp.shortest_path_port(last_dp))
+        self.valve.flood_manager.update_stack_topo(True, dp, dp.ports[1])
+        self.assertEqual(['s1', last_dp], dp.shortest_path(last_dp))
+
+    def test_path_lookups(self):
+        """Test path and port lookups between all DPs in a stack use precomputed paths."""
+        dp = self.valve.dp
+        for port in dp.stack_ports:
+            port.dyn_phys_up = True
+        dp_names = ['s%u' % dp_no for dp_no in range(1, self.STACK_SIZE + 1)]
+        stack_paths = dp.dyn_stack_paths
+        for src_dp in dp_names:
+            for dest_dp in dp_names:
+                dp.shortest_path(dest_dp, src_dp=src_dp)
+        for dest_dp in dp_names:
+            dp.shortest_path_port(dest_dp)
+        # Lookups used the paths as computed when the stack topology last changed.
+        self.assertIs(stack_paths, dp.dyn_stack_paths)
+
+    @unittest.skipUnless(os.environ.get('FAUCET_BENCHMARK'), 'FAUCET_BENCHMARK not set')
+    def test_path_lookups_benchmark(self):
+        """Benchmark path and port lookups between all DPs in a stack, and a topology change."""
+        dp = self.valve.dp
+        for port in dp.stack_ports:
+            port.dyn_phys_up = True
+        dp_names = ['s%u' % dp_no for dp_no in range(1, self.STACK_SIZE + 1)]
+        start = time.process_time()
+        self.valve.flood_manager.update_stack_topo(False, dp, dp.ports[1])
+        dp.shortest_path_port(dp_names[-1])
+        print('%u DP stack paths after topology change: %.4fs' % (
+            self.STACK_SIZE, time.process_time() - start))
+        lookups = 0
+        start = time.process_time()
+        for _ in range(100):
+            for src_dp in dp_names:
+                for dest_dp in dp_names:
+                    dp.shortest_path(dest_dp, src_dp=src_dp)
+                    lookups += 1
+            for dest_dp in dp_names:
+                dp.shortest_path_port(dest_dp)
+                lookups += 1
+        print('%u DP stack path lookup: %.2fus' % (
+            self.STACK_SIZE, (time.process_time() - start) / lookups * 1e6))
+
+
 class ValveReloadConfigProfile(ValveTestBases.ValveTestSmall):
 
     CONFIG = """
@@ -3060,6 +4300,41 @@ class ValveReloadConfigTestCase(ValveTestBases.ValveTestBig):
         self.update_config(CONFIG, reload_type='warm', reload_expected=False)
 
 
+class ValveConfigWatcherTestCase(ValveTestBases.ValveTestSmall):
+    """Test config file changes are detected with inotify."""
+
+    CONFIG = """
+dps:
+    s1:
+%s
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: 0x100
+""" % DP1_CONFIG
+
+    def setUp(self):
+        self.setup_valve(self.CONFIG)
+
+    def test_inotify(self):
+        """Test only changes to config files are detected."""
+        # eventlet has already monkey patched os (via faucet_bgp et al).
+        try:
+            valve_util.Inotify().close()
+        except OSError:
+            self.skipTest('inotify not supported')
+        config_watcher = self.valves_manager.config_watcher
+        self.assertIsNotNone(config_watcher.watch())
+        self.assertFalse(config_watcher.files_changed())
+        with open(os.path.join(self.tmpdir, 'other.yaml'), 'w') as other_file:
+            other_file.write(self.CONFIG)
+        self.assertFalse(config_watcher.files_changed())
+        with open(self.config_file, 'a') as config_file:
+            config_file.write('# changed\n')
+        self.assertTrue(config_watcher.files_changed())
+        self.assertFalse(config_watcher.files_changed())
+
+
 class ValveMirrorTestCase(ValveTestBases.ValveTestBig):
     """Test ACL and interface mirroring."""
     # TODO: check mirror packets are present/correct
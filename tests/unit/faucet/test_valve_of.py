@@ -18,7 +18,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import os
+import time
 import unittest
+from unittest import mock
 
 from faucet import valve_of
 
@@ -59,6 +63,100 @@ class ValveOfTestCase(unittest.TestCase): # pytype: disable=module-attr
         # with regular flow last
         self.assertEqual(str(flow), reordered_str[-1], msg=reordered)
 
+    def test_bundle(self):
+        """Test flow changes are bundled, with other messages after commit."""
+        flowdel = valve_of.flowmod(
+            cookie=None, hard_timeout=None, idle_timeout=None, match_fields=None, out_port=None,
+            table_id=9, inst=[], priority=0, command=valve_of.ofp.OFPFC_DELETE,
+            out_group=valve_of.ofp.OFPG_ANY)
+        flow = valve_of.flowmod(
+            cookie=0, hard_timeout=0, idle_timeout=0, match_fields=None, out_port=0,
+            table_id=9, inst=[], priority=1, command=valve_of.ofp.OFPFC_ADD,
+            out_group=0)
+        packetout = valve_of.packetout(1, bytes(64))
+        flows = [packetout, flow, flowdel]
+        bundled = valve_of.bundle_ofmsgs(
+            1, valve_of.valve_flowreorder(flows, use_barriers=True))
+        self.assertEqual(5, len(bundled), msg=bundled)
+        self.assertEqual(valve_of.ofp.ONF_BCT_OPEN_REQUEST, bundled[0].type)
+        self.assertTrue(all(
+            isinstance(ofmsg, valve_of.parser.ONFBundleAddMsg) for ofmsg in bundled[1:3]))
+        self.assertEqual(
+            [str(valve_of.bundleadd(1, ofmsg)) for ofmsg in (flowdel, flow)],
+            [str(ofmsg) for ofmsg in bundled[1:3]])
+        self.assertEqual(valve_of.ofp.ONF_BCT_COMMIT_REQUEST, bundled[3].type)
+        self.assertEqual(packetout, bundled[4])
+
+    def test_flowmod_ir(self):
+        """Test flowmods are hashable, compare by value and convert to Ryu."""
+
+        def _flowmod(port):
+            return valve_of.flowmod(
+                cookie=1, command=valve_of.ofp.OFPFC_ADD, table_id=1, priority=2,
+                out_port=0, out_group=0,
+                match_fields=valve_of.match({'in_port': port, 'vlan_vid': (0x1000, 0x1000)}),
+                inst=[valve_of.apply_actions([valve_of.output_port(port)])],
+                hard_timeout=0, idle_timeout=0)
+
+        flow = _flowmod(1)
+        self.assertEqual(flow, _flowmod(1))
+        self.assertEqual(hash(flow), hash(_flowmod(1)))
+        self.assertNotEqual(flow, _flowmod(2))
+        self.assertEqual(2, len({flow, _flowmod(1), _flowmod(2)}))
+        self.assertEqual(1, flow.match['in_port'])
+        ryu_flow = flow.to_ryu()
+        self.assertTrue(isinstance(ryu_flow, valve_of.parser.OFPFlowMod))
+        self.assertEqual(dict(flow.match.items()), dict(ryu_flow.match.items()))
+        self.assertEqual(flow, valve_of.flowmod(
+            ryu_flow.cookie, ryu_flow.command, ryu_flow.table_id, ryu_flow.priority,
+            ryu_flow.out_port, ryu_flow.out_group, ryu_flow.match, ryu_flow.instructions,
+            ryu_flow.hard_timeout, ryu_flow.idle_timeout))
+
+    @staticmethod
+    def _flowmods(count):
+        """Return count flowmods, some duplicate and some deletes."""
+        ofmsgs = []
+        for i in range(count):
+            # Every 4th flow is a duplicate of its predecessor.
+            if i % 4 == 3:
+                ofmsgs.append(copy.copy(ofmsgs[-1]))
+                continue
+            port = i
+            command = valve_of.ofp.OFPFC_ADD
+            if i % 10 == 0:
+                command = valve_of.ofp.OFPFC_DELETE
+            ofmsgs.append(valve_of.flowmod(
+                cookie=1, command=command, table_id=i % 8, priority=port % 1000,
+                out_port=0, out_group=0,
+                match_fields=valve_of.match({'in_port': port, 'vlan_vid': 0x1000 | (i % 4000)}),
+                inst=[valve_of.apply_actions([valve_of.output_port(port)])],
+                hard_timeout=0, idle_timeout=0))
+        return ofmsgs
+
+    def test_reorder_single_pass(self):
+        """Test reordering classifies each message once, and dedupes and orders them."""
+        large = self._flowmods(int(1e4))
+        msg_kind = valve_of._msg_kind # pylint: disable=protected-access
+        with mock.patch.object(valve_of, '_msg_kind', wraps=msg_kind) as msg_kind_mock:
+            reordered = valve_of.valve_flowreorder(large, use_barriers=True)
+        self.assertEqual(len(large), msg_kind_mock.call_count)
+        reordered_flows = [ofmsg for ofmsg in reordered if valve_of.is_flowmod(ofmsg)]
+        self.assertEqual(len(large) - len(large) // 4, len(reordered_flows))
+        self.assertEqual(len(reordered_flows), len(set(reordered_flows)))
+        deletes = [ofmsg for ofmsg in reordered_flows if valve_of.is_flowdel(ofmsg)]
+        self.assertEqual(deletes, reordered_flows[:len(deletes)])
+        adds = reordered_flows[len(deletes):]
+        self.assertEqual(sorted(adds, key=lambda ofmsg: -ofmsg.priority), adds)
+
+    @unittest.skipUnless(os.environ.get('FAUCET_BENCHMARK'), 'FAUCET_BENCHMARK not set')
+    def test_reorder_benchmark(self):
+        """Benchmark reordering 10k and 100k message batches."""
+        for count in (int(1e4), int(1e5)):
+            ofmsgs = self._flowmods(count)
+            start = time.process_time()
+            valve_of.valve_flowreorder(ofmsgs, use_barriers=True)
+            print('reorder of %u messages: %.3fs' % (count, time.process_time() - start))
+
 
 if __name__ == "__main__":
     unittest.main() # pytype: disable=module-attr
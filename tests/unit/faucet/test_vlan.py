@@ -1,8 +1,12 @@
 """Unit tests for VLAN"""
 
+import array
+import os
+import time
 import unittest
 from ipaddress import ip_address, ip_network, ip_interface
 
+from faucet.port import Port
 from faucet.vlan import VLAN
 
 
@@ -138,6 +142,34 @@ class FaucetVLANMethodTest(unittest.TestCase):
         self.assertEqual(vlan.route_count_by_ipv(4), 0)
         self.assertEqual(vlan.routes_by_ipv(4), {})
 
+    def test_routes_longest_match(self):
+        """Tests routes are indexed for longest prefix match"""
+
+        vlan = VLAN(1, 1, {})
+
+        for ip_dst, ip_gw in (
+                ('0.0.0.0/0', '10.0.0.1'),
+                ('10.99.0.0/16', '10.0.0.2'),
+                ('10.99.99.0/24', '10.0.0.3'),
+                ('10.99.99.128/25', '10.0.0.4')):
+            vlan.add_route(ip_network(ip_dst), ip_address(ip_gw))
+        routes = vlan.routes_by_ipv(4)
+        for ip_addr, ip_dst in (
+                ('192.168.0.1', '0.0.0.0/0'),
+                ('10.99.1.1', '10.99.0.0/16'),
+                ('10.99.99.1', '10.99.99.0/24'),
+                ('10.99.99.200', '10.99.99.128/25')):
+            self.assertEqual(ip_network(ip_dst), routes.longest_match(ip_address(ip_addr)))
+        self.assertEqual(
+            set([ip_network('10.99.99.0/24'), ip_network('10.99.99.128/25')]),
+            set(routes.subnets(ip_network('10.99.99.0/24'))))
+        vlan.del_route(ip_network('10.99.99.0/24'))
+        self.assertEqual(
+            ip_network('10.99.0.0/16'), routes.longest_match(ip_address('10.99.99.1')))
+        self.assertEqual(
+            ip_network('10.99.99.128/25'), routes.longest_match(ip_address('10.99.99.200')))
+        self.assertIsNone(routes.longest_match(ip_address('fc00::1')))
+
     def test_modify_routes_v6(self):
         """Tests the add_route() and remove_route() methods with IPv4 routes"""
 
@@ -230,6 +262,111 @@ class FaucetVLANMethodTest(unittest.TestCase):
             ip_network('fc00::30:0/112'): ip_address('fc00::1:99')
         })
 
+    @staticmethod
+    def _cache_hosts(vlan, port, hosts):
+        """Add hosts to cache, one every 10ms"""
+        for i in range(hosts):
+            eth_src = '0e:00:00:%2.2x:%2.2x:%2.2x' % (
+                (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+            vlan.add_cache_host(eth_src, port, i / 100)
+
+    def test_expire_cache_hosts(self):
+        """Tests host expiry visits only expiring hosts, with 100k hosts"""
+
+        vlan = VLAN(1, 1, {})
+        port = Port(1, 1, {})
+        permanent_port = Port(2, 1, {'permanent_learn': True})
+        hosts = int(1e5)
+        learn_timeout = 300
+        self._cache_hosts(vlan, port, hosts)
+        vlan.add_cache_host('0e:00:00:ff:ff:ff', permanent_port, 0)
+        # Refreshed host must not be expired at its original cache time.
+        vlan.add_cache_host('0e:00:00:00:00:00', port, hosts / 100)
+        self.assertEqual(hosts + 1, vlan.hosts_count())
+
+        class CountingArray(array.array):
+            """Array that counts reads."""
+
+            reads = 0
+
+            def __getitem__(self, index):
+                CountingArray.reads += 1
+                return super().__getitem__(index)
+
+        host_cache = vlan.dyn_host_cache
+        host_cache._cache_times = CountingArray( # pylint: disable=protected-access
+            'd', host_cache._cache_times) # pylint: disable=protected-access
+
+        # With nothing expiring, only hosts in the oldest bucket (1s) are visited.
+        self.assertFalse(vlan.expire_cache_hosts(learn_timeout, learn_timeout))
+        self.assertGreater(200, CountingArray.reads)
+
+        expired = vlan.expire_cache_hosts(learn_timeout + 100.5, learn_timeout)
+        self.assertEqual(10050 - 1, len(expired))
+        self.assertTrue(all(entry.cache_time < 100.5 for entry in expired))
+        self.assertEqual(hosts + 1 - len(expired), vlan.hosts_count())
+        self.assertTrue(vlan.cached_host('0e:00:00:00:00:00'))
+        self.assertTrue(vlan.cached_host('0e:00:00:ff:ff:ff'))
+
+        expired = vlan.expire_cache_hosts(learn_timeout * 10, learn_timeout)
+        self.assertEqual(hosts + 1 - 10050, len(expired))
+        self.assertEqual(1, vlan.hosts_count())
+        self.assertTrue(vlan.cached_host('0e:00:00:ff:ff:ff'))
+
+    @unittest.skipUnless(os.environ.get('FAUCET_BENCHMARK'), 'FAUCET_BENCHMARK not set')
+    def test_expire_cache_hosts_benchmark(self):
+        """Benchmark host expiry with 100k hosts"""
+
+        vlan = VLAN(1, 1, {})
+        port = Port(1, 1, {})
+        hosts = int(1e5)
+        learn_timeout = 300
+        self._cache_hosts(vlan, port, hosts)
+        start = time.process_time()
+        for _ in range(100):
+            vlan.expire_cache_hosts(learn_timeout, learn_timeout)
+        print('expiry of no hosts (of %u): %.6fs' % (hosts, (time.process_time() - start) / 100))
+        start = time.process_time()
+        expired = vlan.expire_cache_hosts(learn_timeout + hosts / 200, learn_timeout)
+        print('expiry of %u hosts (of %u): %.3fs' % (
+            len(expired), hosts, time.process_time() - start))
+
+    def test_host_cache(self):
+        """Tests host cache adds, moves and removes hosts"""
+
+        vlan = VLAN(1, 1, {})
+        port1 = Port(1, 1, {})
+        port2 = Port(2, 1, {})
+        port1.native_vlan = vlan
+        port2.native_vlan = vlan
+        vlan.add_cache_host('0e:00:00:00:00:01', port1, 1)
+        vlan.add_cache_host('0e:00:00:00:00:02', port1, 2)
+        entry = vlan.cached_host('0e:00:00:00:00:01')
+        self.assertEqual(port1, entry.port)
+        self.assertEqual(1, entry.cache_time)
+        self.assertEqual(0x0e0000000001, entry.eth_src_int)
+        self.assertEqual(2, port1.hosts_count())
+        self.assertEqual(2, len(port1.hosts()))
+
+        # Host moves port.
+        vlan.add_cache_host('0e:00:00:00:00:01', port2, 3)
+        self.assertEqual(1, port1.hosts_count())
+        self.assertEqual(1, port2.hosts_count())
+        self.assertEqual(3, port2.hosts()[0].cache_time)
+        self.assertIsNone(vlan.cached_host_on_port('0e:00:00:00:00:01', port1))
+        self.assertTrue(vlan.cached_host_on_port('0e:00:00:00:00:01', port2))
+
+        # Removed host's slot is reused.
+        vlan.expire_cache_host('0e:00:00:00:00:02')
+        self.assertIsNone(vlan.cached_host('0e:00:00:00:00:02'))
+        self.assertEqual((), port1.hosts())
+        vlan.add_cache_host('0e:00:00:00:00:03', port1, 4)
+        self.assertEqual(2, vlan.hosts_count())
+        self.assertEqual(
+            ['0e:00:00:00:00:03'], [entry.eth_src for entry in port1.hosts()])
+        vlan.clear_cache_hosts_on_port(port2)
+        self.assertEqual(1, vlan.hosts_count())
+
 
 if __name__ == "__main__":
     unittest.main() # pytype: disable=module-attr